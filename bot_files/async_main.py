@@ -0,0 +1,195 @@
+import asyncio
+import os
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+from loguru import logger
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import ReplyKeyboardMarkup, KeyboardButton, Message, CallbackQuery
+from telegram_bot_calendar import DetailedTelegramCalendar
+
+import botrequests.async_func as af
+import botrequests.bot_func as bf
+from botrequests.bot_classes import async_api_client, hotel_index, rapidapi_limiter
+from botrequests.city_index import CITY_INDEX_PATH, city_index
+from botrequests.conversation import restore, set_step
+from botrequests.date_picker import date_picker
+from botrequests.history import history_log
+from botrequests.metrics import AsyncTraceMiddleware, MetricsServer, metrics, setup_logging
+from botrequests.prefetch import prefetcher
+from botrequests.retention import session_retention
+from botrequests.send_queue import AsyncQueuedBot, async_send_queue
+from botrequests.session_store import session_store
+
+load_dotenv()
+
+bot = AsyncQueuedBot(AsyncTeleBot(os.getenv('TOKEN_TELEGRAM')), async_send_queue)
+bot.setup_middleware(AsyncTraceMiddleware(metrics))
+
+service_messages: Dict = {'/lowprice': 'PRICE',
+                          '/highprice': 'PRICE_HIGHEST_FIRST',
+                          '/bestdeal': 'DISTANCE_FROM_LANDMARK',
+                          '/flexprice': 'FLEX_PRICE'}
+
+
+@bot.message_handler(func=af.conversation.is_input, content_types=['text'])
+async def next_step_handler(message: Message):
+    """
+    Передает сообщение обработчику текущего шага диалога, либо text_handler, если диалог не ожидает ввода.
+    Шаг диалога проверяется здесь, а не в фильтре: фильтры вызываются синхронно, а текущий запрос чата
+    может понадобиться загрузить из базы
+    """
+    if await af.expects_input(message):
+        await af.conversation.handle(message, bot)
+    else:
+        await text_handler(message)
+
+
+@bot.message_handler(commands=['start'])
+async def start_handler(message: Message):
+    """ Обработчик команды start"""
+    await bot.send_message(message.chat.id, f'Приветствую, {message.from_user.first_name}!\n'
+                                            f'Я бот-помощник и постараюсь помочь Вам в поиске лучших вариантов отелей\n'
+                                            f'Для помощи по командам наберите /help)')
+
+
+@bot.message_handler(commands=['help'])
+async def help_handler(message: Message):
+    """ Обработчик команды help"""
+    keyboard_menu = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
+    keyboard_menu.add(KeyboardButton('/lowprice'), KeyboardButton('/highprice'),
+                      KeyboardButton('/bestdeal'), KeyboardButton('/flexprice'), KeyboardButton('/history'))
+    await bot.send_message(message.chat.id, 'В меню используйте следующие команды:\n'
+                                            '/lowprice - Поиск отелей с демократическими ценами\n'
+                                            '/highprice - Поиск отелей с максимальными ценами\n'
+                                            '/bestdeal - Поиск доступных отелей по удаленности от центра города\n'
+                                            '/flexprice - Поиск самых низких цен на даты рядом с выбранными\n'
+                                            '/history - Просмотр истории поиска',
+                           reply_markup=keyboard_menu)
+
+
+@bot.message_handler(commands=['lowprice', 'highprice', 'bestdeal', 'flexprice'])
+async def request_handler(message: Message):
+    """ Обработчик команд lowprice, highprice, bestdeal, flexprice """
+    logger.info(f'message {message.from_user.id}{message.text}')
+    await af.new_session(message, service_messages[message.text])
+    await bot.send_message(message.chat.id, 'В каком городе ищем отели? ')
+    set_step(message, 'search_city')
+
+
+@bot.message_handler(commands=['history'])
+async def history_handler(message: Message):
+    """ Обработчик команды history"""
+    logger.info(f'message {message.from_user.id}{message.text}')
+    await af.show_history(message, bot)
+
+
+@bot.message_handler(commands=['stats'], func=bf.is_admin)
+async def stats_handler(message: Message):
+    """ Обработчик команды администратора stats"""
+    logger.info(f'message {message.from_user.id}{message.text}')
+    await bot.send_message(message.chat.id, metrics.report()[:bf.MESSAGE_LIMIT])
+
+
+@bot.callback_query_handler(func=DetailedTelegramCalendar.func())
+async def calendar(call: CallbackQuery):
+    """ Обработчик inline callback запросов для ввода дат"""
+    await af.load_session(call.message)
+    locale: str = bf.get_value_from_save(call.message, 'locale')[:2]
+    result, key = date_picker.process(locale, call.data)
+    if key:
+        await bot.edit_message_text(bf.dates_text(call.message),
+                                    call.message.chat.id,
+                                    call.message.message_id,
+                                    reply_markup=key)
+    elif result:
+        await bot.edit_message_text(f"Вы выбрали {result}",
+                                    call.message.chat.id,
+                                    call.message.message_id)
+        logger.info(f'call chat_id {call.from_user.id}: {call.data}')
+        dates = date_picker.choose(call.message.chat.id, result)
+        if dates is None:
+            await af.check_dates(call.message, bot)
+        elif bf.validation_dates(call.message, *dates):
+            logger.info(f'message {call.message.from_user.id}: Даты введены корректно')
+            date_picker.save(call.message.chat.id, *dates)
+            await af.search_hotels(call.message, bot)
+        else:
+            await bot.send_message(call.message.chat.id, 'Возможно Вы ошиблись при вводе данных.'
+                                                         ' Дата выезда не может быть раньше или равна дате въезда.'
+                                                         'Попробуйте ввести их еще раз')
+            await af.check_dates(call.message, bot)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_inline(call: CallbackQuery):
+    """Обработчик callback inline  запросов """
+    logger.info(f'call chat_id {call.from_user.id}: {call.data}')
+    data_sep = call.data.split('.')
+    if data_sep[1] == 'history':
+        await af.turn_history_page(call, bot)
+        return
+    if data_sep[1] == 'results':
+        await af.turn_results_page(call, bot)
+        return
+    await af.load_session(call.message)
+    if data_sep[1] == 'city_id':
+        bf.update_save(call.message, 'city_id', data_sep[0])
+        await bot.send_message(call.message.chat.id,
+                               'Сколько вариантов отелей показывать? Прошу ограничится 25')
+        set_step(call.message, 'number_hotels')
+    elif data_sep[1] == 'hotel_id':
+        bf.choose_hotel(call.message, data_sep[0])
+        await af.check_photo(call.message, bot)
+    elif data_sep[1] == 'photo':
+        if data_sep[0] == 'No':
+            bf.update_save(call.message, 'hotel_pics', '0')
+            await af.search_hotel_info(call.message, bot)
+        else:
+            await bot.send_message(call.message.chat.id,
+                                   'Сколько фотографий данного отеля показывать? Прошу ограничится 15')
+            set_step(call.message, 'number_photos')
+
+
+@bot.message_handler(content_types=['text'])
+async def text_handler(message):
+    """ Обработчик текстовых сообщений"""
+    logger.info(f'message chat_id {message.from_user.id}: {message.text}')
+    await bot.send_message(message.chat.id, 'Если в меню определены кнопки для выбора,'
+                                            ' прошу их использовать, а не вводить данные руками.\n'
+                                            'В случае ошибки, попробуйте повторить ввод данных с начала,'
+                                            ' используя команду /start')
+
+
+async def run() -> None:
+    """Запускает асинхронный бот и останавливает фоновые задачи при завершении"""
+    session_store.start()
+    history_log.start()
+    hotel_index.start()
+    session_retention.start()
+    metrics_server: Optional[MetricsServer] = MetricsServer(metrics) if int(os.getenv('METRICS_PORT', 9108)) else None
+    if metrics_server is not None:
+        metrics_server.start()
+    try:
+        await bot.polling(non_stop=True)
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        await async_send_queue.stop()
+        await async_api_client.close()
+        await asyncio.to_thread(rapidapi_limiter.quota.save)
+        city_index.save(CITY_INDEX_PATH)
+        prefetcher.stop()
+        session_retention.stop()
+        hotel_index.stop()
+        history_log.stop()
+        session_store.stop()
+
+
+if __name__ == '__main__':
+    setup_logging('botrequests/logs.log')
+    logger.info('Async bot is starting')
+    bf.create_database()
+    restore()
+    city_index.load(CITY_INDEX_PATH)
+    asyncio.run(run())
@@ -0,0 +1,437 @@
+"""
+Микро-бенчмарки бота. Запуск из каталога bot_files:
+    python benchmark.py collect
+    python benchmark.py parse [--hotels-payload list.json] [--details-payload details.json]
+    python benchmark.py render [--hotels-payload list.json] [--details-payload details.json]
+    python benchmark.py shards [--processes 1 2 4] [--updates 2000]
+    python benchmark.py hotels [--hotels 100000] [--cities 20] [--queries 1000]
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from botrequests.bot_classes import db
+
+SEARCH_HOTELS_COLUMNS = ('city_id', 'page_number', 'number_hotels', 'check_in', 'check_out',
+                         'number_persons', 'sort_order', 'locale', 'currency')
+
+
+class QueryCounter:
+    """Класс, подсчитывающий количество sql-запросов к базе"""
+
+    def __init__(self):
+        self.count: int = 0
+        self._execute_sql: Callable = db.execute_sql
+
+    def __enter__(self) -> 'QueryCounter':
+        def counted_execute_sql(*args, **kwargs):
+            self.count += 1
+            return self._execute_sql(*args, **kwargs)
+
+        db.execute_sql = counted_execute_sql
+        return self
+
+    def __exit__(self, *exc) -> None:
+        db.execute_sql = self._execute_sql
+
+
+def fake_message(chat_id: int, text: str = '') -> SimpleNamespace:
+    """Возвращает объект, заменяющий сообщение telebot"""
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), from_user=SimpleNamespace(id=chat_id), text=text)
+
+
+def temporary_database() -> str:
+    """Переключает базу на временный файл и создает таблицы"""
+    import botrequests.bot_func as bf
+
+    path = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    db.init(path)
+    bf.create_database()
+    return path
+
+
+def legacy_collect_request(message: SimpleNamespace, *args: str) -> Dict:
+    """
+    Сборка запроса к API так, как до хранения запросов в памяти: для каждой колонки ключ API читается
+    из первой строки таблицы Session, а значение - из последней записи чата, каждое в своем соединении
+    """
+    from botrequests.bot_classes import Session
+
+    collected_request: Dict = dict()
+    for arg in args:
+        with db:
+            key: str = getattr(Session.get(Session.id == 1), arg)
+        with db:
+            cur_query = Session.select().where(Session.chat_id == message.chat.id).limit(1).order_by(Session.id.desc())
+            collected_request[key] = getattr(cur_query[0], arg)
+    return collected_request
+
+
+def bench_collect(chats: int) -> Dict:
+    """Количество sql-запросов и время сборки запроса search_hotels"""
+    import botrequests.bot_func as bf
+    from botrequests.session_store import session_store
+
+    temporary_database()
+    messages: List = [fake_message(chat_id) for chat_id in range(1, chats + 1)]
+    for message in messages:
+        bf.add_new_save(message, 'PRICE')
+    session_store.flush()
+    for message in messages:
+        session_store.forget(message.chat.id)
+
+    result: Dict = {'columns': len(SEARCH_HOTELS_COLUMNS)}
+    for name, collect in (('before', legacy_collect_request), ('cold', bf.collect_request),
+                          ('warm', bf.collect_request)):
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            for message in messages:
+                collect(message, *SEARCH_HOTELS_COLUMNS)
+            elapsed = time.perf_counter() - start
+        result[f'queries_{name}'] = counter.count / chats
+        result[f'us_{name}'] = elapsed / chats * 1e6
+    return result
+
+
+def sample_hotels_payload(hotels: int = 25) -> bytes:
+    """Возвращает ответ properties/list в формате API с hotels отелями и типичным набором лишних полей"""
+    results: List = [{'id': 100000 + num, 'name': f'Hotel {num}', 'starRating': num % 5 + 0.5 * (num % 2),
+                      'urls': {}, 'address': {'streetAddress': f'{num} Main street', 'locality': 'Moscow',
+                                              'postalCode': '101000', 'region': '', 'countryName': 'Russia',
+                                              'countryCode': 'ru', 'obfuscate': False},
+                      'guestReviews': {'unformattedRating': 8.4, 'rating': '8.4', 'scale': 10, 'total': 1234,
+                                       'badge': 'fabulous', 'badgeText': 'Fabulous'},
+                      'landmarks': [{'label': 'City center', 'distance': f'{num / 10:.1f} km'},
+                                    {'label': 'Airport', 'distance': '30 km'}],
+                      'ratePlan': {'price': {'current': f'${50 + num}', 'exactCurrent': 50.0 + num,
+                                             'old': f'${70 + num}', 'info': 'nightly price per room'},
+                                   'features': {'freeCancellation': True, 'paymentPreference': False,
+                                                'noCCRequired': False}},
+                      'neighbourhood': 'Tverskoy', 'deals': {'specialDeal': {'dealText': 'Save 10%'}},
+                      'messaging': {'scarcity': 'Only 2 left'}, 'badging': {}, 'pimmsAttributes': 'x' * 200,
+                      'coordinate': {'lat': 55.75 + num / 1000, 'lon': 37.61 + num / 1000},
+                      'roomsLeft': 2, 'providerType': 'LOCAL', 'supplierHotelId': 1000 + num, 'isAlternative': False,
+                      'optimizedThumbUrls': {'srpDesktop': f'https://exp.cdn-hotels.com/{num}.jpg'}}
+                     for num in range(hotels)]
+    payload: Dict = {'result': 'OK', 'data': {'body': {'header': 'Moscow', 'query': {'destination': {'id': '1'}},
+                                                       'searchResults': {'totalCount': hotels, 'results': results,
+                                                                         'pagination': {'currentPage': 1}},
+                                                       'sortResults': {'options': [{'label': 'x'}] * 20},
+                                                       'filters': {'name': {'item': {'value': ''}},
+                                                                   'facilities': {'items': [{'label': 'f'}] * 200}}}}}
+    return json.dumps(payload).encode()
+
+
+def sample_details_payload() -> bytes:
+    """Возвращает ответ properties/get-details в формате API"""
+    payload: Dict = {'result': 'OK', 'data': {'body': {
+        'pdpHeader': {'hotelId': 100000, 'hotelLocation': {'coordinates': {'latitude': 55.75, 'longitude': 37.61},
+                                                           'locationName': 'Moscow'}},
+        'overview': {'overviewSections': [
+            {'title': 'Main amenities', 'type': 'HOTEL_FEATURE', 'content': [f'Amenity {num}' for num in range(12)]},
+            {'title': 'What is around', 'type': 'LOCATION_SECTION', 'content': [f'Place {num}' for num in range(8)]},
+            {'title': 'Family friendly', 'type': 'FAMILY_FRIENDLY_SECTION', 'content': ['Free cribs'] * 5}]},
+        'propertyDescription': {'name': 'Hotel 0', 'address': {'fullAddress': '0 Main street, Moscow, Russia'},
+                                'featuredPrice': {'currentPrice': {'formatted': '$50', 'plain': 50},
+                                                  'priceInfo': 'nightly price per room'},
+                                'mapWidget': {'staticMapUrl': 'https://maps.googleapis.com/maps/api/staticmap'},
+                                'freebies': ['Free WiFi'] * 10, 'roomTypeNames': [f'Room {num}' for num in range(20)]},
+        'amenities': [{'heading': 'In the hotel', 'listItems': [{'heading': 'Food', 'listItems': ['Bar'] * 30}] * 10}],
+        'hygieneAndCleanliness': {'title': 'x' * 500}, 'smallPrint': {'policies': ['y' * 300] * 10},
+        'specialFeatures': {'sections': [{'heading': 'z' * 50, 'freeText': 'w' * 1000}] * 5}}}}
+    return json.dumps(payload).encode()
+
+
+def legacy_hotels(raw: bytes) -> List[Tuple]:
+    """Разбор properties/list в том виде, в каком он был до введения модуля parsing"""
+    variants_hotels: Dict = json.loads(raw.decode('utf-8'))
+    return [(f"{hotel.get('name')} {'⭐️' * int(hotel.get('starRating', 0))}  "
+             f"{hotel.get('address').get('streetAddress')}. "
+             f"{str(hotel.get('ratePlan').get('price').get('current')).lower()} "
+             f"{hotel.get('landmarks')[0].get('distance').split(sep=' ')[0]} до центра",
+             str(hotel.get('id')) + '.hotel_id')
+            for hotel in variants_hotels['data']['body']['searchResults']['results']]
+
+
+def legacy_details(raw: bytes) -> Any:
+    """Разбор properties/get-details в том виде, в каком он был до введения модуля parsing"""
+    this_hotel: Dict = json.loads(raw.decode('utf-8'))
+    short_path = this_hotel.get('data').get('body').get('overview').get('overviewSections')
+    return ([short_path[num].get('title') for num in range(len(short_path))
+             if short_path[num].get('type') == 'HOTEL_FEATURE'],
+            [short_path[num].get('content') for num in range(len(short_path))
+             if short_path[num].get('type') == 'HOTEL_FEATURE'],
+            [short_path[num].get('title') for num in range(len(short_path))
+             if short_path[num].get('type') == 'LOCATION_SECTION'],
+            [short_path[num].get('content') for num in range(len(short_path))
+             if short_path[num].get('type') == 'LOCATION_SECTION'],
+            this_hotel.get('data').get('body').get('propertyDescription').get('name'))
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict:
+    """
+    Измеряет процессорное время одного вызова и пиковый объем памяти, выделяемой при вызове
+    :param func: измеряемая функция
+    :param repeat: количество повторов для измерения времени
+    :return: словарь с временем в микросекундах и памятью в килобайтах
+    """
+    start: float = time.process_time()
+    for _ in range(repeat):
+        func()
+    cpu_us: float = (time.process_time() - start) / repeat * 1e6
+    tracemalloc.start()
+    func()
+    peak: int = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'cpu_us': cpu_us, 'peak_kb': peak / 1024}
+
+
+def bench_parse(hotels_payload: Optional[str], details_payload: Optional[str], repeat: int) -> Dict:
+    """Процессорное время и пиковая память на разбор ответов properties/list и get-details"""
+    from botrequests import parsing
+    from botrequests.bot_classes import Request
+
+    hotels_raw: bytes = open(hotels_payload, 'rb').read() if hotels_payload else sample_hotels_payload()
+    details_raw: bytes = open(details_payload, 'rb').read() if details_payload else sample_details_payload()
+    request = Request({'locale': 'en_US', 'id': '100000'})
+    return {
+        'backend': 'orjson' if parsing.orjson is not None else 'json',
+        'hotels_kb': len(hotels_raw) / 1024,
+        'details_kb': len(details_raw) / 1024,
+        'hotels_legacy': measure(lambda: legacy_hotels(hotels_raw), repeat),
+        'hotels_new': measure(lambda: request.parse_hotels(request.decode_response('', 200, hotels_raw)), repeat),
+        'details_legacy': measure(lambda: legacy_details(details_raw), repeat),
+        'details_new': measure(lambda: request.parse_hotel_info(request.decode_response('', 200, details_raw)),
+                               repeat),
+    }
+
+
+def legacy_hotel_keys(data: Dict) -> List[Tuple]:
+    """Сборка кнопок отелей f-строкой по словарю ответа, как до введения модуля renderer"""
+    return [(f"{hotel.get('name')} {'⭐️' * int(hotel.get('starRating', 0))}  "
+             f"{hotel.get('address').get('streetAddress')}. "
+             f"{str(hotel.get('ratePlan').get('price').get('current')).lower()} "
+             f"{hotel.get('landmarks')[0].get('distance').split(sep=' ')[0]} до центра",
+             str(hotel.get('id')) + '.hotel_id')
+            for hotel in data['data']['body']['searchResults']['results']]
+
+
+def legacy_hotel_text(data: Dict, hotel_id: str, locale: str) -> str:
+    """Сборка сообщения об отеле конкатенацией по словарю ответа, как до введения модуля renderer"""
+    description: Dict = data.get('data').get('body').get('propertyDescription')
+    coordinates: Dict = data.get('data').get('body').get('pdpHeader').get('hotelLocation').get('coordinates')
+    short_path = data.get('data').get('body').get('overview').get('overviewSections')
+    header_overview = [section.get('title') for section in short_path if section.get('type') == 'HOTEL_FEATURE']
+    this_overview = [section.get('content') for section in short_path if section.get('type') == 'HOTEL_FEATURE']
+    header_around = [section.get('title') for section in short_path if section.get('type') == 'LOCATION_SECTION']
+    this_around = [section.get('content') for section in short_path if section.get('type') == 'LOCATION_SECTION']
+    this_price = str(description.get('featuredPrice').get('currentPrice').get('formatted')) + ' ' + \
+        str(description.get('featuredPrice').get('priceInfo', ''))
+    box = {'en_US': '', 'ru_RU': 'ru.'}[locale]
+
+    hotel_info = ''
+    hotel_info += description.get('name') + '\n\n'
+    hotel_info += f"Адрес отеля: {description.get('address').get('fullAddress')}\n"
+    hotel_info += description.get('mapWidget').get('staticMapUrl', '') + '\n'
+    hotel_info += f"Координаты отеля: {coordinates.get('latitude')}, {coordinates.get('longitude')}\n\n"
+    hotel_info += '\n'.join(header_overview) + '\n\n'
+    hotel_info += '\n'.join(*this_overview)
+    hotel_info += '\n\n'
+    hotel_info += '\n'.join(header_around) + '\n\n'
+    hotel_info += '\n'.join(*this_around)
+    hotel_info += '\n\n'
+    hotel_info += this_price + '\n\n'
+    hotel_info += f'Ссылка на страницу отеля на сайте hotels.com: https://www.{box}hotels.com/ho{hotel_id}\n'
+    return hotel_info
+
+
+def retained(func: Callable[[], Any]) -> int:
+    """Возвращает объем памяти в байтах, который удерживает результат вызова"""
+    tracemalloc.start()
+    result = func()
+    size: int = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_render(hotels_payload: Optional[str], details_payload: Optional[str], repeat: int) -> Dict:
+    """Время сборки кнопок и сообщений и память на один результат поиска: словари ответа против записей"""
+    from botrequests import parsing, renderer
+
+    hotels_raw: bytes = open(hotels_payload, 'rb').read() if hotels_payload else sample_hotels_payload()
+    details_raw: bytes = open(details_payload, 'rb').read() if details_payload else sample_details_payload()
+    hotels_data: Dict = parsing.loads(hotels_raw)
+    details_data: Dict = parsing.loads(details_raw)
+    hotels: List = parsing.parse_hotels(hotels_data)
+    details = parsing.parse_hotel_details(details_data)
+    renderer.templates('en_US')
+    return {
+        'hotels': len(hotels),
+        'keys_legacy': measure(lambda: legacy_hotel_keys(hotels_data), repeat),
+        'keys_new': measure(lambda: renderer.hotel_keys(hotels, 'en_US'), repeat),
+        'text_legacy': measure(lambda: legacy_hotel_text(details_data, '100000', 'en_US'), repeat),
+        'text_new': measure(lambda: renderer.hotel_text(details, '100000', 'en_US'), repeat),
+        'result_legacy_bytes': retained(lambda: parsing.loads(hotels_raw)['data']['body']['searchResults']['results'])
+        / len(hotels),
+        'result_new_bytes': retained(lambda: parsing.parse_hotels(parsing.loads(hotels_raw))) / len(hotels),
+    }
+
+
+class ParsingBot:
+    """Класс, заменяющий бота в процессе-обработчике: на каждое обновление разбирает ответ API и собирает кнопки"""
+
+    def __init__(self):
+        from botrequests import renderer
+
+        self.payload: bytes = sample_hotels_payload()
+        renderer.templates('en_US')
+
+    def process_new_updates(self, updates: List) -> None:
+        from botrequests import parsing, renderer
+
+        for _ in updates:
+            renderer.hotel_keys(parsing.parse_hotels(parsing.loads(self.payload)), 'en_US')
+
+
+def bench_shard_worker(shard: int, processes: int, updates, ready) -> None:
+    """Процесс-обработчик бенчмарка shards"""
+    from botrequests.shard import serve_shard
+
+    serve_shard(ParsingBot(), updates, ready)
+
+
+def bench_shards(processes: int, updates: int, batch: int = 100) -> Dict:
+    """Пропускная способность разбора ответов и сборки кнопок при распределении обновлений по процессам"""
+    from botrequests.shard import ShardRouter
+
+    router = ShardRouter(bench_shard_worker, processes)
+    router.start()
+    raw: List[Dict] = [{'update_id': num + 1, 'message': {'message_id': num, 'date': 0, 'text': 'Moscow',
+                                                          'chat': {'id': num, 'type': 'private'},
+                                                          'from': {'id': num, 'is_bot': False, 'first_name': 'A'}}}
+                       for num in range(updates)]
+    start: float = time.perf_counter()
+    for offset in range(0, updates, batch):
+        router.process_raw_updates(raw[offset:offset + batch])
+    router.stop()
+    elapsed: float = time.perf_counter() - start
+    return {'processes': processes, 'seconds': elapsed, 'updates_per_s': updates / elapsed}
+
+
+def bench_hotels(hotels: int, cities: int, queries: int, page_size: int = 25) -> Dict:
+    """
+    Построение индекса отелей по страницам результатов поиска, запись в базу, загрузка города из базы
+    и подсчет отелей не дальше заданного расстояния от центра
+    """
+    from botrequests import hotel_index as hotel_index_module
+    from botrequests.bot_classes import HotelLocation
+    from botrequests.records import HotelSummary
+
+    temporary_database()
+    rng = random.Random(1)
+    centers: List[Tuple[float, float]] = [(rng.uniform(-60, 60), rng.uniform(-180, 180)) for _ in range(cities)]
+    pages: List[Tuple[str, List[HotelSummary]]] = []
+    for start in range(0, hotels, page_size):
+        city: int = start // page_size % cities
+        latitude, longitude = centers[city]
+        page: List[HotelSummary] = []
+        for num in range(start, min(start + page_size, hotels)):
+            distance: float = rng.expovariate(1 / 5)
+            page.append(HotelSummary(str(num), f'Hotel {num}', num % 6, 'Main street', '$50', 50.0, f'{distance:.1f} km',
+                                     distance, latitude + rng.uniform(-0.1, 0.1), longitude + rng.uniform(-0.1, 0.1)))
+        pages.append((str(city), page))
+
+    index = hotel_index_module.HotelIndex(HotelLocation, db)
+    start_time: float = time.perf_counter()
+    for city_id, page in pages:
+        index.add(city_id, page)
+    add_s: float = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    index.flush()
+    flush_s: float = time.perf_counter() - start_time
+
+    cold = hotel_index_module.HotelIndex(HotelLocation, db)
+    start_time = time.perf_counter()
+    cold.within('0', 1.0)
+    load_s: float = time.perf_counter() - start_time
+
+    points: List[Tuple[str, float]] = [(str(num % cities), rng.uniform(0.5, 2)) for num in range(queries)]
+    start_time = time.perf_counter()
+    for city_id, distance in points:
+        index.within(city_id, distance)
+    within_us: float = (time.perf_counter() - start_time) / queries * 1e6
+    return {'backend': 'numpy' if hotel_index_module.numpy is not None else 'python', 'hotels': hotels,
+            'cities': cities, 'add_per_s': hotels / add_s, 'flush_s': flush_s, 'load_s': load_s,
+            'within_us': within_us}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+    collect = subparsers.add_parser('collect', help='запросы к базе при сборке запроса к API')
+    collect.add_argument('--chats', type=int, default=1000)
+    parse = subparsers.add_parser('parse', help='разбор ответов API')
+    parse.add_argument('--hotels-payload', help='записанный ответ properties/list')
+    parse.add_argument('--details-payload', help='записанный ответ properties/get-details')
+    parse.add_argument('--repeat', type=int, default=200)
+    render = subparsers.add_parser('render', help='сборка сообщений и кнопок из результатов поиска')
+    render.add_argument('--hotels-payload', help='записанный ответ properties/list')
+    render.add_argument('--details-payload', help='записанный ответ properties/get-details')
+    render.add_argument('--repeat', type=int, default=2000)
+    shards = subparsers.add_parser('shards', help='обработка обновлений в нескольких процессах')
+    shards.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    shards.add_argument('--updates', type=int, default=2000)
+    hotels = subparsers.add_parser('hotels', help='пространственный индекс отелей')
+    hotels.add_argument('--hotels', type=int, default=100000)
+    hotels.add_argument('--cities', type=int, default=20)
+    hotels.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    from loguru import logger
+    logger.remove()
+
+    if args.bench == 'collect':
+        result = bench_collect(args.chats)
+        print(f"collect_request ({result['columns']} колонок), sql-запросов на шаг: "
+              f"до изменений {result['queries_before']:.1f} ({result['us_before']:.0f} мкс), "
+              f"холодный кэш {result['queries_cold']:.1f} ({result['us_cold']:.0f} мкс), "
+              f"теплый кэш {result['queries_warm']:.1f} ({result['us_warm']:.0f} мкс)")
+    elif args.bench == 'parse':
+        result = bench_parse(args.hotels_payload, args.details_payload, args.repeat)
+        print(f"json backend: {result['backend']}")
+        for name, size in (('hotels', result['hotels_kb']), ('details', result['details_kb'])):
+            for variant in ('legacy', 'new'):
+                measured: Dict = result[f'{name}_{variant}']
+                print(f"{name} ({size:.0f} КБ), {variant}: {measured['cpu_us']:.0f} мкс CPU, "
+                      f"пик памяти {measured['peak_kb']:.0f} КБ")
+    elif args.bench == 'render':
+        result = bench_render(args.hotels_payload, args.details_payload, args.repeat)
+        for name, title in (('keys', f"кнопки {result['hotels']} отелей"), ('text', 'сообщение об отеле')):
+            for variant in ('legacy', 'new'):
+                measured: Dict = result[f'{name}_{variant}']
+                print(f"{title}, {variant}: {measured['cpu_us']:.1f} мкс CPU, пик памяти {measured['peak_kb']:.1f} КБ")
+        print(f"память на один отель: словарь ответа {result['result_legacy_bytes']:.0f} Б, "
+              f"HotelSummary {result['result_new_bytes']:.0f} Б")
+    elif args.bench == 'shards':
+        print(f'ядер процессора: {os.cpu_count()}')
+        for processes in args.processes:
+            result = bench_shards(processes, args.updates)
+            print(f"процессов {result['processes']}: {result['updates_per_s']:.0f} обновлений/с "
+                  f"({result['seconds']:.2f} с)")
+    elif args.bench == 'hotels':
+        result = bench_hotels(args.hotels, args.cities, args.queries)
+        print(f"подсчет отелей: {result['backend']}")
+        print(f"отелей {result['hotels']} в {result['cities']} городах: добавление {result['add_per_s']:.0f} отелей/с, "
+              f"запись в базу {result['flush_s']:.2f} с, загрузка города из базы {result['load_s'] * 1000:.1f} мс")
+        print(f"отелей не дальше расстояния от центра: {result['within_us']:.0f} мкс на запрос")
+
+
+if __name__ == '__main__':
+    main()
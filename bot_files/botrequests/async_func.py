@@ -0,0 +1,211 @@
+import asyncio
+import time
+from typing import Callable, Dict, List, Optional, Union
+
+from loguru import logger
+from telebot.types import CallbackQuery, InlineKeyboardMarkup, InputMediaPhoto, Message
+
+from botrequests.bestdeal import BESTDEAL_SORT_ORDER
+from botrequests.bot_classes import API_KEYS, Request
+from botrequests.bot_func import PHOTO_QUESTION, RESULTS_EXPIRED, RESULTS_FETCH_SIZE, SEARCH_PROGRESS, add_new_save, \
+    album_photos, best_deal, city_reply, city_request, collect_request, dates_reply, flex_results, history_page, \
+    history_reply, hotel_info_reply, hotel_info_request, hotels_reply, hotels_request, log_album, max_distance_reply, \
+    number_guests_reply, number_hotels_reply, number_photos_reply, photo_albums, price_range_reply, record_history, \
+    remember_photos, results_page_markup, results_request
+from botrequests.conversation import Conversation, Reply, set_step
+from botrequests.fanout import FLEX_SORT_ORDER, FanOutSearch, date_variants
+from botrequests.history import history_log
+from botrequests.metrics import metrics
+from botrequests.records import HotelDetails, HotelSummary
+from botrequests.session_store import session_store
+
+
+async def load_session(message: Message) -> None:
+    """Загружает текущий запрос пользователя в память, не блокируя цикл событий"""
+    await asyncio.to_thread(session_store.load, message.chat.id)
+
+
+async def expects_input(message: Message) -> bool:
+    """
+    Асинхронный вариант conversation.expects: текущий запрос чата, которого нет в памяти, загружается
+    из базы в отдельном потоке, поэтому проверка не блокирует цикл событий
+    """
+    if not conversation.is_input(message):
+        return False
+    try:
+        await load_session(message)
+    except KeyError:
+        return False
+    return conversation.expects(message)
+
+
+async def new_session(message: Message, sort_order: str) -> None:
+    """Создает начальную запись текущего запроса пользователя, не блокируя цикл событий"""
+    await asyncio.to_thread(add_new_save, message, sort_order)
+
+
+async def reply(message: Message, bot, answer: Reply) -> None:
+    """Асинхронный вариант bot_func.reply"""
+    if answer.text is not None:
+        await bot.send_message(message.chat.id, answer.text, reply_markup=answer.markup)
+    if answer.step is not None:
+        set_step(message, answer.step)
+    if answer.follow is not None:
+        await follow_ups[answer.follow](message, bot)
+
+
+async def search_city(message: Message, bot) -> None:
+    """
+    Асинхронный вариант bot_func.search_city: ищет город по названию и создает inline клавиатуру
+    с вариантами городов, либо повторно запрашивает название
+    :param bot: асинхронный бот
+    :param message: Полученное в чате сообщение
+    """
+    await load_session(message)
+    request_queue: Dict = city_request(message)
+    await reply(message, bot, city_reply(message, *await object_search(search_city.__name__, request_queue, message)))
+
+
+async def number_hotels(message: Message, bot) -> None:
+    """Асинхронный вариант bot_func.number_hotels"""
+    await load_session(message)
+    await reply(message, bot, number_hotels_reply(message))
+
+
+async def number_guests(message: Message, bot) -> None:
+    """Асинхронный вариант bot_func.number_guests"""
+    await load_session(message)
+    await reply(message, bot, number_guests_reply(message))
+
+
+async def price_range(message: Message, bot) -> None:
+    """Асинхронный вариант bot_func.price_range"""
+    await load_session(message)
+    await reply(message, bot, price_range_reply(message))
+
+
+async def max_distance(message: Message, bot) -> None:
+    """Асинхронный вариант bot_func.max_distance"""
+    await load_session(message)
+    await reply(message, bot, max_distance_reply(message))
+
+
+async def check_dates(message: Message, bot) -> None:
+    """Формирует календарь для ввода дат заезда-выезда"""
+    await reply(message, bot, dates_reply(message))
+
+
+async def search_hotels(message: Message, bot) -> None:
+    """
+    Асинхронный вариант bot_func.search_hotels. Индекс отелей для /bestdeal и журнал поисков
+    читаются из базы в отдельном потоке
+    """
+    request_queue: Dict = hotels_request(message)
+    await bot.send_message(message.chat.id, SEARCH_PROGRESS)
+    if request_queue[API_KEYS['sort_order']] == FLEX_SORT_ORDER:
+        hotels: List = await flex_search(message, request_queue, bot)
+    elif request_queue[API_KEYS['sort_order']] == BESTDEAL_SORT_ORDER:
+        hotels: List = await (await asyncio.to_thread(best_deal, message, request_queue)).asearch()
+    else:
+        hotels: List = await object_search(search_hotels.__name__, results_request(request_queue), message)
+    await reply(message, bot, hotels_reply(message, request_queue, hotels))
+    await asyncio.to_thread(record_history, message, hotels[:int(request_queue[API_KEYS['number_hotels']])])
+    await asyncio.to_thread(session_store.flush, message.chat.id)
+
+
+async def flex_search(message: Message, request_queue: Dict, bot) -> List[HotelSummary]:
+    """Асинхронный вариант bot_func.flex_search"""
+    page_size: int = int(request_queue[API_KEYS['number_hotels']])
+    fan_out = FanOutSearch(date_variants(results_request(request_queue)), RESULTS_FETCH_SIZE)
+    sent: Optional[Message] = None
+    hotels: List[HotelSummary] = []
+    async for top in fan_out.asearch():
+        if not top:
+            continue
+        text, markup, hotels = flex_results(message, fan_out, top, page_size, request_queue['locale'])
+        if sent is None:
+            sent = await bot.send_message(message.chat.id, text, reply_markup=markup)
+        else:
+            await bot.edit_message_text(text, message.chat.id, sent.message_id, reply_markup=markup)
+    return hotels
+
+
+async def turn_results_page(call: CallbackQuery, bot) -> None:
+    """Асинхронный вариант bot_func.turn_results_page"""
+    markup: Optional[InlineKeyboardMarkup] = results_page_markup(call.data)
+    if markup is None:
+        await bot.edit_message_text(RESULTS_EXPIRED, call.message.chat.id, call.message.message_id)
+    else:
+        await bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+
+async def show_history(message: Message, bot) -> None:
+    """Асинхронный вариант bot_func.show_history"""
+    entries, has_older = await asyncio.to_thread(history_log.page, message.chat.id)
+    logger.info(f'message {message.chat.id}: Отправлена страница истории из {len(entries)} записей')
+    await reply(message, bot, history_reply(entries, False, has_older))
+
+
+async def turn_history_page(call: CallbackQuery, bot) -> None:
+    """Асинхронный вариант bot_func.turn_history_page"""
+    direction, cursor = call.data.split('.')[0].split('_')
+    answer: Reply = history_reply(*await asyncio.to_thread(history_page, call.message.chat.id, direction, cursor))
+    await bot.edit_message_text(answer.text, call.message.chat.id, call.message.message_id,
+                                reply_markup=answer.markup)
+
+
+async def object_search(func_name: str, request_queue: Dict, message: Message) -> Union[List, Optional[HotelDetails]]:
+    """Асинхронный вариант bot_func.object_search"""
+    searched_objects = Request(request_queue)
+    way_search: Dict = {'search_hotels': searched_objects.aget_hotels,
+                        'search_city': searched_objects.aget_city,
+                        'search_hotel_info': searched_objects.aget_hotel_info,
+                        'search_hotel_photos': searched_objects.aget_hotel_pics}
+    with metrics.span('object_search', search=func_name):
+        objects: Union[List, Optional[HotelDetails]] = await way_search[func_name]()
+    logger.info(f'message {message.from_user.id}: Запрос от {func_name} отработан')
+    return objects
+
+
+async def search_hotel_info(message: Message, bot) -> None:
+    """Асинхронный вариант bot_func.search_hotel_info"""
+    await load_session(message)
+    request_queue: Dict = hotel_info_request(message)
+    hotel_info: Optional[HotelDetails] = await object_search(search_hotel_info.__name__, request_queue, message)
+    await reply(message, bot, hotel_info_reply(message, request_queue, hotel_info))
+
+
+async def check_photo(message: Message, bot) -> None:
+    """Создает inline клавиатуру с вопросом о необходимости вывода фотографий отеля"""
+    await reply(message, bot, PHOTO_QUESTION)
+
+
+async def number_photos(message: Message, bot) -> None:
+    """Асинхронный вариант bot_func.number_photos"""
+    await load_session(message)
+    await reply(message, bot, number_photos_reply(message))
+
+
+async def search_hotel_photos(message: Message, bot) -> None:
+    """Асинхронный вариант bot_func.search_hotel_photos"""
+    request_queue: Dict = collect_request(message, 'hotel_id')
+    answer, albums = photo_albums(message, await object_search(search_hotel_photos.__name__, request_queue, message))
+    await reply(message, bot, answer)
+    for album in albums:
+        started: float = time.perf_counter()
+        photos: List = await asyncio.to_thread(album_photos, album)
+        if len(photos) == 1:
+            sent: List = [await bot.send_photo(message.chat.id, photos[0])]
+        else:
+            sent: List = await bot.send_media_group(message.chat.id, [InputMediaPhoto(photo) for photo in photos])
+        await asyncio.to_thread(remember_photos, album, photos, sent)
+        log_album(message, album, started)
+    logger.info(f'message {message.from_user.id}: {sum(map(len, albums))} фотографий отправлено пользователю')
+
+
+follow_ups: Dict[str, Callable] = {'check_dates': check_dates, 'search_hotel_info': search_hotel_info,
+                                   'search_hotel_photos': search_hotel_photos}
+conversation = Conversation({'search_city': search_city, 'number_hotels': number_hotels,
+                             'number_guests': number_guests, 'price_range': price_range,
+                             'max_distance': max_distance, 'dates': check_dates, 'photos': check_photo,
+                             'number_photos': number_photos})
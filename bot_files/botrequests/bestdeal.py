@@ -0,0 +1,154 @@
+import asyncio
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Iterator, List
+
+from loguru import logger
+
+from botrequests.bot_classes import API_KEYS, Request, hotel_index
+from botrequests.records import HotelSummary
+
+BESTDEAL_SORT_ORDER: str = 'DISTANCE_FROM_LANDMARK'
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BESTDEAL_WORKERS', 4)), thread_name_prefix='bestdeal')
+
+
+class BestDeal:
+    """
+    Класс, реализующий поиск /bestdeal: страницы properties/list загружаются лениво, отели фильтруются
+    по диапазону цен и расстоянию до центра по мере поступления страниц. Следующая страница загружается
+    одновременно с фильтрацией текущей. Поиск останавливается, как только найдено нужное количество отелей,
+    исчерпан бюджет страниц или (при сортировке по расстоянию) отели стали дальше заданного расстояния.
+    При сортировке по расстоянию первые страницы загружаются одновременно: индекс отелей города дает
+    нижнюю оценку количества страниц, которые поиск загрузит в любом случае
+    """
+
+    def __init__(self, query: Dict, number_hotels: int, price_start: float, price_stop: float, distance: float,
+                 max_pages: int = int(os.getenv('BESTDEAL_MAX_PAGES', 5)),
+                 page_size: int = int(os.getenv('BESTDEAL_PAGE_SIZE', 25))):
+        """
+        первичная инициализация класса
+        :param query: запрос properties/list (как в search_hotels)
+        :param number_hotels: сколько отелей нужно найти
+        :param price_start: минимальная цена
+        :param price_stop: максимальная цена
+        :param distance: максимальное расстояние до центра в километрах
+        :param max_pages: бюджет страниц на один поиск
+        :param page_size: количество отелей на странице
+        """
+        self.query: Dict = query
+        self.number_hotels: int = number_hotels
+        self.price_start: float = price_start
+        self.price_stop: float = price_stop
+        self.distance: float = distance
+        self.max_pages: int = max_pages
+        self.page_size: int = page_size
+        self.sorted_by_distance: bool = query.get(API_KEYS['sort_order']) == BESTDEAL_SORT_ORDER
+        self.eager_pages: int = 1
+        if self.sorted_by_distance:
+            # поиск не остановится раньше, чем найдет number_hotels отелей или дойдет до дальних отелей
+            needed: int = min(-(-number_hotels // page_size),
+                              hotel_index.pages_within(query.get(API_KEYS['city_id'], ''), distance, page_size))
+            self.eager_pages = max(1, min(needed, max_pages))
+        self.pages_loaded: int = 0
+
+    def page_request(self, page_number: int) -> Request:
+        """Возвращает запрос одной страницы properties/list"""
+        return Request({**self.query, API_KEYS['page_number']: str(page_number),
+                        API_KEYS['number_hotels']: str(self.page_size)})
+
+    def page_range(self) -> range:
+        """Возвращает номера страниц в пределах бюджета"""
+        start_page: int = int(self.query.get(API_KEYS['page_number']) or 1)
+        return range(start_page, start_page + self.max_pages)
+
+    def pages(self) -> Iterator[List[HotelSummary]]:
+        """
+        Генератор страниц отелей. Первые eager_pages страниц загружаются одновременно, далее
+        пока вызывающий код обрабатывает страницу, следующая уже загружается
+        """
+        page_range: range = self.page_range()
+        futures: Dict[int, Future] = {page_number: _executor.submit(self.page_request(page_number).get_hotels)
+                                      for page_number in page_range[:self.eager_pages]}
+        try:
+            for page_number in page_range:
+                hotels: List[HotelSummary] = futures.pop(page_number).result()
+                self.pages_loaded += 1
+                last: bool = len(hotels) < self.page_size or page_number == page_range[-1]
+                if not last and page_number + 1 not in futures:
+                    futures[page_number + 1] = _executor.submit(self.page_request(page_number + 1).get_hotels)
+                yield hotels
+                if last:
+                    return
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+    async def apages(self) -> AsyncIterator[List[HotelSummary]]:
+        """Асинхронный вариант pages"""
+        page_range: range = self.page_range()
+        tasks: Dict[int, asyncio.Task] = {
+            page_number: asyncio.ensure_future(self.page_request(page_number).aget_hotels())
+            for page_number in page_range[:self.eager_pages]}
+        try:
+            for page_number in page_range:
+                hotels: List[HotelSummary] = await tasks.pop(page_number)
+                self.pages_loaded += 1
+                last: bool = len(hotels) < self.page_size or page_number == page_range[-1]
+                if not last and page_number + 1 not in tasks:
+                    tasks[page_number + 1] = asyncio.ensure_future(self.page_request(page_number + 1).aget_hotels())
+                yield hotels
+                if last:
+                    return
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+    def too_far(self, hotel: HotelSummary) -> bool:
+        """Возвращает True, если отель и все следующие за ним (при сортировке по расстоянию) дальше заданного"""
+        return self.sorted_by_distance and hotel.distance_value is not None and hotel.distance_value > self.distance
+
+    def matches(self, hotel: HotelSummary) -> bool:
+        """Проверяет, что цена отеля попадает в диапазон, а расстояние до центра не больше заданного"""
+        return (hotel.price_value is not None and self.price_start <= hotel.price_value <= self.price_stop
+                and hotel.distance_value is not None and hotel.distance_value <= self.distance)
+
+    def filter_page(self, hotels: List[HotelSummary], found: List[HotelSummary]) -> bool:
+        """
+        Добавляет в found подходящие отели страницы
+        :return: True, если поиск нужно остановить
+        """
+        for hotel in hotels:
+            if self.too_far(hotel):
+                return True
+            if self.matches(hotel):
+                found.append(hotel)
+                if len(found) >= self.number_hotels:
+                    return True
+        return False
+
+    def search(self) -> List[HotelSummary]:
+        """Возвращает не более number_hotels отелей, подходящих под фильтр"""
+        found: List[HotelSummary] = []
+        pages = self.pages()
+        for hotels in pages:
+            if self.filter_page(hotels, found):
+                pages.close()
+                break
+        self.log(found)
+        return found
+
+    async def asearch(self) -> List[HotelSummary]:
+        """Асинхронный вариант search"""
+        found: List[HotelSummary] = []
+        pages = self.apages()
+        async for hotels in pages:
+            if self.filter_page(hotels, found):
+                await pages.aclose()
+                break
+        self.log(found)
+        return found
+
+    def log(self, found: List[HotelSummary]) -> None:
+        logger.info(f'bestdeal: найдено {len(found)} из {self.number_hotels} отелей, '
+                    f'загружено страниц {self.pages_loaded} из {self.max_pages}')
@@ -1,17 +1,34 @@
+import asyncio
 import json
 import os
+import random
 import re
-from typing import List, Dict
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, List, Dict, Mapping, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from loguru import logger
-from peewee import *
+from peewee import CharField, CompositeKey, DateField, DateTimeField, FloatField, IntegerField, Model, \
+    PrimaryKeyField, SqliteDatabase, TextField
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+from botrequests import parsing
+from botrequests.city_index import city_index
+from botrequests.hotel_index import HotelIndex
+from botrequests.metrics import metrics
+from botrequests.ratelimit import ApiLimiter, MonthlyQuota, TokenBucket
+from botrequests.records import City, HotelDetails, HotelSummary
+from botrequests.state import create_backend
+
 load_dotenv()
 
-db = SqliteDatabase('botrequests/sqlite_bot.db')
+db = SqliteDatabase(os.getenv('DB_PATH', 'botrequests/sqlite_bot.db'), timeout=float(os.getenv('DB_TIMEOUT', 10)),
+                    pragmas={'synchronous': 'normal'})
 
 
 class BaseModel(Model):
@@ -39,19 +56,240 @@ class Session(BaseModel):
     price_start = FloatField()
     price_stop = FloatField()
     distance = FloatField()
+    step = CharField(default='')
+    created_at = DateTimeField(default=datetime.now)
 
     class Meta:
         db_table = 'sessions'
         order_by = 'id'
+        indexes = ((('chat_id', 'id'), False),)
+
+
+API_KEYS: Dict[str, str] = {'chat_id': 'chat.id', 'sort_order': 'sortOrder', 'query': 'query',
+                             'city_id': 'destinationId', 'locale': 'locale', 'currency': 'currency',
+                             'number_hotels': 'pageSize', 'number_persons': 'adults1', 'page_number': 'pageNumber',
+                             'check_in': 'checkIn', 'check_out': 'checkOut', 'hotel_id': 'id', 'hotel_pics': 'pics',
+                             'price_start': 'price_start', 'price_stop': 'price_stop', 'distance': 'distance'}
 
 
 class HistoryQuery(BaseModel):
-    """Класс, реализующий таблицу HistoryQuery"""
+    """
+    Класс, реализующий таблицу HistoryQuery: журнал завершенных поисков.
+    saved_query содержит json с командой, городом, датами и показанными отелями
+    """
     chat_id = CharField()
-    saved_query = CharField()
+    saved_query = TextField()
+    created_at = DateTimeField(default=datetime.now)
 
     class Meta:
         db_table = 'history_queries'
+        indexes = ((('chat_id', 'created_at'), False),)
+
+
+class CachedValue(BaseModel):
+    """Класс, реализующий таблицу CachedValue для сохранения кэшей между перезапусками бота"""
+    cache_name = CharField()
+    key = CharField()
+    value = TextField()
+    expires_at = FloatField()
+
+    class Meta:
+        db_table = 'cached_values'
+        primary_key = CompositeKey('cache_name', 'key')
+
+
+class HotelLocation(BaseModel):
+    """Класс, реализующий таблицу HotelLocation: координаты и расстояние до центра отелей из результатов поиска"""
+    hotel_id = CharField(primary_key=True)
+    city_id = CharField(index=True)
+    name = CharField()
+    star_rating = IntegerField()
+    latitude = FloatField()
+    longitude = FloatField()
+    distance = FloatField(null=True)
+
+    class Meta:
+        db_table = 'hotel_locations'
+
+
+cache_backend = create_backend(os.getenv('CACHE_BACKEND', 'sqlite'), CachedValue, db)
+hotel_index = HotelIndex(HotelLocation, db)
+
+
+class TTLCache:
+    """
+    Класс, реализующий ограниченный по размеру LRU кэш с временем жизни записей.
+    При persistent=True записи дополнительно сохраняются в хранилище cache_backend (таблицу CachedValue
+    или key-value сервер, настройка CACHE_BACKEND), общее для всех процессов бота.
+    Значения должны сериализоваться в json
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, persistent: bool = False):
+        """
+        первичная инициализация класса
+        :param name: название кэша
+        :param maxsize: максимальное количество записей в памяти
+        :param ttl: время жизни записи в секундах
+        :param persistent: сохранять ли записи в базе
+        """
+        self.name: str = name
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.persistent: bool = persistent
+        self.hits: int = 0
+        self.misses: int = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, key: Any) -> Optional[Any]:
+        """Получает не устаревшую запись из хранилища сохраняемых кэшей"""
+        item = cache_backend.get(self.name, json.dumps(key))
+        if item is None:
+            return None
+        value = json.loads(item[0])
+        with self._lock:
+            self._put(key, value, item[1])
+        return value
+
+    def _put(self, key: Any, value: Any, expires_at: float) -> None:
+        """Добавляет запись в память, вытесняя самые давно использованные"""
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: Any) -> Optional[Any]:
+        """
+        Возвращает значение по ключу
+        :param key: ключ
+        :return: значение, либо None, если записи нет или она устарела
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] <= time.time():
+                del self._data[key]
+                item = None
+            if item is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+        value = self._load(key) if self.persistent else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: Any, value: Any) -> None:
+        """
+        Сохраняет значение по ключу
+        :param key: ключ
+        :param value: значение
+        """
+        expires_at: float = time.time() + self.ttl
+        with self._lock:
+            self._put(key, value, expires_at)
+        if self.persistent:
+            cache_backend.set(self.name, json.dumps(key), json.dumps(value), expires_at)
+
+    def __contains__(self, key: Any) -> bool:
+        """Проверяет наличие не устаревшей записи, не изменяя счетчики попаданий и порядок вытеснения"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.time():
+                return True
+        return self.persistent and cache_backend.get(self.name, json.dumps(key)) is not None
+
+    def stats(self) -> Dict[str, int]:
+        """Возвращает количество попаданий, промахов и записей в памяти"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class SingleFlight:
+    """
+    Класс, объединяющий одновременные одинаковые вызовы: функция для ключа выполняется один раз,
+    остальные вызывающие потоки ожидают и получают тот же результат
+    """
+
+    def __init__(self):
+        """первичная инициализация класса"""
+        self._calls: Dict[Any, Dict] = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, func: Callable[[], Any]) -> Any:
+        """
+        Выполняет func для ключа key, если для него нет выполняющегося вызова, иначе ожидает его результата
+        :param key: ключ вызова
+        :param func: вызываемая функция
+        :return: результат функции
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = func()
+        except Exception as err:
+            call['error'] = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+        return call['result']
+
+
+class AsyncSingleFlight:
+    """Асинхронный вариант SingleFlight: одновременные одинаковые корутины выполняются один раз"""
+
+    def __init__(self):
+        """первичная инициализация класса"""
+        self._calls: Dict[Any, asyncio.Future] = dict()
+
+    async def do(self, key: Any, func: Callable[[], Any]) -> Any:
+        """
+        Выполняет корутину func() для ключа key, если для него нет выполняющегося вызова, иначе ожидает его результата
+        :param key: ключ вызова
+        :param func: функция, возвращающая корутину
+        :return: результат корутины
+        """
+        call = self._calls.get(key)
+        if call is not None:
+            return await asyncio.shield(call)
+        call = asyncio.ensure_future(func())
+        self._calls[key] = call
+        call.add_done_callback(lambda done: self._calls.pop(key, None))
+        return await asyncio.shield(call)
+
+
+def normalize_query(query: Dict) -> str:
+    """Возвращает ключ кэша для запроса к API, не зависящий от порядка и типов параметров"""
+    return json.dumps({key: str(value) for key, value in query.items()}, sort_keys=True)
+
+
+city_cache = TTLCache('cities', int(os.getenv('CITY_CACHE_SIZE', 1000)), float(os.getenv('CITY_CACHE_TTL', 86400)),
+                      persistent=os.getenv('CITY_CACHE_PERSIST', '1') == '1')
+hotels_cache = TTLCache('hotels', int(os.getenv('HOTELS_CACHE_SIZE', 500)), float(os.getenv('HOTELS_CACHE_TTL', 300)))
+hotels_flight = SingleFlight()
+details_cache = TTLCache('details', int(os.getenv('DETAILS_CACHE_SIZE', 500)),
+                         float(os.getenv('DETAILS_CACHE_TTL', 600)))
+details_flight = SingleFlight()
+async_details_flight = AsyncSingleFlight()
+photo_cache = TTLCache('photo', int(os.getenv('PHOTO_CACHE_SIZE', 5000)), float(os.getenv('PHOTO_CACHE_TTL', 2592000)),
+                       persistent=True)
+async_hotels_flight = AsyncSingleFlight()
+results_cache = TTLCache('results', int(os.getenv('RESULTS_CACHE_SIZE', 1000)), float(os.getenv('RESULTS_CACHE_TTL', 3600)))
+for cache in (city_cache, hotels_cache, details_cache, photo_cache, results_cache):
+    metrics.register_gauges(f'cache_{cache.name}', cache.stats)
 
 
 class InlineKeyboard:
@@ -104,17 +342,192 @@ class InlineKeyboard:
         :return: клавиатура
         """
         bot_keyboard = InlineKeyboardMarkup(row_width=self.rows)
-        for every_key in self.keys:
-            self.key_list.append(InlineKeyboardButton(every_key[0], callback_data=every_key[1]))
+        self.key_list = [InlineKeyboardButton(every_key[0], callback_data=every_key[1]) for every_key in self.keys]
         for all_keys in self.key_list:
             bot_keyboard.add(all_keys)
         return bot_keyboard
 
 
+class ApiClient:
+    """
+    Класс, реализующий общий для всех запросов пул http-соединений с keep-alive,
+    таймаутами и повторными попытками с экспоненциальной задержкой для ответов 429 и 5xx.
+    Перед каждой попыткой запрос проходит через ограничитель частоты и месячной квоты
+    """
+    retry_statuses = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, pool_size: int = int(os.getenv('RAPIDAPI_POOL_SIZE', 10)),
+                 connect_timeout: float = float(os.getenv('RAPIDAPI_CONNECT_TIMEOUT', 3.05)),
+                 read_timeout: float = float(os.getenv('RAPIDAPI_READ_TIMEOUT', 15)),
+                 retries: int = int(os.getenv('RAPIDAPI_RETRIES', 3)),
+                 backoff: float = float(os.getenv('RAPIDAPI_BACKOFF', 0.5)),
+                 limiter: Optional[ApiLimiter] = None):
+        """
+        первичная инициализация класса
+        :param pool_size: максимальное количество соединений с одним хостом
+        :param connect_timeout: таймаут установки соединения в секундах
+        :param read_timeout: таймаут чтения ответа в секундах
+        :param retries: количество повторных попыток
+        :param backoff: базовая задержка между попытками в секундах
+        :param limiter: ограничитель частоты запросов и месячной квоты
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.limiter: Optional[ApiLimiter] = limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def delay(self, attempt: int, headers: Optional[Mapping] = None) -> float:
+        """
+        Возвращает задержку перед следующей попыткой: значение заголовка Retry-After,
+        если он есть, иначе экспоненциальная задержка со случайной добавкой
+        :param attempt: номер попытки, начиная с 0
+        :param headers: заголовки ответа, полученного на предыдущей попытке
+        """
+        retry_after = headers.get('Retry-After', '') if headers is not None else ''
+        if retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+
+    def reserve(self, url: str) -> Optional[float]:
+        """
+        Занимает место для запроса в ограничителе
+        :param url: url, по которому производится запрос
+        :return: время ожидания перед запросом в секундах, либо None, если месячная квота исчерпана
+        """
+        if self.limiter is None:
+            return 0.0
+        delay: Optional[float] = self.limiter.reserve()
+        if delay is None:
+            logger.info(f'Месячная квота запросов исчерпана, запрос к {url} не выполнен')
+        return delay
+
+    def get(self, url: str, headers: Dict, params: Dict) -> Optional[requests.Response]:
+        """
+        Выполняет GET запрос с повторными попытками
+        :param url: url, по которому производится запрос
+        :param headers: заголовки запроса
+        :param params: параметры запроса
+        :return: ответ, либо None, если ответ не получен за все попытки
+        """
+        response = None
+        for attempt in range(self.retries + 1):
+            delay: Optional[float] = self.reserve(url)
+            if delay is None:
+                return response
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                response = self.session.get(url, headers=headers, params=params, timeout=self.timeout)
+                if self.limiter is not None:
+                    self.limiter.record_status(response.status_code)
+                if response.status_code not in self.retry_statuses:
+                    return response
+                logger.info(f'Ответ {response.status_code} от {url}, попытка {attempt + 1}')
+            except (requests.ConnectionError, requests.Timeout) as err:
+                response = None
+                logger.info(f'Ошибка соединения с {url}, попытка {attempt + 1}: {err}')
+            if attempt < self.retries:
+                time.sleep(self.delay(attempt, response.headers if response is not None else None))
+        return response
+
+
+class AsyncApiClient(ApiClient):
+    """
+    Класс, реализующий асинхронный (aiohttp) пул http-соединений с теми же настройками таймаутов
+    и повторных попыток, что и ApiClient. Сессия aiohttp создается при первом запросе
+    """
+
+    def __init__(self, pool_size: int = int(os.getenv('RAPIDAPI_POOL_SIZE', 10)),
+                 connect_timeout: float = float(os.getenv('RAPIDAPI_CONNECT_TIMEOUT', 3.05)),
+                 read_timeout: float = float(os.getenv('RAPIDAPI_READ_TIMEOUT', 15)),
+                 retries: int = int(os.getenv('RAPIDAPI_RETRIES', 3)),
+                 backoff: float = float(os.getenv('RAPIDAPI_BACKOFF', 0.5)),
+                 limiter: Optional[ApiLimiter] = None):
+        """
+        первичная инициализация класса
+        :param pool_size: максимальное количество соединений с одним хостом
+        :param connect_timeout: таймаут установки соединения в секундах
+        :param read_timeout: таймаут чтения ответа в секундах
+        :param retries: количество повторных попыток
+        :param backoff: базовая задержка между попытками в секундах
+        :param limiter: ограничитель частоты запросов и месячной квоты
+        """
+        self.pool_size: int = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.limiter: Optional[ApiLimiter] = limiter
+        self.session = None
+
+    async def get(self, url: str, headers: Dict, params: Dict) -> Optional[Tuple]:
+        """
+        Выполняет асинхронный GET запрос с повторными попытками
+        :param url: url, по которому производится запрос
+        :param headers: заголовки запроса
+        :param params: параметры запроса
+        :return: кортеж из кода и тела ответа в байтах, либо None, если ответ не получен за все попытки
+        """
+        import aiohttp
+
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+        headers = {key: value for key, value in headers.items() if value is not None}
+        params = {key: str(value) for key, value in params.items()}
+        result = None
+        for attempt in range(self.retries + 1):
+            # месячная квота читает и сохраняет счетчик в хранилище сохраняемых кэшей, поэтому не в цикле событий
+            delay: Optional[float] = await asyncio.to_thread(self.reserve, url)
+            if delay is None:
+                return result
+            if delay > 0:
+                await asyncio.sleep(delay)
+            response_headers = None
+            try:
+                async with self.session.get(url, headers=headers, params=params) as response:
+                    result = (response.status, await response.read())
+                    response_headers = response.headers
+                if self.limiter is not None:
+                    self.limiter.record_status(result[0])
+                if result[0] not in self.retry_statuses:
+                    return result
+                logger.info(f'Ответ {result[0]} от {url}, попытка {attempt + 1}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                result = None
+                logger.info(f'Ошибка соединения с {url}, попытка {attempt + 1}: {err}')
+            if attempt < self.retries:
+                await asyncio.sleep(self.delay(attempt, response_headers))
+        return result
+
+    async def close(self) -> None:
+        """Закрывает сессию aiohttp"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+rapidapi_limiter = ApiLimiter(TokenBucket(float(os.getenv('RAPIDAPI_RATE_LIMIT', 5)), float(os.getenv('RAPIDAPI_BURST', 5))),
+                              MonthlyQuota(int(os.getenv('RAPIDAPI_MONTHLY_QUOTA', 0)),
+                                           store=TTLCache('quota', 12, 40 * 86400, persistent=True)))
+metrics.register_gauges('rapidapi', rapidapi_limiter.stats)
+metrics.register_gauges('city_index', city_index.stats)
+metrics.register_gauges('hotel_index', hotel_index.stats)
+api_client = ApiClient(limiter=rapidapi_limiter)
+async_api_client = AsyncApiClient(limiter=rapidapi_limiter)
+
+
 class Request:
     """
     Класс работы с rapidapi.com
     """
+    base_url: str = os.getenv('RAPIDAPI_URL', 'https://hotels4.p.rapidapi.com')
+    client: ApiClient = api_client
+    async_client: AsyncApiClient = async_api_client
 
     def __init__(self, current_request: Dict, rapidapi_key: str = os.getenv('x-rapidapi-key')):
         """
@@ -124,10 +537,10 @@ class Request:
         self.rapidapi_key = rapidapi_key
         self.this_query = current_request
         self._headers = {'x-rapidapi-key': self._rapidapi_key, 'x-rapidapi-host': "hotels4.p.rapidapi.com"}
-        self._city_url = "https://hotels4.p.rapidapi.com/locations/v2/search"
-        self._hotels_url = "https://hotels4.p.rapidapi.com/properties/list"
-        self._hotel_info_url = "https://hotels4.p.rapidapi.com/properties/get-details"
-        self._hotel_pics_url = "https://hotels4.p.rapidapi.com/properties/get-hotel-photos"
+        self._city_url = self.base_url + "/locations/v2/search"
+        self._hotels_url = self.base_url + "/properties/list"
+        self._hotel_info_url = self.base_url + "/properties/get-details"
+        self._hotel_pics_url = self.base_url + "/properties/get-hotel-photos"
 
     @property
     def rapidapi_key(self) -> str:
@@ -153,111 +566,286 @@ class Request:
         :param current_request: словарь, содержащий переменные, участвующие в запросе
         :return: Dict
         """
-
-        response = requests.request("GET", url, headers=self._headers, params=current_request)
-        data = json.loads(response.text)
+        endpoint: str = url.rsplit('/', 1)[-1]
+        with metrics.span('rapidapi_request', endpoint=endpoint):
+            response = self.client.get(url, self._headers, current_request)
+        metrics.inc('rapidapi_responses_total', endpoint=endpoint,
+                    status=0 if response is None else response.status_code)
+        if response is None:
+            return self.decode_response(url, 0, b'')
+        return self.decode_response(url, response.status_code, response.content)
+
+    async def aget_response(self, url: str, current_request: Dict) -> Dict:
+        """
+        Асинхронный вариант get_response
+        :param url: url, по которому производится запрос
+        :param current_request: словарь, содержащий переменные, участвующие в запросе
+        :return: Dict
+        """
+        endpoint: str = url.rsplit('/', 1)[-1]
+        with metrics.span('rapidapi_request', endpoint=endpoint):
+            response = await self.async_client.get(url, self._headers, current_request)
+        metrics.inc('rapidapi_responses_total', endpoint=endpoint, status=0 if response is None else response[0])
+        if response is None:
+            return self.decode_response(url, 0, b'')
+        return self.decode_response(url, *response)
+
+    @staticmethod
+    def decode_response(url: str, status: int, content: bytes) -> Dict:
+        """
+        Сериализует ответ от API прямо из байтов (через orjson, если он установлен).
+        В случае ошибки возвращает пустой словарь
+        :param url: url, по которому производился запрос
+        :param status: код ответа (0, если ответ не получен)
+        :param content: тело ответа
+        :return: Dict
+        """
+        if not 200 <= status < 400:
+            logger.info(f'Не получен ответ от {url}')
+            return {}
+        try:
+            data = parsing.loads(content)
+        except ValueError:
+            logger.info(f'Получен некорректный json от {url}')
+            return {}
         return data
 
-    def get_city(self) -> List[Tuple]:
+    def get_city(self) -> tuple:
         """
-        Получает список id городов, имя которых совпадает с введенным пользователем
+        Получает список id городов, имя которых совпадает с введенным пользователем.
+        Результаты для одинаковых названий города и локализации берутся из кэша city_cache,
+        затем из локального индекса городов по точному совпадению или префиксу названия. Если название
+        похоже на город из индекса (опечатка), предлагаются похожие города, иначе выполняется запрос к API
+        :return: список записей City и признак того, что это предложения похожих городов
+        """
+        key = self.city_key()
+        cities = city_cache.get(key) or self.local_city()
+        if cities:
+            return [City(*city) for city in cities], False
+        suggestions = self.suggest_city()
+        if suggestions:
+            return suggestions, True
+        cities = self.load_city()
+        if cities:
+            city_cache.set(key, cities)
+        return [City(*city) for city in cities], False
+
+    async def aget_city(self) -> tuple:
+        """Асинхронный вариант get_city. Хранилище кэша city_cache читается и пишется в отдельном потоке"""
+        key = self.city_key()
+        cities = await asyncio.to_thread(city_cache.get, key) or self.local_city()
+        if cities:
+            return [City(*city) for city in cities], False
+        suggestions = self.suggest_city()
+        if suggestions:
+            return suggestions, True
+        cities = self.parse_city(await self.aget_response(self._city_url, self.this_query))
+        if cities:
+            await asyncio.to_thread(city_cache.set, key, cities)
+        return [City(*city) for city in cities], False
+
+    def city_key(self) -> Tuple:
+        """Возвращает ключ кэша city_cache для текущего запроса"""
+        return self.this_query['query'].strip().lower(), self.this_query.get('locale', '')
+
+    def local_city(self) -> List[Tuple]:
+        """Ищет города по введенному пользователем названию в локальном индексе городов"""
+        return city_index.lookup(self.this_query.get('locale', ''), self.this_query['query'])
+
+    def suggest_city(self) -> List[City]:
+        """Предлагает из локального индекса города с названием, похожим на введенное пользователем (опечатки)"""
+        return [City(*city) for city in city_index.suggest(self.this_query.get('locale', ''), self.this_query['query'])]
+
+    def load_city(self) -> List[Tuple]:
+        """
+        Получает от API список id городов, имя которых совпадает с введенным пользователем
         В случае ошибки возвращает пустой список
         :return: список кортежей, содержащих имя города с географической привязкой и его id
         """
+        return self.parse_city(self.get_response(self._city_url, self.this_query))
+
+    def parse_city(self, variants_cities: Dict) -> List[Tuple]:
+        """
+        Выбирает из ответа API города, имя которых совпадает с введенным пользователем.
+        Все города ответа добавляются в локальный индекс городов
+        :param variants_cities: ответ API
+        :return: список кортежей, содержащих имя города с географической привязкой и его id
+        """
         try:
-            variants_cities = self.get_response(self._city_url, self.this_query)
-            cities = [(re.sub(r'<.+?>', '', elem.get('caption')), elem.get('destinationId') + '.city_id')
-                      for elem in variants_cities.get('suggestions', [])[0].get('entities')
-                      if elem.get('type') == 'CITY' and self.this_query["query"].lower() in elem.get('name').lower()]
+            entities = [elem for elem in variants_cities.get('suggestions', [])[0].get('entities')
+                        if elem.get('type') == 'CITY']
         except IndexError:
-            cities = []
             logger.info('Получен неправильный ответ от сайта при запросе города.')
-        return cities
-
-    def get_hotels(self) -> List[Tuple]:
+            return []
+        for elem in entities:
+            city_index.add(self.this_query.get('locale', ''), elem.get('name'), re.sub(r'<.+?>', '', elem.get('caption')),
+                           elem.get('destinationId'))
+        return [(re.sub(r'<.+?>', '', elem.get('caption')), elem.get('destinationId')) for elem in entities
+                if self.this_query["query"].lower() in elem.get('name').lower()]
+
+    def get_hotels(self) -> List[HotelSummary]:
         """
         Получает список отелей, подходящих под критерии, введенные пользователем.
-        В случае ошибки возвращает пустой список
-        :return: список кортежей, содержащих информацию об отелях
+        Результаты одинаковых запросов берутся из кэша hotels_cache, одновременные одинаковые
+        запросы объединяются в один запрос к API
+        :return: список записей HotelSummary
+        """
+        key: str = normalize_query(self.this_query)
+        hotels = hotels_cache.get(key)
+        if hotels is None:
+            hotels = hotels_flight.do(key, lambda: self.load_hotels(key))
+        return hotels
+
+    async def aget_hotels(self) -> List[HotelSummary]:
+        """Асинхронный вариант get_hotels"""
+        key: str = normalize_query(self.this_query)
+        hotels = hotels_cache.get(key)
+        if hotels is None:
+            hotels = await async_hotels_flight.do(key, lambda: self.aload_hotels(key))
+        return hotels
+
+    def load_hotels(self, key: str) -> List[HotelSummary]:
+        """
+        Получает от API список отелей, подходящих под критерии, введенные пользователем, сохраняет его в кэш
+        и добавляет отели в индекс hotel_index. В случае ошибки возвращает пустой список
+        :param key: ключ кэша для текущего запроса
+        :return: список записей HotelSummary
+        """
+        hotels = self.parse_hotels(self.get_response(self._hotels_url, self.this_query))
+        if hotels:
+            hotels_cache.set(key, hotels)
+            hotel_index.add(self.this_query.get(API_KEYS['city_id'], ''), hotels)
+        return hotels
+
+    async def aload_hotels(self, key: str) -> List[HotelSummary]:
+        """
+        Асинхронный вариант load_hotels. Индекс hotel_index при первом обращении к городу читает базу,
+        поэтому отели добавляются в него в отдельном потоке
+        """
+        hotels = self.parse_hotels(await self.aget_response(self._hotels_url, self.this_query))
+        if hotels:
+            hotels_cache.set(key, hotels)
+            await asyncio.to_thread(hotel_index.add, self.this_query.get(API_KEYS['city_id'], ''), hotels)
+        return hotels
+
+    @staticmethod
+    def parse_hotels(variants_hotels: Dict) -> List[HotelSummary]:
+        """
+        Выбирает из ответа API список отелей. В случае ошибки возвращает пустой список
+        :param variants_hotels: ответ API
+        :return: список записей HotelSummary
         """
         hotels = []
         try:
-            variants_hotels = self.get_response(self._hotels_url, self.this_query)
-            hotels = [(f"{hotel.get('name')} {'⭐️' * int(hotel.get('starRating', 0))}  "
-                       f"{hotel.get('address').get('streetAddress')}. "
-                       f"{str(hotel.get('ratePlan').get('price').get('current')).lower()} "
-                       f"{hotel.get('landmarks')[0].get('distance').split(sep=' ')[0]} до центра",
-                       str(hotel.get('id')) + '.hotel_id')
-                      for hotel in variants_hotels['data']['body']['searchResults']['results']]
-
-        except IndexError as err:
+            hotels = parsing.parse_hotels(variants_hotels)
+        except (IndexError, KeyError, TypeError) as err:
             logger.info(f'Получен неправильный ответ от сайта при запросе отелей: {err}')
         return hotels
 
-    def get_hotel_info(self) -> str:
+    def hotel_info_key(self) -> str:
+        """Возвращает ключ кэша details_cache для информации об отеле"""
+        return 'info' + normalize_query(self.this_query)
+
+    def hotel_pics_key(self) -> str:
+        """Возвращает ключ кэша details_cache для списка изображений отеля"""
+        return 'pics' + normalize_query(self.this_query)
+
+    def get_hotel_info(self) -> Optional[HotelDetails]:
         """
         Получает от API и возвращает информацию об одном отеле.
-        :return: строка, содержащая полную информацию об отеле
+        Успешные ответы (в том числе полученные заранее Prefetcher) берутся из кэша details_cache
+        :return: запись HotelDetails, либо None в случае ошибки
         """
-        try:
-            this_hotel = self.get_response(self._hotel_info_url, self.this_query)
-            if this_hotel.get('result') != 'OK':
-                hotel_info = 'Произошла ошибка при обращении к сайту.'
-            else:
-                name = this_hotel.get('data').get('body').get('propertyDescription').get('name')
-                latitude = this_hotel.get('data').get('body').get('pdpHeader') \
-                    .get('hotelLocation').get('coordinates').get('latitude')
-                longitude = this_hotel.get('data').get('body').get('pdpHeader') \
-                    .get('hotelLocation').get('coordinates').get('longitude')
-
-                short_path = this_hotel.get('data').get('body').get('overview').get('overviewSections')
-                header_overview = [short_path[num].get('title') for num in range(len(short_path))
-                                   if short_path[num].get('type') == 'HOTEL_FEATURE']
-                this_overview = [short_path[num].get('content') for num in range(len(short_path))
-                                 if short_path[num].get('type') == 'HOTEL_FEATURE']
-                header_around = [short_path[num].get('title') for num in range(len(short_path))
-                                 if short_path[num].get('type') == 'LOCATION_SECTION']
-                this_around = [short_path[num].get('content') for num in range(len(short_path))
-                               if short_path[num].get('type') == 'LOCATION_SECTION']
-
-                this_address = this_hotel.get('data').get('body').get('propertyDescription').get(
-                    'address').get('fullAddress')
-                this_price = str(this_hotel.get('data').get('body').get('propertyDescription').get(
-                    'featuredPrice').get('currentPrice').get('formatted')) + ' ' + str(this_hotel.get('data').get(
-                     'body').get('propertyDescription').get('featuredPrice').get('priceInfo', ''))
-                this_map_widget = this_hotel.get('data').get('body').get('propertyDescription').get('mapWidget').\
-                    get('staticMapUrl', '')
-
-                dict_locale: dict = {'en_US': '', 'ru_RU': 'ru.'}
-                box = dict_locale[self.this_query['locale']]
-                hotel_url = f'https://www.{box}hotels.com/ho' + self.this_query['id']
-
-                hotel_info = ''
-                hotel_info += name + '\n\n'
-                hotel_info += f'Адрес отеля: {this_address}\n'
-                hotel_info += this_map_widget + '\n'
-                hotel_info += f'Координаты отеля: {latitude}, {longitude}\n\n'
-                hotel_info += '\n'.join(header_overview) + '\n\n'
-                hotel_info += '\n'.join(*this_overview)
-                hotel_info += '\n\n'
-                hotel_info += '\n'.join(header_around) + '\n\n'
-                hotel_info += '\n'.join(*this_around)
-                hotel_info += '\n\n'
-                hotel_info += this_price + '\n\n'
-                hotel_info += f'Ссылка на страницу отеля на сайте hotels.com: {hotel_url}\n'
+        key: str = self.hotel_info_key()
+        hotel_info = details_cache.get(key)
+        if hotel_info is None:
+            hotel_info = details_flight.do(key, lambda: self.cache_hotel_info(
+                key, self.get_response(self._hotel_info_url, self.this_query)))
+        return hotel_info
 
-        except IndexError:
-            hotel_info = 'Запрос составлен неверно, обратитесь к администратору.'
+    async def aget_hotel_info(self) -> Optional[HotelDetails]:
+        """Асинхронный вариант get_hotel_info"""
+        key: str = self.hotel_info_key()
+        hotel_info = details_cache.get(key)
+        if hotel_info is None:
+            hotel_info = await async_details_flight.do(key, lambda: self.acache_hotel_info(key))
+        return hotel_info
+
+    def cache_hotel_info(self, key: str, this_hotel: Dict) -> Optional[HotelDetails]:
+        """
+        Выбирает информацию об отеле и сохраняет ее в кэш, если ответ API успешный
+        :param key: ключ кэша
+        :param this_hotel: ответ API
+        :return: запись HotelDetails, либо None в случае ошибки
+        """
+        hotel_info: Optional[HotelDetails] = self.parse_hotel_info(this_hotel)
+        if hotel_info is not None:
+            details_cache.set(key, hotel_info)
         return hotel_info
 
+    async def acache_hotel_info(self, key: str) -> Optional[HotelDetails]:
+        """Запрашивает у API информацию об отеле и сохраняет ее в кэш, если ответ успешный"""
+        return self.cache_hotel_info(key, await self.aget_response(self._hotel_info_url, self.this_query))
+
+    def parse_hotel_info(self, this_hotel: Dict) -> Optional[HotelDetails]:
+        """
+        Выбирает информацию об одном отеле из ответа API
+        :param this_hotel: ответ API
+        :return: запись HotelDetails, либо None в случае ошибки
+        """
+        if this_hotel.get('result') != 'OK':
+            logger.info(f'Произошла ошибка при запросе информации об отеле {self.this_query.get("id")}')
+            return None
+        try:
+            return parsing.parse_hotel_details(this_hotel)
+        except (IndexError, KeyError, TypeError) as err:
+            logger.info(f'Получен неправильный ответ от сайта при запросе информации об отеле: {err}')
+            return None
+
     def get_hotel_pics(self) -> List[str]:
         """
-        Возвращает список url изображений отеля
+        Возвращает список url изображений отеля. Непустые списки берутся из кэша details_cache
+        :return: список url изображений
+        """
+        key: str = self.hotel_pics_key()
+        pics = details_cache.get(key)
+        if pics is None:
+            pics = details_flight.do(key, lambda: self.cache_hotel_pics(
+                key, self.get_response(self._hotel_pics_url, self.this_query)))
+        return pics
+
+    async def aget_hotel_pics(self) -> List[str]:
+        """Асинхронный вариант get_hotel_pics"""
+        key: str = self.hotel_pics_key()
+        pics = details_cache.get(key)
+        if pics is None:
+            pics = await async_details_flight.do(key, lambda: self.acache_hotel_pics(key))
+        return pics
+
+    def cache_hotel_pics(self, key: str, pictures: Dict) -> List[str]:
+        """
+        Выбирает список url изображений отеля и сохраняет его в кэш, если он не пустой
+        :param key: ключ кэша
+        :param pictures: ответ API
+        :return: список url изображений
+        """
+        pics: List[str] = self.parse_hotel_pics(pictures)
+        if pics:
+            details_cache.set(key, pics)
+        return pics
+
+    async def acache_hotel_pics(self, key: str) -> List[str]:
+        """Запрашивает у API список url изображений отеля и сохраняет его в кэш, если он не пустой"""
+        return self.cache_hotel_pics(key, await self.aget_response(self._hotel_pics_url, self.this_query))
+
+    def parse_hotel_pics(self, pictures: Dict) -> List[str]:
+        """
+        Выбирает из ответа API список url изображений отеля
+        :param pictures: ответ API
         :return: список url изображений
         """
         pics: List = []
         try:
-            pictures = self.get_response(self._hotel_pics_url, self.this_query)
             photo_hotel = pictures.get('hotelImages')
             if photo_hotel:
                 for photo in photo_hotel:
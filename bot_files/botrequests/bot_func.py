@@ -1,23 +1,84 @@
+import os
 import re
-from datetime import date
-from typing import Dict, List, Tuple, Union
+import time
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from loguru import logger
-from telebot.types import InlineKeyboardMarkup, Message
-from telegram_bot_calendar import DetailedTelegramCalendar
+from peewee import CharField, DateTimeField
+from playhouse.migrate import SqliteMigrator, migrate
+from telebot.types import CallbackQuery, InlineKeyboardMarkup, InputMediaPhoto, Message
+
+from botrequests import renderer
+from botrequests.bestdeal import BESTDEAL_SORT_ORDER, BestDeal
+from botrequests.bot_classes import API_KEYS, CachedValue, HotelLocation, InlineKeyboard, Request, Session, HistoryQuery, \
+    db, photo_cache, results_cache
+from botrequests.conversation import Conversation, Reply, set_step
+from botrequests.date_picker import date_picker
+from botrequests.fanout import FLEX_DAYS, FLEX_SORT_ORDER, FanOutSearch, date_variants
+from botrequests.history import from_cursor, history_log
+from botrequests.metrics import metrics
+from botrequests.parsing import to_float
+from botrequests.prefetch import prefetcher
+from botrequests.records import City, HotelDetails, HotelSummary, SearchResults
+from botrequests.session_store import session_store
+
+
+ALBUM_SIZE: int = 10
+RESULTS_FETCH_SIZE: int = int(os.getenv('RESULTS_FETCH_SIZE', 25))
+RESULTS_EXPIRED: str = 'Результаты поиска устарели. Повторите поиск командой /lowprice, /highprice, /bestdeal или /flexprice'
+PRICE_RANGE_QUESTION: str = 'Введите диапазон цен за ночь ({}) через пробел, например: 1000 5000'
+CITY_SUGGESTION: str = 'Города с таким названием не обнаружено. Возможно, Вы имели в виду один из них?\n' \
+                       'Если нет, введите название еще раз:'
+FLEX_PROGRESS: str = 'Проверено вариантов дат: {completed} из {total}. Лучшие цены на данный момент:'
+FLEX_FOUND: str = 'Самые низкие цены за {total} вариантов дат (±{days} дн.). Выберите подходящий отель:'
+DISTANCE_QUESTION: str = 'Введите максимальное расстояние от отеля до центра города в километрах:'
+ADMIN_IDS: Tuple[str, ...] = tuple(admin.strip() for admin in os.getenv('ADMIN_IDS', '').split(',') if admin.strip())
+MESSAGE_LIMIT: int = 4096
+SEARCH_PROGRESS: str = 'Идет поиск отелей...:'
+PHOTO_QUESTION = Reply('Для выбранного отеля будем выводить фото?',
+                       InlineKeyboard([('Yes', 'Yes.photo'), ('No', 'No.photo')], 2).create_keys(), 'photos')
+
+
+def reply(message: Message, bot, answer: Reply) -> None:
+    """
+    Отправляет ответ шага диалога, устанавливает следующий шаг и вызывает обработчик, указанный в ответе
+    :param message: Полученное в чате сообщение
+    :param bot: бот
+    :param answer: ответ шага диалога
+    """
+    if answer.text is not None:
+        bot.send_message(message.chat.id, answer.text, reply_markup=answer.markup)
+    if answer.step is not None:
+        set_step(message, answer.step)
+    if answer.follow is not None:
+        follow_ups[answer.follow](message, bot)
+
 
-from Bot_files.botrequests.bot_classes import InlineKeyboard, Request, Session, HistoryQuery, db
+def keyboard(keys: List, row: int) -> InlineKeyboardMarkup:
+    """Создает inline клавиатуру из кнопок keys по row кнопок в ряду"""
+    return InlineKeyboard(keys, row).create_keys()
 
 
 def search_city(message: Message, bot) -> None:
     """
     Формирует запрос для поиска города по названию и на основе полученных данных создается
     inline клавиатура с вариантами городов (если поиск успешный) или производится повторный запрос
-    у пользователя (если данных на сайте не найдено). В зависимости от языка вводимого сообщения выбирается
-    локализация и валюта для поиска и отображения результатов текущего запроса пользователя
+    у пользователя (если данных на сайте не найдено)
     :param bot: бот
     :param message: Полученное в чате сообщение
     """
+    request_queue: Dict = city_request(message)
+    reply(message, bot, city_reply(message, *object_search(search_city.__name__, request_queue, message)))
+
+
+def city_request(message: Message) -> Dict:
+    """
+    Сохраняет в текущем запросе пользователя название города. В зависимости от языка вводимого сообщения
+    выбирается локализация и валюта для поиска и отображения результатов текущего запроса пользователя
+    :param message: Полученное в чате сообщение
+    :return: запрос поиска города
+    """
     city: str = message.text
     if re.match(r'[А-Яа-яЁё]+', city):
         locale: str = 'ru_RU'
@@ -29,18 +90,24 @@ def search_city(message: Message, bot) -> None:
     for value in (('query', city), ('locale', locale), ('currency', currency)):
         update_save(message, value[0], value[1])
 
-    request_queue: Dict = collect_request(message, 'query', 'locale', 'currency')
+    return collect_request(message, 'query', 'locale', 'currency')
+
 
-    cities: List = object_search(search_city.__name__, request_queue, message)
+def city_reply(message: Message, cities: List[City], suggested: bool) -> Reply:
+    """
+    Возвращает клавиатуру с вариантами городов, либо повторный запрос названия, если город не найден
+    :param message: Полученное в чате сообщение
+    :param cities: найденные города
+    :param suggested: признак того, что это предложения похожих городов
+    """
+    if suggested:
+        logger.info(f'message {message.from_user.id}: Предложено {len(cities)} похожих названий города')
+        return Reply(CITY_SUGGESTION, keyboard(renderer.city_keys(cities), 1), 'search_city')
     if len(cities) == 0:
         logger.info(f'message {message.from_user.id}: Города с названием {message.text} не обнаружено:')
-        msg = bot.send_message(message.chat.id,
-                               'Города с таким названием не обнаружено\nПопробуйте ввести название еще раз:')
-        bot.register_next_step_handler(msg, search_city, bot)
-
-    else:
-        logger.info(f'message {message.from_user.id}: Найдено {len(cities)} вариантов названия города на выбор')
-        create_keyboard(cities, 1, 'Найдено несколько городов. Выберите подходящий:', message, bot)
+        return Reply('Города с таким названием не обнаружено\nПопробуйте ввести название еще раз:', step='search_city')
+    logger.info(f'message {message.from_user.id}: Найдено {len(cities)} вариантов названия города на выбор')
+    return Reply('Найдено несколько городов. Выберите подходящий:', keyboard(renderer.city_keys(cities), 1))
 
 
 def number_hotels(message: Message, bot):
@@ -50,18 +117,19 @@ def number_hotels(message: Message, bot):
     :param bot: бот
     :param message: Полученное в чате сообщение
     """
+    reply(message, bot, number_hotels_reply(message))
+
+
+def number_hotels_reply(message: Message) -> Reply:
+    """Проверяет и сохраняет введенное пользователем количество отелей"""
     amount_hotels: str = message.text
     if not amount_hotels.isdigit() or int(amount_hotels) > 25 or 0 >= int(amount_hotels):
         logger.info(f'message {message.from_user.id}: Количество отелей {amount_hotels} введено не корректно')
-        msg = bot.send_message(message.chat.id,
-                               'Введено не число от 1 до 25\nПопробуйте ввести количество вариантов еще раз:')
-        bot.register_next_step_handler(msg, number_hotels, bot)
-    else:
-        logger.info(f'message {message.from_user.id}: Количество отелей введено корректно')
-        update_save(message, 'number_hotels', amount_hotels)
-        msg = bot.send_message(message.chat.id,
-                               'Сколько человек будет проживать в отеле:')
-        bot.register_next_step_handler(msg, number_guests, bot)
+        return Reply('Введено не число от 1 до 25\nПопробуйте ввести количество вариантов еще раз:',
+                     step='number_hotels')
+    logger.info(f'message {message.from_user.id}: Количество отелей введено корректно')
+    update_save(message, 'number_hotels', amount_hotels)
+    return Reply('Сколько человек будет проживать в отеле:', step='number_guests')
 
 
 def number_guests(message: Message, bot):
@@ -71,42 +139,104 @@ def number_guests(message: Message, bot):
     :param bot: бот
     :param message: Полученное в чате сообщение
     """
+    reply(message, bot, number_guests_reply(message))
+
+
+def number_guests_reply(message: Message) -> Reply:
+    """Проверяет и сохраняет введенное пользователем число гостей, для /bestdeal запрашивает диапазон цен"""
     amount_guests: str = message.text
     if not amount_guests.isdigit() or int(amount_guests) not in range(1, 11):
         logger.info(f'message {message.from_user.id}: Количество гостей {amount_guests} введено не корректно')
-        msg = bot.send_message(message.chat.id,
-                               'Введено не число от 1 до 10\nПопробуйте ввести количество гостей еще раз:')
-        bot.register_next_step_handler(msg, number_guests, bot)
-    else:
-        logger.info(f'message {message.from_user.id}: Количество гостей введено корректно')
-        update_save(message, 'number_persons', amount_guests)
-        check_dates(message, bot)
+        return Reply('Введено не число от 1 до 10\nПопробуйте ввести количество гостей еще раз:',
+                     step='number_guests')
+    logger.info(f'message {message.from_user.id}: Количество гостей введено корректно')
+    update_save(message, 'number_persons', amount_guests)
+    if get_value_from_save(message, 'sort_order') == BESTDEAL_SORT_ORDER:
+        return Reply(PRICE_RANGE_QUESTION.format(get_value_from_save(message, 'currency')), step='price_range')
+    return Reply(follow='check_dates')
+
+
+def parse_price_range(text: str) -> Optional[Tuple[float, float]]:
+    """Возвращает минимальную и максимальную цену из строки вида '1000 5000' или None, если ввод некорректен"""
+    prices: List[Optional[float]] = [to_float(price.replace(',', '.')) for price in re.split(r'[\s\-]+', text.strip())]
+    if len(prices) != 2 or None in prices or not 0 <= prices[0] <= prices[1]:
+        return None
+    return prices[0], prices[1]
+
+
+def parse_distance(text: str) -> Optional[float]:
+    """Возвращает максимальное расстояние до центра в километрах или None, если ввод некорректен"""
+    distance: Optional[float] = to_float(text.strip().replace(',', '.'))
+    if distance is None or distance <= 0:
+        return None
+    return distance
+
+
+def price_range(message: Message, bot) -> None:
+    """
+    Проверяет введенный пользователем диапазон цен (/bestdeal) и запрашивает максимальное расстояние до центра
+    (если проверка успешная) или производится повторный запрос (если данные не прошли проверку)
+    :param bot: бот
+    :param message: Полученное в чате сообщение
+    """
+    reply(message, bot, price_range_reply(message))
+
+
+def price_range_reply(message: Message) -> Reply:
+    """Проверяет и сохраняет введенный пользователем диапазон цен"""
+    prices: Optional[Tuple[float, float]] = parse_price_range(message.text)
+    if prices is None:
+        logger.info(f'message {message.from_user.id}: Диапазон цен {message.text} введен не корректно')
+        return Reply('Введите два числа через пробел, например: 1000 5000', step='price_range')
+    logger.info(f'message {message.from_user.id}: Диапазон цен введен корректно')
+    update_save(message, 'price_start', prices[0])
+    update_save(message, 'price_stop', prices[1])
+    return Reply(DISTANCE_QUESTION, step='max_distance')
+
+
+def max_distance(message: Message, bot) -> None:
+    """
+    Проверяет введенное пользователем максимальное расстояние до центра (/bestdeal) и вызывает check_dates
+    (если проверка успешная) или производится повторный запрос (если данные не прошли проверку)
+    :param bot: бот
+    :param message: Полученное в чате сообщение
+    """
+    reply(message, bot, max_distance_reply(message))
+
+
+def max_distance_reply(message: Message) -> Reply:
+    """Проверяет и сохраняет введенное пользователем максимальное расстояние до центра"""
+    distance: Optional[float] = parse_distance(message.text)
+    if distance is None:
+        logger.info(f'message {message.from_user.id}: Расстояние {message.text} введено не корректно')
+        return Reply('Введите положительное число, например: 2.5', step='max_distance')
+    logger.info(f'message {message.from_user.id}: Расстояние введено корректно')
+    update_save(message, 'distance', distance)
+    return Reply(follow='check_dates')
+
+
+def dates_text(message: Message) -> str:
+    """Возвращает текст сообщения с календарем: ввод даты заезда или, если она уже выбрана, даты выезда"""
+    if date_picker.check_in(message.chat.id) is None:
+        return 'Введите дату заезда в отель'
+    return 'Введите дату выезда из отеля'
 
 
 def check_dates(message: Message, bot):
     """Формирует календарь для ввода дат заезда-выезда"""
-    locale: str = get_value_from_save(message, 'locale')[:2]
+    reply(message, bot, dates_reply(message))
 
-    calendar, step = DetailedTelegramCalendar(locale=locale).build()
-    if get_value_from_save(message, 'check_in') == '':
-        text_message = 'заезда в отель'
-    else:
-        text_message = 'выезда из отеля'
-    bot.send_message(message.chat.id, 'Введите дату ' + text_message, reply_markup=calendar)
 
+def dates_reply(message: Message) -> Reply:
+    """Возвращает сообщение с календарем для ввода дат заезда-выезда"""
+    locale: str = get_value_from_save(message, 'locale')[:2]
+    return Reply(dates_text(message), date_picker.start(locale), 'dates')
 
-def validation_dates(message: Message, bot) -> bool:
-    """Проверка вводимых дат на корректность"""
-    check_in: date = get_value_from_save(message, 'check_in')
-    check_out: date = get_value_from_save(message, 'check_out')
-    if check_out.year > check_in.year:
+
+def validation_dates(message: Message, check_in: date, check_out: date) -> bool:
+    """Проверка вводимых дат на корректность: дата выезда должна быть позже даты заезда"""
+    if check_out > check_in:
         return True
-    elif check_out.year == check_in.year:
-        if check_out.month > check_in.month:
-            return True
-        elif check_out.month == check_in.month:
-            if check_out.day > check_in.day:
-                return True
     logger.info(f'message {message.from_user.id}: Даты {check_in} и {check_out} введены не корректно')
     return False
 
@@ -118,38 +248,238 @@ def search_hotels(message: Message, bot):
     :param bot: бот
     :param message: Полученное в чате сообщение
     """
-    bot.send_message(message.chat.id, 'Идет поиск отелей...:')
-    request_queue: Dict = collect_request(message, 'city_id', 'page_number', 'number_hotels', 'check_in', 'check_out',
-                                          'number_persons', 'sort_order', 'locale', 'currency')
-    hotels: List = object_search(search_hotels.__name__, request_queue, message)
+    request_queue: Dict = hotels_request(message)
+    bot.send_message(message.chat.id, SEARCH_PROGRESS)
+    if request_queue[API_KEYS['sort_order']] == FLEX_SORT_ORDER:
+        hotels: List = flex_search(message, request_queue, bot)
+    elif request_queue[API_KEYS['sort_order']] == BESTDEAL_SORT_ORDER:
+        hotels: List = best_deal(message, request_queue).search()
+    else:
+        hotels: List = object_search(search_hotels.__name__, results_request(request_queue), message)
+    reply(message, bot, hotels_reply(message, request_queue, hotels))
+    record_history(message, hotels[:int(request_queue[API_KEYS['number_hotels']])])
+    session_store.flush(message.chat.id)
 
+
+def hotels_request(message: Message) -> Dict:
+    """Завершает диалог и возвращает запрос поиска отелей из текущего запроса пользователя"""
+    set_step(message, '')
+    return collect_request(message, 'city_id', 'page_number', 'number_hotels', 'check_in', 'check_out',
+                           'number_persons', 'sort_order', 'locale', 'currency')
+
+
+def hotels_reply(message: Message, request_queue: Dict, hotels: List[HotelSummary]) -> Reply:
+    """
+    Возвращает клавиатуру первой страницы найденных отелей: результаты сохраняются в results_cache,
+    для первых отелей запускается упреждающая загрузка. Гибкий поиск отправляет результаты сам
+    :param message: Полученное в чате сообщение
+    :param request_queue: запрос поиска отелей
+    :param hotels: найденные отели
+    """
     if len(hotels) == 0:
         logger.info(f'message {message.from_user.id}: Отеля по запросу не обнаружено:')
-        bot.send_message(message.chat.id,
-                         'Отелей по вашему запросу не найдено.'
-                         ' Если хотите повторить запрос или набрать новый,'
-                         ' воспользуйтесь, пожалуйста, командой /start')
+        return Reply('Отелей по вашему запросу не найдено.'
+                     ' Если хотите повторить запрос или набрать новый,'
+                     ' воспользуйтесь, пожалуйста, командой /start')
+    if request_queue[API_KEYS['sort_order']] == FLEX_SORT_ORDER:
+        logger.info(f'message {message.from_user.id}: Гибкий поиск нашел {len(hotels)} вариантов отелей')
+        return Reply()
+    logger.info(f'message {message.from_user.id}: Обнаружено {len(hotels)} вариантов отелей')
+    page_size: int = int(request_queue[API_KEYS['number_hotels']])
+    results_keyboard: List = cache_results(message, hotels, page_size, request_queue['locale'])
+    prefetch_hotels(message, hotels[:page_size])
+    return Reply('Найдено несколько отелей. Выберите подходящий:', keyboard(results_keyboard, 1))
+
+
+def flex_search(message: Message, request_queue: Dict, bot) -> List[HotelSummary]:
+    """
+    Гибкий поиск /flexprice: запросы на даты со сдвигом до FLEX_DAYS дней выполняются одновременно.
+    Сообщение с отелями отправляется после первого ответа и обновляется по мере поступления остальных
+    :param message: Полученное в чате сообщение
+    :param request_queue: запрос properties/list (как в search_hotels)
+    :param bot: бот
+    :return: найденные отели (лучшие по цене среди всех дат)
+    """
+    page_size: int = int(request_queue[API_KEYS['number_hotels']])
+    fan_out = FanOutSearch(date_variants(results_request(request_queue)), RESULTS_FETCH_SIZE)
+    sent: Optional[Message] = None
+    hotels: List[HotelSummary] = []
+    for top in fan_out.search():
+        if not top:
+            continue
+        text, markup, hotels = flex_results(message, fan_out, top, page_size, request_queue['locale'])
+        if sent is None:
+            sent = bot.send_message(message.chat.id, text, reply_markup=markup)
+        else:
+            bot.edit_message_text(text, message.chat.id, sent.message_id, reply_markup=markup)
+    return hotels
+
+
+def flex_results(message: Message, fan_out: FanOutSearch, top: List[Tuple[HotelSummary, Dict]], page_size: int,
+                 locale: str) -> Tuple[str, InlineKeyboardMarkup, List[HotelSummary]]:
+    """
+    Сохраняет промежуточные результаты гибкого поиска в results_cache вместе с датами каждого отеля
+    :param message: Полученное в чате сообщение
+    :param fan_out: выполняемый гибкий поиск
+    :param top: лучшие отели с запросами вариантов, в которых они найдены
+    :param page_size: количество отелей на одной странице клавиатуры
+    :param locale: локализация запроса
+    :return: текст сообщения, клавиатура первой страницы и список отелей
+    """
+    hotels: List[HotelSummary] = [hotel for hotel, variant in top]
+    dates: Dict[str, Tuple[date, date]] = {hotel.hotel_id: (variant[API_KEYS['check_in']],
+                                                            variant[API_KEYS['check_out']])
+                                           for hotel, variant in top}
+    keys: List = cache_results(message, hotels, page_size, locale, dates)
+    if fan_out.completed < fan_out.total:
+        text: str = FLEX_PROGRESS.format(completed=fan_out.completed, total=fan_out.total)
+    else:
+        text = FLEX_FOUND.format(total=fan_out.total, days=FLEX_DAYS)
+    return text, InlineKeyboard(keys, 1).create_keys(), hotels
+
+
+def choose_hotel(message: Message, hotel_id: str) -> None:
+    """
+    Сохраняет выбранный отель в текущем запросе пользователя. Если отель найден гибким поиском,
+    в запросе сохраняются и даты, на которые найдена его цена
+    """
+    update_save(message, 'hotel_id', hotel_id)
+    results: Optional[SearchResults] = results_cache.get(session_store.get(message.chat.id, 'id'))
+    if results is not None and results.dates and hotel_id in results.dates:
+        check_in, check_out = results.dates[hotel_id]
+        session_store.update(message.chat.id, check_in=check_in, check_out=check_out)
+
+
+def results_request(request_queue: Dict) -> Dict:
+    """
+    Возвращает запрос properties/list, в котором запрашивается не меньше RESULTS_FETCH_SIZE отелей:
+    следующие страницы результатов показываются из results_cache без новых запросов к API
+    """
+    page_size: int = max(int(request_queue[API_KEYS['number_hotels']]), RESULTS_FETCH_SIZE)
+    return {**request_queue, API_KEYS['number_hotels']: str(page_size)}
+
+
+def cache_results(message: Message, hotels: List[HotelSummary], page_size: int, locale: str,
+                  dates: Optional[Dict[str, Tuple[date, date]]] = None) -> List:
+    """
+    Сохраняет результаты поиска в results_cache по id текущего запроса пользователя
+    :return: кнопки первой страницы результатов
+    """
+    session_id: int = session_store.get(message.chat.id, 'id')
+    results = SearchResults(hotels, page_size, locale, dates)
+    results_cache.set(session_id, results)
+    return renderer.results_keys(results, session_id, 0)
+
+
+def results_page_markup(data: str) -> Optional[InlineKeyboardMarkup]:
+    """
+    Возвращает клавиатуру страницы результатов поиска из results_cache без обращения к API и базе
+    :param data: callback data кнопки перелистывания вида '<id запроса>_<номер страницы>.results'
+    :return: клавиатура или None, если результаты поиска уже удалены из кэша
+    """
+    session_id, page = map(int, data.split('.')[0].split('_'))
+    results: Optional[SearchResults] = results_cache.get(session_id)
+    if results is None:
+        return None
+    return InlineKeyboard(renderer.results_keys(results, session_id, page), 1).create_keys()
+
+
+def turn_results_page(call: CallbackQuery, bot) -> None:
+    """Перелистывает клавиатуру результатов поиска в сообщении, к которому привязана нажатая кнопка"""
+    markup: Optional[InlineKeyboardMarkup] = results_page_markup(call.data)
+    if markup is None:
+        bot.edit_message_text(RESULTS_EXPIRED, call.message.chat.id, call.message.message_id)
     else:
-        logger.info(f'message {message.from_user.id}: Обнаружено {len(hotels)} вариантов отелей')
-        text_message = 'Найдено несколько отелей. Выберите подходящий:'
-        create_keyboard(hotels, 1, text_message, message, bot)
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
 
 
-def object_search(func_name: str, request_queue: Dict, message: Message) -> Union[List[Tuple], str]:
+def record_history(message: Message, hotels: List[HotelSummary]) -> None:
+    """Добавляет завершенный поиск в журнал поисков"""
+    current_session: Dict = session_store.load(message.chat.id)
+    history_log.append(message.chat.id, current_session['sort_order'], current_session['query'],
+                       current_session['check_in'], current_session['check_out'], [hotel.name for hotel in hotels])
+
+
+def show_history(message: Message, bot) -> None:
+    """Отправляет первую страницу журнала поисков пользователя"""
+    entries, has_older = history_log.page(message.chat.id)
+    logger.info(f'message {message.chat.id}: Отправлена страница истории из {len(entries)} записей')
+    reply(message, bot, history_reply(entries, False, has_older))
+
+
+def is_admin(message: Message) -> bool:
+    """Проверяет, что сообщение отправлено администратором бота (id из настройки ADMIN_IDS)"""
+    return str(message.from_user.id) in ADMIN_IDS
+
+
+def show_stats(message: Message, bot) -> None:
+    """Отправляет администратору отчет метрик бота"""
+    logger.info(f'message {message.chat.id}: Отправлен отчет метрик')
+    bot.send_message(message.chat.id, metrics.report()[:MESSAGE_LIMIT])
+
+
+def turn_history_page(call: CallbackQuery, bot) -> None:
+    """
+    Перелистывает журнал поисков в сообщении, к которому привязана нажатая кнопка
+    :param call: callback запрос кнопки с данными вида 'older_<время>-<id>.history' или 'newer_<время>-<id>.history'
+    :param bot: бот
+    """
+    direction, cursor = call.data.split('.')[0].split('_')
+    answer: Reply = history_reply(*history_page(call.message.chat.id, direction, cursor))
+    bot.edit_message_text(answer.text, call.message.chat.id, call.message.message_id, reply_markup=answer.markup)
+
+
+def history_reply(entries: List, has_newer: bool, has_older: bool) -> Reply:
+    """Возвращает страницу журнала поисков с клавиатурой перелистывания (без клавиатуры, если листать некуда)"""
+    keys: List = renderer.history_keys(entries, has_newer, has_older)
+    return Reply(renderer.history_text(entries), keyboard(keys, 2) if keys else None)
+
+
+def history_page(chat_id, direction: str, cursor: str) -> Tuple[List, bool, bool]:
+    """
+    Возвращает страницу журнала поисков, соседнюю с записью cursor
+    :return: записи страницы, есть ли записи новее, есть ли записи старее
+    """
+    position: Tuple[datetime, int] = from_cursor(cursor)
+    if direction == 'older':
+        entries, has_older = history_log.page(chat_id, before=position)
+        return entries, True, has_older
+    entries, has_newer = history_log.page(chat_id, after=position)
+    return entries, has_newer, True
+
+
+def best_deal(message: Message, request_queue: Dict) -> BestDeal:
+    """Создает поиск /bestdeal по запросу search_hotels и фильтрам из текущего запроса пользователя"""
+    return BestDeal(request_queue, int(request_queue[API_KEYS['number_hotels']]),
+                    float(get_value_from_save(message, 'price_start')),
+                    float(get_value_from_save(message, 'price_stop')),
+                    float(get_value_from_save(message, 'distance')))
+
+
+def prefetch_hotels(message: Message, hotels: List[HotelSummary]) -> None:
+    """Запускает упреждающую загрузку информации и фотографий первых отелей из результатов поиска"""
+    info_request: Dict = collect_request(message, 'check_in', 'check_out', 'number_persons', 'locale', 'currency')
+    scheduled: int = prefetcher.prefetch(hotels, info_request)
+    logger.info(f'message {message.from_user.id}: Упреждающая загрузка для {scheduled} отелей')
+
+
+def object_search(func_name: str, request_queue: Dict, message: Message) -> Union[List, Optional[HotelDetails]]:
     """
     Создает объект класса Request, вызывает метод в зависимости от функции отправителя.
      Возвращает искомые данные в функцию отправителя.
     :param func_name: Название функции - отправителя запроса
     :param request_queue: Запрос пользователя
     :param message: Полученное в чате сообщение
-    :return: Список кортежей, содержащих объекты поиска, либо текстовые данные в виде строки
+    :return: Список записей HotelSummary или ссылок на фотографии, запись HotelDetails, либо для search_city
+     список записей City и признак предложения похожих городов
     """
     searched_objects = Request(request_queue)
     way_search: Dict = {'search_hotels': searched_objects.get_hotels,
                         'search_city': searched_objects.get_city,
                         'search_hotel_info': searched_objects.get_hotel_info,
                         'search_hotel_photos': searched_objects.get_hotel_pics}
-    objects: Union[List, str] = way_search[func_name]()
+    with metrics.span('object_search', search=func_name):
+        objects: Union[List, Optional[HotelDetails]] = way_search[func_name]()
     logger.info(f'message {message.from_user.id}: Запрос от {func_name} отработан')
     return objects
 
@@ -161,31 +491,30 @@ def search_hotel_info(message: Message, bot):
     :param bot: бот
     :param message: Полученное в чате сообщение
     """
-    request_queue: Dict = collect_request(message, 'hotel_id', 'check_in', 'check_out',
-                                          'number_persons', 'locale', 'currency')
-    hotel_info: str = object_search(search_hotel_info.__name__, request_queue, message)
+    request_queue: Dict = hotel_info_request(message)
+    hotel_info: Optional[HotelDetails] = object_search(search_hotel_info.__name__, request_queue, message)
+    reply(message, bot, hotel_info_reply(message, request_queue, hotel_info))
+
+
+def hotel_info_request(message: Message) -> Dict:
+    """Завершает диалог и возвращает запрос информации о выбранном отеле из текущего запроса пользователя"""
+    set_step(message, '')
+    return collect_request(message, 'hotel_id', 'check_in', 'check_out', 'number_persons', 'locale', 'currency')
+
 
-    if len(hotel_info) == 0:
+def hotel_info_reply(message: Message, request_queue: Dict, hotel_info: Optional[HotelDetails]) -> Reply:
+    """Возвращает информацию об отеле, после которой, если пользователь их запросил, отправляются фотографии"""
+    follow: Optional[str] = 'search_hotel_photos' if get_value_from_save(message, 'hotel_pics').isdigit() else None
+    if hotel_info is None:
         logger.info(f'message {message.from_user.id}: Информация об отеле отсутствует в базе')
-        bot.send_message(message.chat.id, 'Информация об отеле отсутствует в базе')
-    else:
-        logger.info(f'message {message.from_user.id}: Информация об отеле отправлена пользователю')
-        bot.send_message(message.chat.id, hotel_info)
-    if get_value_from_save(message, 'hotel_pics').isdigit():
-        search_hotel_photos(message, bot)
+        return Reply('Информация об отеле отсутствует в базе', follow=follow)
+    logger.info(f'message {message.from_user.id}: Информация об отеле отправлена пользователю')
+    return Reply(renderer.hotel_text(hotel_info, request_queue['id'], request_queue['locale']), follow=follow)
 
 
 def check_photo(message: Message, bot) -> None:
     """Создает inline клавиатуру с вопросом о необходимости вывода фотографий отеля"""
-    button = [('Yes', 'Yes.photo'), ('No', 'No.photo')]
-    create_keyboard(button, 2, 'Для выбранного отеля будем выводить фото?', message, bot)
-
-
-def create_keyboard(keyboard: List, row: int, question: str, message: Message, bot) -> None:
-    """Создает inline клавиатуру по запросу пользователя"""
-    this_keyboard = InlineKeyboard(keyboard, row)
-    keyboard: InlineKeyboardMarkup = this_keyboard.create_keys()
-    bot.send_message(message.chat.id, text=question, reply_markup=keyboard)
+    reply(message, bot, PHOTO_QUESTION)
 
 
 def number_photos(message: Message, bot) -> None:
@@ -195,16 +524,19 @@ def number_photos(message: Message, bot) -> None:
     :param bot: бот
     :param message: Полученное в чате сообщение
     """
+    reply(message, bot, number_photos_reply(message))
+
+
+def number_photos_reply(message: Message) -> Reply:
+    """Проверяет и сохраняет введенное пользователем число фотографий"""
     amount_photos: str = message.text
     if not amount_photos.isdigit() or int(amount_photos) not in range(1, 16):
         logger.info(f'message {message.from_user.id}: Количество фотографий не корректное')
-        msg = bot.send_message(message.chat.id,
-                               'Введено не число от 1 до 15\nПопробуйте ввести количество фотографий еще раз:')
-        bot.register_next_step_handler(msg, number_photos, bot)
-    else:
-        logger.info(f'message {message.from_user.id}: Количество фотографий корректное')
-        update_save(message, 'hotel_pics', amount_photos)
-        search_hotel_info(message, bot)
+        return Reply('Введено не число от 1 до 15\nПопробуйте ввести количество фотографий еще раз:',
+                     step='number_photos')
+    logger.info(f'message {message.from_user.id}: Количество фотографий корректное')
+    update_save(message, 'hotel_pics', amount_photos)
+    return Reply(follow='search_hotel_info')
 
 
 def search_hotel_photos(message: Message, bot) -> None:
@@ -214,47 +546,115 @@ def search_hotel_photos(message: Message, bot) -> None:
     :param message: Полученное в чате сообщение
     """
     request_queue: Dict = collect_request(message, 'hotel_id')
-    photo_album: List = object_search(search_hotel_photos.__name__, request_queue, message)
+    answer, albums = photo_albums(message, object_search(search_hotel_photos.__name__, request_queue, message))
+    reply(message, bot, answer)
+    for album in albums:
+        started: float = time.perf_counter()
+        photos: List = album_photos(album)
+        if len(photos) == 1:
+            sent: List = [bot.send_photo(message.chat.id, photos[0])]
+        else:
+            sent: List = bot.send_media_group(message.chat.id, [InputMediaPhoto(photo) for photo in photos])
+        remember_photos(album, photos, sent)
+        log_album(message, album, started)
+    logger.info(f'message {message.from_user.id}: {sum(map(len, albums))} фотографий отправлено пользователю')
+
+
+def photo_albums(message: Message, photo_album: List[str]) -> Tuple[Reply, List[List[str]]]:
+    """
+    Делит фотографии отеля на альбомы по ALBUM_SIZE с учетом запрошенного пользователем количества
+    :param message: Полученное в чате сообщение
+    :param photo_album: url изображений отеля
+    :return: сообщение, если фотографий меньше запрошенного, и список альбомов
+    """
     photo_from_db = get_value_from_save(message, 'hotel_pics')
-
     if int(photo_from_db) <= len(photo_album):
         pics: int = int(photo_from_db)
+        answer = Reply()
     else:
         pics: int = len(photo_album)
-        bot.send_message(message.chat.id, f'На сайте найдено всего {photo_album} фотографий')
-    for pic in photo_album[:pics]:
-        bot.send_photo(message.chat.id, pic)
-    logger.info(f'message {message.from_user.id}: {pics} фотографий отправлено пользователю')
+        answer = Reply(f'На сайте найдено всего {pics} фотографий')
+    return answer, [photo_album[start:min(start + ALBUM_SIZE, pics)] for start in range(0, pics, ALBUM_SIZE)]
+
+
+def album_photos(album: List[str]) -> List[str]:
+    """
+    Заменяет url изображений на file_id telegram, если изображение уже отправлялось
+    :param album: список url изображений
+    :return: список file_id или url изображений
+    """
+    photos: List[str] = []
+    for url in album:
+        file_id: str = photo_cache.get(url)
+        photos.append(url if file_id is None else file_id)
+    return photos
+
+
+def remember_photos(album: List[str], photos: List[str], sent: List[Message]) -> None:
+    """
+    Сохраняет в photo_cache file_id изображений, отправленных по url
+    :param album: список url изображений
+    :param photos: отправленные значения (url или file_id)
+    :param sent: сообщения, полученные в ответ от telegram
+    """
+    for url, photo, sent_message in zip(album, photos, sent):
+        if photo == url and sent_message.photo:
+            photo_cache.set(url, sent_message.photo[-1].file_id)
+
+
+def log_album(message: Message, album: List[str], started: float) -> None:
+    """Логирует время отправки альбома и попадания в кэш file_id"""
+    stats: Dict = photo_cache.stats()
+    requests_total: int = stats['hits'] + stats['misses']
+    hit_rate: float = stats['hits'] / requests_total if requests_total else 0.0
+    logger.info(f'message {message.from_user.id}: альбом из {len(album)} фото отправлен за '
+                f'{time.perf_counter() - started:.3f} с, попаданий в кэш file_id {hit_rate:.0%}')
 
 
 def create_database() -> None:
-    """Создает таблицы Session и HistoryQuery в базе sqlite"""
+    """Создает таблицы Session, HistoryQuery, CachedValue и HotelLocation в базе sqlite"""
+    migrate_database()
     with db:
-        db.create_tables([Session, HistoryQuery])
-        logger.info(f'message: таблицы Session и HistoryQuery созданы или существуют')
+        db.create_tables([Session, HistoryQuery, CachedValue, HotelLocation])
+        logger.info(f'message: таблицы Session, HistoryQuery, CachedValue и HotelLocation созданы или существуют')
 
 
-def add_new_save(message: Message, sort_order: str) -> None:
+def migrate_database() -> None:
     """
-    Создает первую строку в таблице Session со значениями, соответствующими ключам в запросах к API hotels.com,
-    если она еще не создана. Создает начальную запись текущего запроса пользователя
+    Приводит базу, созданную предыдущими версиями бота, к текущей схеме: добавляет колонку created_at
+    в таблицы Session и HistoryQuery, колонку step в таблицу Session, включает режим incremental auto_vacuum
+    и журнал WAL, в котором несколько процессов бота читают базу, не блокируя друг друга.
+    Вызывается до создания таблиц, чтобы индексы по created_at создавались для уже существующих колонок
     """
-    with db:
-        first_save = Session.select().where(Session.id == 1)
-        if not first_save.exists():
-            first_save = Session(chat_id='chat.id', sort_order='sortOrder', query='query', city_id='destinationId',
-                                 locale='locale', currency='currency', number_hotels='pageSize',
-                                 number_persons='adults1', page_number='pageNumber', check_in='checkIn',
-                                 check_out='checkOut', hotel_id='id', hotel_pics='pics', price_start='price_start',
-                                 price_stop='price_stop', distance='distance')
-            first_save.save()
-            logger.info(f'message {message.from_user.id}: Первая запись создана')
-
-        session = Session(chat_id=message.chat.id, sort_order=sort_order, query='', city_id='', locale='',
-                          currency='', number_hotels='', number_persons='', check_in='', check_out='',
-                          hotel_id='', hotel_pics='', price_start='', price_stop='', distance='', page_number='1')
-        session.save()
-        logger.info(f'message {message.from_user.id}: Начальная запись текущего запроса создана')
+    with db.connection_context():
+        for model in (Session, HistoryQuery):
+            table_name: str = model._meta.table_name
+            if not db.table_exists(table_name):
+                continue
+            columns: List[str] = [column.name for column in db.get_columns(table_name)]
+            if 'created_at' not in columns:
+                with db.atomic():
+                    migrate(SqliteMigrator(db).add_column(table_name, 'created_at', DateTimeField(null=True)))
+                    model.update(created_at=datetime.now()).where(model.created_at.is_null()).execute()
+                logger.info(f'message: в таблицу {model.__name__} добавлена колонка created_at')
+            if model is Session and 'step' not in columns:
+                migrate(SqliteMigrator(db).add_column(table_name, 'step', CharField(default='')))
+                logger.info('message: в таблицу Session добавлена колонка step')
+        if db.pragma('auto_vacuum') != 2:
+            db.pragma('auto_vacuum', 'incremental')
+            db.execute_sql('VACUUM')
+            logger.info('message: для базы включен режим incremental auto_vacuum')
+        if db.pragma('journal_mode') != 'wal':
+            db.pragma('journal_mode', 'wal')
+            logger.info('message: для базы включен режим WAL')
+
+
+def add_new_save(message: Message, sort_order: str) -> None:
+    """Создает начальную запись текущего запроса пользователя"""
+    session_store.new_session(message.chat.id, sort_order=sort_order, query='', city_id='', locale='',
+                              currency='', number_hotels='', number_persons='', check_in='', check_out='',
+                              hotel_id='', hotel_pics='', price_start='', price_stop='', distance='', page_number='1')
+    logger.info(f'message {message.from_user.id}: Начальная запись текущего запроса создана')
 
 
 def update_save(message: Message, update_key: str, update_value: Union[str, date]) -> None:
@@ -264,11 +664,8 @@ def update_save(message: Message, update_key: str, update_value: Union[str, date
     :param update_value: Значение, сохраняемое в базе
     :param message: Полученное в чате сообщение
     """
-    with db:
-        session = eval(f"Session({update_key}='{update_value}')")
-        session.id = Session.select().where(Session.chat_id == message.chat.id).limit(1).order_by(Session.id.desc())[0]
-        session.save()
-        logger.info(f'message {message.from_user.id}: Обновление в базе: {update_key} = {update_value}')
+    session_store.set(message.chat.id, update_key, update_value)
+    logger.debug('message {}: Обновление запроса: {} = {}', message.from_user.id, update_key, update_value)
 
 
 def get_value_from_save(message: Message, column_from_save: str) -> Union[str, date]:
@@ -278,37 +675,27 @@ def get_value_from_save(message: Message, column_from_save: str) -> Union[str, d
     :param message: Полученное в чате сообщение
     :return: value
     """
-    with db:
-        cur_query = Session.select().where(Session.chat_id == message.chat.id).limit(1).order_by(Session.id.desc())[0]
-        value: Union[str, date] = eval(f"cur_query.{column_from_save}")
-        logger.info(f'message {message.from_user.id}: Запрос значения из базы: {column_from_save} = {value}')
-        return value
-
-
-def get_key_from_save(column_from_save: str) -> str:
-    """
-    Получает ключ для создания запроса к API hotels.com из первой строки таблицы Session,
-    соответствующей колонки текущего запроса пользователя
-    :param column_from_save: Название колонки в таблице Session
-    :return: key
-    """
-    with db:
-        cur_query = Session.get(Session.id == 1)
-        key: str = eval(f"cur_query.{column_from_save}")
-        logger.info(f'message: Запрос ключа из базы: {column_from_save} = {key}')
-        return key
+    value: Union[str, date] = session_store.get(message.chat.id, column_from_save)
+    logger.debug('message {}: Запрос значения: {} = {}', message.from_user.id, column_from_save, value)
+    return value
 
 
 def collect_request(message: Message, *args: Union[str, date, float, int]) -> Dict:
     """
-    создает запрос к API hotels.com из соответствующих колонок текущего запроса пользователя
+    создает запрос к API hotels.com из соответствующих колонок текущего запроса пользователя.
+    Все колонки берутся из одной записи, названия ключей API - из словаря API_KEYS
     :param args: Название колонки в таблице Session
     :param message: Полученное в чате сообщение
     :return: запрос в виде словаря
     """
-    collected_request: Dict = dict()
-    for arg in args:
-        key = get_key_from_save(arg)
-        value = get_value_from_save(message, arg)
-        collected_request[key] = value
+    current_session: Dict = session_store.load(message.chat.id)
+    collected_request: Dict = {API_KEYS[arg]: current_session[arg] for arg in args}
     return collected_request
+
+
+follow_ups: Dict[str, Callable] = {'check_dates': check_dates, 'search_hotel_info': search_hotel_info,
+                                  'search_hotel_photos': search_hotel_photos}
+conversation = Conversation({'search_city': search_city, 'number_hotels': number_hotels,
+                             'number_guests': number_guests, 'price_range': price_range,
+                             'max_distance': max_distance, 'dates': check_dates, 'photos': check_photo,
+                             'number_photos': number_photos})
@@ -0,0 +1,176 @@
+import difflib
+import json
+import os
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+CITY_INDEX_PATH: str = os.getenv('CITY_INDEX_PATH', 'botrequests/city_index.jsonl')
+
+
+def normalize(name: str) -> str:
+    """Приводит название города к виду для поиска: нижний регистр, ё как е, дефисы и лишние пробелы как пробел"""
+    return re.sub(r'[\s\-]+', ' ', name.lower().replace('ё', 'е')).strip()
+
+
+class CityIndex:
+    """
+    Класс, реализующий локальный индекс городов из ответов locations/v2/search. Для каждой локализации
+    хранится отсортированный список нормализованных названий, поиск по префиксу выполняется бинарным поиском.
+    Индекс позволяет отвечать на повторные и неполные названия городов без запросов к API
+    """
+
+    def __init__(self, limit: int = int(os.getenv('CITY_INDEX_LIMIT', 10)),
+                 min_prefix: int = int(os.getenv('CITY_INDEX_MIN_PREFIX', 3)),
+                 cutoff: float = float(os.getenv('CITY_INDEX_CUTOFF', 0.8))):
+        """
+        первичная инициализация класса
+        :param limit: максимальное количество городов в ответе
+        :param min_prefix: минимальная длина названия для поиска по префиксу (короче - только точное совпадение)
+        :param cutoff: минимальное сходство названия для предложения похожих городов (от 0 до 1)
+        """
+        self.limit: int = limit
+        self.min_prefix: int = min_prefix
+        self.cutoff: float = cutoff
+        self._names: Dict[str, List[str]] = dict()
+        self._cities: Dict[Tuple[str, str], Dict[str, str]] = dict()
+        self._suggested: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.suggested: int = 0
+        self.misses: int = 0
+
+    def add(self, locale: str, name: str, caption: str, destination_id: str) -> None:
+        """
+        Добавляет город в индекс
+        :param locale: локализация ответа API ('ru_RU', 'en_US')
+        :param name: название города
+        :param caption: название города с географической привязкой
+        :param destination_id: id города в API
+        """
+        key: str = normalize(name)
+        if not key:
+            return
+        with self._lock:
+            cities: Optional[Dict[str, str]] = self._cities.get((locale, key))
+            if cities is None:
+                cities = self._cities[(locale, key)] = dict()
+                insort(self._names.setdefault(locale, []), key)
+            cities[destination_id] = caption
+
+    def _collect(self, locale: str, keys: List[str]) -> List[Tuple[str, str]]:
+        """Возвращает города с названиями keys (не более limit)"""
+        cities: List[Tuple[str, str]] = [(caption, destination_id) for key in keys
+                                         for destination_id, caption in self._cities[(locale, key)].items()]
+        return cities[:self.limit]
+
+    def _prefixed(self, locale: str, query: str) -> List[str]:
+        """Возвращает название, совпадающее с query, либо (при его отсутствии) названия, начинающиеся с query"""
+        names: List[str] = self._names.get(locale, [])
+        position: int = bisect_left(names, query)
+        if position < len(names) and names[position] == query:
+            return [query]
+        if len(query) < self.min_prefix:
+            return []
+        keys: List[str] = []
+        while position < len(names) and names[position].startswith(query) and len(keys) < self.limit:
+            keys.append(names[position])
+            position += 1
+        return keys
+
+    def lookup(self, locale: str, query: str) -> List[Tuple[str, str]]:
+        """
+        Ищет города по точному совпадению или префиксу названия
+        :param locale: локализация запроса
+        :param query: введенное пользователем название
+        :return: список кортежей (название с географической привязкой, id), пустой при промахе
+        """
+        with self._lock:
+            cities: List[Tuple[str, str]] = self._collect(locale, self._prefixed(locale, normalize(query)))
+            if cities:
+                self.hits += 1
+        return cities
+
+    def suggest(self, locale: str, query: str) -> List[Tuple[str, str]]:
+        """
+        Предлагает города с похожими названиями (опечатки). Сравниваются названия с той же первой буквой
+        и близкой длиной, поэтому поиск не перебирает весь индекс. Для повторно введенного названия, на которое
+        уже предлагались похожие города, предложения не выдаются: такой город ищется через API
+        :param locale: локализация запроса
+        :param query: введенное пользователем название
+        :return: список кортежей (название с географической привязкой, id), пустой, если похожих нет
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        with self._lock:
+            if self._suggested.pop((locale, query), None) is not None:
+                self.misses += 1
+                return []
+            names: List[str] = self._names.get(locale, [])
+            position: int = bisect_left(names, query[0])
+            candidates: List[str] = []
+            while position < len(names) and names[position].startswith(query[0]):
+                if abs(len(names[position]) - len(query)) <= 2:
+                    candidates.append(names[position])
+                position += 1
+            keys: List[str] = difflib.get_close_matches(query, candidates, n=self.limit, cutoff=self.cutoff)
+            cities: List[Tuple[str, str]] = self._collect(locale, keys)
+            if cities:
+                self.suggested += 1
+                self._suggested[(locale, query)] = True
+                if len(self._suggested) > 1000:
+                    self._suggested.popitem(last=False)
+            else:
+                self.misses += 1
+        return cities
+
+    def load(self, path: str) -> int:
+        """
+        Загружает города из файла: по одному объекту json в строке с полями locale, name, caption и destination_id
+        :param path: путь к файлу, отсутствующий файл пропускается
+        :return: количество загруженных городов
+        """
+        if not path or not os.path.exists(path):
+            return 0
+        count: int = 0
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    city: Dict = json.loads(line)
+                    self.add(city['locale'], city['name'], city['caption'], str(city['destination_id']))
+                    count += 1
+        logger.info(f'Загружено городов в локальный индекс: {count}')
+        return count
+
+    def save(self, path: str) -> None:
+        """
+        Сохраняет индекс в файл. Города, уже записанные в файл другими процессами бота, сохраняются
+        :param path: путь к файлу
+        """
+        if not path:
+            return
+        self.load(path)
+        with self._lock:
+            lines: List[str] = [json.dumps({'locale': locale, 'name': key, 'caption': caption,
+                                            'destination_id': destination_id}, ensure_ascii=False)
+                                for (locale, key), cities in self._cities.items()
+                                for destination_id, caption in cities.items()]
+        temp: str = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines))
+        os.replace(temp, path)
+        logger.info(f'Сохранено городов локального индекса: {len(lines)}')
+
+    def stats(self) -> Dict[str, int]:
+        """Возвращает количество ответов из индекса, предложений похожих городов, промахов и названий"""
+        with self._lock:
+            return {'hits': self.hits, 'suggested': self.suggested, 'misses': self.misses,
+                    'size': len(self._cities)}
+
+
+city_index = CityIndex()
@@ -0,0 +1,115 @@
+from typing import Any, Callable, Dict, Optional
+
+from loguru import logger
+from peewee import fn
+from telebot.types import InlineKeyboardMarkup, Message
+
+from botrequests.bot_classes import Session, db
+from botrequests.metrics import metrics
+from botrequests.session_store import session_store
+
+STEPS = ('search_city', 'number_hotels', 'number_guests', 'price_range', 'max_distance', 'dates', 'photos',
+         'number_photos')
+
+
+class Reply:
+    """
+    Класс, реализующий ответ шага диалога. Проверка ввода и подготовка ответа общие для синхронного
+    и асинхронного ботов, а отправляет ответ и вызывает следующий обработчик каждый бот по-своему
+    """
+    __slots__ = ('text', 'markup', 'step', 'follow')
+
+    def __init__(self, text: Optional[str] = None, markup: Optional[InlineKeyboardMarkup] = None,
+                 step: Optional[str] = None, follow: Optional[str] = None):
+        """
+        первичная инициализация класса
+        :param text: текст сообщения пользователю, None - сообщение не отправляется
+        :param markup: клавиатура сообщения
+        :param step: следующий шаг диалога, None - шаг не меняется
+        :param follow: название обработчика, который вызывается после отправки сообщения
+        """
+        self.text: Optional[str] = text
+        self.markup: Optional[InlineKeyboardMarkup] = markup
+        self.step: Optional[str] = step
+        self.follow: Optional[str] = follow
+
+    def __repr__(self) -> str:
+        return f'Reply({self.text!r}, step={self.step!r}, follow={self.follow!r})'
+
+
+def set_step(message: Message, step: str) -> None:
+    """
+    Сохраняет в текущем запросе пользователя шаг диалога, который обработает следующее сообщение чата
+    :param message: сообщение чата
+    :param step: название шага из STEPS, либо пустая строка, если диалог не ожидает ввода
+    """
+    if step and step not in STEPS:
+        raise KeyError(f'Шаг диалога {step} не существует')
+    session_store.set(message.chat.id, 'step', step)
+
+
+def current_step(chat_id) -> str:
+    """Возвращает текущий шаг диалога чата или пустую строку, если диалог не ожидает ввода"""
+    try:
+        return session_store.get(chat_id, 'step') or ''
+    except KeyError:
+        return ''
+
+
+def restore(owns: Optional[Callable[[str], bool]] = None) -> int:
+    """
+    Загружает в память текущие запросы чатов, диалог которых ожидает ввода, одним запросом к базе.
+    Вызывается при запуске бота, чтобы диалоги продолжались после перезапуска
+    :param owns: отбор чатов, обрабатываемых процессом (при запуске в нескольких процессах)
+    :return: количество восстановленных диалогов
+    """
+    latest = Session.select(fn.MAX(Session.id)).group_by(Session.chat_id)
+    with db:
+        rows = [row for row in Session.select().where(Session.id.in_(latest), Session.step != '')
+                if owns is None or owns(row.chat_id)]
+    for row in rows:
+        session_store.remember(row)
+    logger.info(f'Восстановлено диалогов: {len(rows)}')
+    return len(rows)
+
+
+class Conversation:
+    """
+    Класс, реализующий диалог как конечный автомат: текущий шаг хранится в колонке step таблицы Session,
+    обработчик следующего сообщения выбирается по таблице handlers. Синхронный и асинхронный боты используют
+    общие названия шагов со своими таблицами обработчиков
+    """
+
+    def __init__(self, handlers: Dict[str, Callable]):
+        """
+        первичная инициализация класса
+        :param handlers: обработчики шагов (функция или корутина с аргументами message и bot)
+        """
+        unknown = set(handlers) - set(STEPS)
+        if unknown:
+            raise KeyError(f'Шаги диалога {unknown} не существуют')
+        self.handlers: Dict[str, Callable] = handlers
+
+    @staticmethod
+    def is_input(message: Message) -> bool:
+        """Проверяет, что сообщение может быть вводом для шага диалога, а не командой (команды прерывают диалог)"""
+        return not (message.text and message.text.startswith('/'))
+
+    def expects(self, message: Message) -> bool:
+        """Проверяет, ожидает ли диалог чата ввода (команды прерывают диалог)"""
+        if not self.is_input(message):
+            return False
+        return current_step(message.chat.id) in self.handlers
+
+    def handle(self, message: Message, bot) -> Any:
+        """
+        Передает сообщение обработчику текущего шага. Перед вызовом шаг сбрасывается: обработчик
+        сам устанавливает следующий шаг или повторяет текущий при некорректном вводе
+        :return: результат обработчика (для асинхронного бота - корутина)
+        """
+        step: str = current_step(message.chat.id)
+        handler: Callable = self.handlers[step]
+        logger.info(f'message {message.chat.id}: шаг диалога {step}')
+        metrics.rename_trace(step)
+        set_step(message, '')
+        return handler(message, bot)
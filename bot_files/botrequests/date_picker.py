@@ -0,0 +1,90 @@
+import os
+from datetime import date
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from telegram_bot_calendar import DetailedTelegramCalendar
+from telegram_bot_calendar.base import CB_CALENDAR, DAY, NOTHING, SELECT
+
+from botrequests.fanout import to_date
+from botrequests.session_store import session_store
+
+CALENDAR_PREFIX: str = CB_CALENDAR + '_0_'
+
+
+@lru_cache(maxsize=int(os.getenv('CALENDAR_CACHE_SIZE', 1024)))
+def keyboard(locale: str, view: Optional[str] = None, today: Optional[date] = None) -> Tuple[str, str]:
+    """
+    Возвращает клавиатуру календаря. Клавиатура зависит только от локализации и отображаемого периода,
+    поэтому собирается один раз для каждой пары (локализация, месяц или год)
+    :param locale: локализация календаря ('ru', 'en')
+    :param view: данные callback без префикса (действие, шаг и дата), None - начальная клавиатура
+    :param today: текущая дата для начальной клавиатуры
+    :return: клавиатура (строка json) и шаг календаря
+    """
+    calendar = DetailedTelegramCalendar(locale=locale, current_date=today)
+    if view is None:
+        return calendar.build()
+    result, key, step = calendar.process(CALENDAR_PREFIX + view)
+    return key, step
+
+
+class DatePicker:
+    """
+    Класс, обрабатывающий ввод дат заезда-выезда календарем. Выбранная дата заезда до выбора даты выезда
+    хранится в текущем запросе пользователя (колонка check_in при пустой check_out), поэтому она записывается
+    в базу вместе с запросом, удаляется из памяти вместе с ним и восстанавливается после перезапуска бота
+    """
+
+    @staticmethod
+    def process(locale: str, call_data: str) -> Tuple[Optional[date], Optional[str]]:
+        """
+        Обрабатывает нажатие кнопки календаря без создания объекта календаря
+        :param locale: локализация календаря
+        :param call_data: данные callback кнопки
+        :return: выбранная дата либо клавиатура следующего экрана (обе None для пустой кнопки)
+        """
+        view: str = call_data[len(CALENDAR_PREFIX):]
+        params = view.split('_')
+        if params[0] == NOTHING:
+            return None, None
+        if params[0] == SELECT and params[1] == DAY:
+            return date(int(params[2]), int(params[3]), int(params[4])), None
+        return None, keyboard(locale, view)[0]
+
+    @staticmethod
+    def start(locale: str) -> str:
+        """Возвращает начальную клавиатуру календаря для локализации"""
+        return keyboard(locale, today=date.today())[0]
+
+    @staticmethod
+    def check_in(chat_id) -> Optional[date]:
+        """Возвращает выбранную дату заезда текущего запроса чата, либо None, если она еще не выбрана"""
+        current: Dict = session_store.load(chat_id)
+        if not current['check_in'] or current['check_out']:
+            return None
+        return to_date(current['check_in'])
+
+    def choose(self, chat_id, value: date) -> Optional[Tuple[date, date]]:
+        """
+        Запоминает выбранную дату. Первая дата запроса считается датой заезда, вторая - датой выезда.
+        После выбора обеих дат дата заезда сбрасывается: даты записываются в запрос методом save,
+        если они корректны, а иначе пользователь выбирает обе даты заново
+        :param chat_id: id чата
+        :param value: выбранная дата
+        :return: даты заезда и выезда, если выбраны обе, иначе None
+        """
+        check_in: Optional[date] = self.check_in(chat_id)
+        if check_in is None:
+            session_store.update(chat_id, check_in=value, check_out='')
+            return None
+        session_store.set(chat_id, 'check_in', '')
+        return check_in, value
+
+    @staticmethod
+    def save(chat_id, check_in: date, check_out: date) -> None:
+        """Записывает даты заезда и выезда в текущий запрос пользователя одним изменением"""
+        session_store.update(chat_id, check_in=check_in, check_out=check_out)
+
+
+date_picker = DatePicker()
@@ -0,0 +1,123 @@
+import os
+import queue
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from loguru import logger
+from telebot.types import Update
+
+
+def update_chat_id(update: Update) -> Any:
+    """
+    Возвращает id чата, к которому относится обновление telegram
+    :param update: обновление
+    :return: id чата (0, если чат определить не удалось)
+    """
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    return 0
+
+
+class ChatDispatcher:
+    """
+    Класс, распределяющий обработку обновлений между несколькими потоками.
+    Обновления одного чата выполняются строго по очереди и в порядке поступления,
+    обновления разных чатов - параллельно. Общее количество ожидающих обновлений ограничено:
+    при переполнении submit блокируется, пока очередь не освободится
+    """
+
+    def __init__(self, workers: int = int(os.getenv('DISPATCHER_WORKERS', 4)),
+                 max_pending: int = int(os.getenv('DISPATCHER_QUEUE_SIZE', 1000))):
+        """
+        первичная инициализация класса
+        :param workers: количество рабочих потоков
+        :param max_pending: максимальное количество ожидающих обработки обновлений
+        """
+        self.workers: int = workers
+        self.max_pending: int = max_pending
+        self.pending: int = 0
+        self._chats: Dict[Any, Deque[Callable]] = dict()
+        self._ready: queue.Queue = queue.Queue()
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, chat_id: Any, func: Callable[[], Any]) -> None:
+        """
+        Добавляет задачу в очередь чата
+        :param chat_id: id чата
+        :param func: задача
+        """
+        with self._condition:
+            while self.pending >= self.max_pending:
+                self._condition.wait()
+            self.pending += 1
+            chat_queue: Optional[Deque] = self._chats.get(chat_id)
+            if chat_queue is None:
+                self._chats[chat_id] = deque([func])
+                self._ready.put(chat_id)
+            else:
+                chat_queue.append(func)
+
+    def _work(self) -> None:
+        """Рабочий поток: выполняет по одной задаче чата и возвращает чат в конец очереди готовых"""
+        while True:
+            chat_id = self._ready.get()
+            if chat_id is None:
+                break
+            with self._condition:
+                func: Callable = self._chats[chat_id][0]
+            try:
+                func()
+            except Exception as err:
+                logger.exception(f'Ошибка обработки обновления чата {chat_id}: {err}')
+            with self._condition:
+                chat_queue: Deque = self._chats[chat_id]
+                chat_queue.popleft()
+                self.pending -= 1
+                if chat_queue:
+                    self._ready.put(chat_id)
+                else:
+                    del self._chats[chat_id]
+                self._condition.notify_all()
+
+    def start(self) -> None:
+        """Запускает рабочие потоки"""
+        for num in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name=f'dispatcher-{num}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Дожидается выполнения всех задач и останавливает рабочие потоки"""
+        with self._condition:
+            while self.pending:
+                self._condition.wait()
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def dispatch(self, bot) -> None:
+        """
+        Подключает диспетчер к синхронному боту: вместо последовательной обработки
+        каждое обновление ставится в очередь своего чата. Бот должен быть создан с threaded=False
+        :param bot: бот
+        """
+        process_new_updates: Callable = bot.process_new_updates
+
+        def dispatch_updates(updates: List[Update]) -> None:
+            for update in updates:
+                bot.last_update_id = max(bot.last_update_id, update.update_id)
+                self.submit(update_chat_id(update), lambda this_update=update: process_new_updates([this_update]))
+
+        bot.process_new_updates = dispatch_updates
+
+
+dispatcher = ChatDispatcher()
@@ -0,0 +1,140 @@
+import asyncio
+import heapq
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+from loguru import logger
+
+from botrequests.bot_classes import API_KEYS, Request, rapidapi_limiter
+from botrequests.metrics import metrics
+from botrequests.records import HotelSummary
+
+FLEX_SORT_ORDER: str = 'FLEX_PRICE'
+FLEX_DAYS: int = int(os.getenv('FLEX_DAYS', 3))
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('FANOUT_WORKERS', 4)), thread_name_prefix='fanout')
+
+
+def to_date(value: Union[str, date]) -> date:
+    """Возвращает дату из значения колонки таблицы Session (дата или строка 'ГГГГ-ММ-ДД')"""
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+
+def date_variants(query: Dict, spread: int = FLEX_DAYS, today: Optional[date] = None) -> List[Dict]:
+    """
+    Возвращает варианты запроса properties/list со сдвигом дат заезда и выезда на -spread..+spread дней
+    при той же продолжительности проживания. Варианты упорядочены по удаленности от исходных дат
+    (0, -1, +1, -2, ...), варианты с датой заезда в прошлом пропускаются
+    :param query: запрос properties/list
+    :param spread: на сколько дней сдвигать даты в каждую сторону
+    :param today: текущая дата
+    :return: список запросов
+    """
+    check_in: date = to_date(query[API_KEYS['check_in']])
+    check_out: date = to_date(query[API_KEYS['check_out']])
+    today = today or date.today()
+    shifts: List[int] = sorted(range(-spread, spread + 1), key=lambda shift: (abs(shift), shift))
+    return [{**query, API_KEYS['check_in']: check_in + timedelta(days=shift),
+             API_KEYS['check_out']: check_out + timedelta(days=shift)}
+            for shift in shifts if check_in + timedelta(days=shift) >= today]
+
+
+class FanOutSearch:
+    """
+    Класс, реализующий гибкий поиск: несколько вариантов запроса properties/list (со сдвигом дат)
+    выполняются одновременно, результаты объединяются по id отеля. Для каждого отеля остается вариант
+    с минимальной ценой, после каждого завершенного варианта выдаются лучшие limit отелей. Количество
+    вариантов ограничено max_variants и остатком месячной квоты RapidAPI за вычетом quota_reserve,
+    который остается для обычных поисков
+    """
+
+    def __init__(self, variants: List[Dict], limit: int,
+                 max_variants: int = int(os.getenv('FANOUT_MAX_VARIANTS', 7)),
+                 quota_reserve: int = int(os.getenv('FANOUT_QUOTA_RESERVE', 100)),
+                 concurrency: int = int(os.getenv('FANOUT_CONCURRENCY', 4))):
+        """
+        первичная инициализация класса
+        :param variants: варианты запроса в порядке приоритета (лишние варианты отбрасываются с конца)
+        :param limit: сколько лучших отелей выдавать
+        :param max_variants: максимальное количество вариантов на один поиск
+        :param quota_reserve: сколько запросов месячной квоты не расходовать на гибкий поиск
+        :param concurrency: сколько вариантов выполняется одновременно (асинхронный вариант)
+        """
+        budget: int = max_variants
+        remaining: Optional[int] = rapidapi_limiter.quota.remaining()
+        if remaining is not None:
+            budget = max(min(budget, remaining - quota_reserve), 1)
+        self.variants: List[Dict] = variants[:budget]
+        self.skipped: int = len(variants) - len(self.variants)
+        self.limit: int = limit
+        self.concurrency: int = concurrency
+        self.completed: int = 0
+        self._best: Dict[str, Tuple[HotelSummary, Dict]] = dict()
+        if self.skipped:
+            logger.info(f'Гибкий поиск: пропущено вариантов из-за квоты: {self.skipped}')
+
+    @property
+    def total(self) -> int:
+        """Количество выполняемых вариантов"""
+        return len(self.variants)
+
+    def merge(self, variant: Dict, hotels: List[HotelSummary]) -> List[Tuple[HotelSummary, Dict]]:
+        """
+        Добавляет результаты варианта: для каждого отеля сохраняется вариант с минимальной ценой
+        :param variant: запрос варианта
+        :param hotels: найденные по нему отели
+        :return: лучшие limit отелей (по цене) с запросами вариантов, в которых найдена эта цена
+        """
+        self.completed += 1
+        for hotel in hotels:
+            if hotel.price_value is None:
+                continue
+            best: Optional[Tuple[HotelSummary, Dict]] = self._best.get(hotel.hotel_id)
+            if best is None or hotel.price_value < best[0].price_value:
+                self._best[hotel.hotel_id] = (hotel, variant)
+        return heapq.nsmallest(self.limit, self._best.values(), key=lambda item: item[0].price_value)
+
+    @staticmethod
+    def request(variant: Dict) -> Request:
+        """Возвращает запрос варианта (с сортировкой по цене для API)"""
+        return Request({**variant, API_KEYS['sort_order']: 'PRICE'})
+
+    def search(self) -> Iterator[List[Tuple[HotelSummary, Dict]]]:
+        """Генератор промежуточных результатов: лучшие отели после каждого завершенного варианта"""
+        with metrics.span('fanout', variants=str(self.total)):
+            futures: Dict[Future, Dict] = {_executor.submit(self.request(variant).get_hotels): variant
+                                           for variant in self.variants}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        hotels: List[HotelSummary] = future.result()
+                    except Exception as err:
+                        logger.exception(f'Ошибка варианта гибкого поиска: {err}')
+                        hotels = []
+                    yield self.merge(futures[future], hotels)
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    async def asearch(self) -> AsyncIterator[List[Tuple[HotelSummary, Dict]]]:
+        """Асинхронный вариант search: одновременно выполняется не больше concurrency вариантов"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(variant: Dict) -> Tuple[Dict, List[HotelSummary]]:
+            async with semaphore:
+                try:
+                    return variant, await self.request(variant).aget_hotels()
+                except Exception as err:
+                    logger.exception(f'Ошибка варианта гибкого поиска: {err}')
+                    return variant, []
+
+        with metrics.span('fanout', variants=str(self.total)):
+            tasks: List[asyncio.Task] = [asyncio.ensure_future(run(variant)) for variant in self.variants]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield self.merge(*await task)
+            finally:
+                for task in tasks:
+                    task.cancel()
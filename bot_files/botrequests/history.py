@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple, Union
+
+import peewee
+from loguru import logger
+
+from botrequests.bot_classes import HistoryQuery, db
+from botrequests.metrics import metrics
+from botrequests.records import HistoryEntry
+
+COMMANDS: Dict[str, str] = {'PRICE': '/lowprice',
+                            'PRICE_HIGHEST_FIRST': '/highprice',
+                            'DISTANCE_FROM_LANDMARK': '/bestdeal',
+                            'FLEX_PRICE': '/flexprice'}
+
+
+def to_cursor(entry: HistoryEntry) -> str:
+    """
+    Кодирует позицию записи журнала для callback data кнопок перелистывания: время записи (целое число
+    микросекунд) и id записи, который различает записи с одинаковым временем
+    """
+    microseconds: int = int(entry.created_at.timestamp()) * 1000000 + entry.created_at.microsecond
+    return f'{microseconds}-{entry.entry_id}'
+
+
+def from_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Восстанавливает время и id записи журнала из callback data"""
+    microseconds, entry_id = map(int, cursor.split('-'))
+    return datetime.fromtimestamp(microseconds // 1000000).replace(microsecond=microseconds % 1000000), entry_id
+
+
+class HistoryLog:
+    """
+    Класс, реализующий журнал завершенных поисков в таблице HistoryQuery.
+    Записи только добавляются: они накапливаются в памяти и записываются в базу пакетами
+    (insert_many) в фоновом потоке и перед чтением. Чтение производится страницами по индексу
+    (chat_id, created_at) от заданной записи (позиция записи - пара (created_at, id), так как время
+    у записей может совпадать), поэтому время чтения не зависит от размера журнала
+    """
+
+    def __init__(self, flush_interval: float = float(os.getenv('HISTORY_FLUSH_INTERVAL', 5.0)),
+                 page_size: int = int(os.getenv('HISTORY_PAGE_SIZE', 5)),
+                 batch_size: int = int(os.getenv('HISTORY_BATCH_SIZE', 100))):
+        """
+        первичная инициализация класса
+        :param flush_interval: интервал (в секундах) записи накопленных записей в базу
+        :param page_size: количество записей на одной странице /history
+        :param batch_size: максимальное количество записей в одном insert
+        """
+        self.flush_interval: float = flush_interval
+        self.page_size: int = page_size
+        self.batch_size: int = batch_size
+        self._pending: List[Dict] = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def append(self, chat_id, sort_order: str, city: str, check_in: Union[str, date], check_out: Union[str, date],
+               hotels: List[str]) -> None:
+        """
+        Добавляет в журнал завершенный поиск
+        :param chat_id: id чата
+        :param sort_order: порядок сортировки запроса (определяет команду поиска)
+        :param city: город, введенный пользователем
+        :param check_in: дата заезда
+        :param check_out: дата выезда
+        :param hotels: названия показанных отелей
+        """
+        saved_query: str = json.dumps({'command': COMMANDS.get(sort_order, sort_order), 'city': city,
+                                       'check_in': str(check_in), 'check_out': str(check_out), 'hotels': hotels},
+                                      ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._pending.append({'chat_id': str(chat_id), 'saved_query': saved_query, 'created_at': datetime.now()})
+
+    def flush(self) -> int:
+        """
+        Записывает накопленные записи в базу в одной транзакции. Если запись не удалась,
+        записи возвращаются в очередь, а исключение передается вызывающему коду
+        :return: количество записанных записей
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            try:
+                with metrics.span('history_query', operation='flush'), db:
+                    for start in range(0, len(pending), self.batch_size):
+                        HistoryQuery.insert_many(pending[start:start + self.batch_size]).execute()
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = pending
+                raise
+            logger.info(f'Записано в журнал поисков: {len(pending)}')
+        return len(pending)
+
+    def page(self, chat_id, before: Optional[Tuple[datetime, int]] = None,
+             after: Optional[Tuple[datetime, int]] = None) -> Tuple[List[HistoryEntry], bool]:
+        """
+        Возвращает страницу журнала чата (записи от новых к старым)
+        :param chat_id: id чата
+        :param before: вернуть записи старее этой позиции (время, id) (следующая страница)
+        :param after: вернуть записи новее этой позиции (время, id) (предыдущая страница)
+        :return: записи страницы и признак того, что в направлении перелистывания есть еще записи
+        """
+        self.flush()
+        position = peewee.Tuple(HistoryQuery.created_at, HistoryQuery.id)
+        query = HistoryQuery.select(HistoryQuery.id, HistoryQuery.saved_query, HistoryQuery.created_at) \
+            .where(HistoryQuery.chat_id == str(chat_id))
+        if after is not None:
+            query = query.where(position > peewee.Tuple(HistoryQuery.created_at.to_value(after[0]), after[1])) \
+                .order_by(HistoryQuery.created_at.asc(), HistoryQuery.id.asc())
+        else:
+            if before is not None:
+                query = query.where(position < peewee.Tuple(HistoryQuery.created_at.to_value(before[0]), before[1]))
+            query = query.order_by(HistoryQuery.created_at.desc(), HistoryQuery.id.desc())
+        with metrics.span('history_query', operation='page'), db:
+            rows: List[HistoryQuery] = list(query.limit(self.page_size + 1))
+        has_more: bool = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if after is not None:
+            rows.reverse()
+        return [HistoryEntry(entry_id=row.id, created_at=row.created_at, **json.loads(row.saved_query))
+                for row in rows], has_more
+
+    def _run(self) -> None:
+        """Фоновая запись журнала в базу"""
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as err:
+                logger.exception(f'Ошибка записи журнала поисков в базу: {err}')
+
+    def start(self) -> None:
+        """Запускает фоновый поток записи журнала в базу"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='history-flush', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Останавливает фоновый поток и записывает оставшиеся записи в базу"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+history_log = HistoryLog()
@@ -0,0 +1,177 @@
+import math
+import os
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+from loguru import logger
+
+from botrequests.metrics import metrics
+from botrequests.records import HotelSummary
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CityHotels:
+    """Класс, реализующий отели одного города: расстояния до центра в массиве и позиции отелей в нем"""
+
+    def __init__(self):
+        """первичная инициализация класса"""
+        self.center_distances: array = array('d')
+        self.positions: Dict[str, int] = dict()
+
+    def add(self, hotel_id: str, distance: Optional[float]) -> bool:
+        """
+        Добавляет отель или обновляет его расстояние до центра
+        :return: True, если отель добавлен или его расстояние изменилось
+        """
+        distance = math.nan if distance is None else distance
+        position: Optional[int] = self.positions.get(hotel_id)
+        if position is not None:
+            if self.center_distances[position] == distance or math.isnan(distance):
+                return False
+            self.center_distances[position] = distance
+            return True
+        self.positions[hotel_id] = len(self.center_distances)
+        self.center_distances.append(distance)
+        return True
+
+
+class HotelIndex:
+    """
+    Класс, реализующий индекс отелей по городам: расстояние до центра каждого отеля из результатов поиска.
+    Индекс пополняется каждой страницей properties/list, новые и изменившиеся отели накапливаются в памяти
+    и записываются в таблицу HotelLocation (вместе с координатами, названием и звездами) пакетами в фоновом
+    потоке, как журнал поисков. Расстояния отелей города загружаются из базы при первом обращении
+    """
+
+    def __init__(self, model, database,
+                 flush_interval: float = float(os.getenv('HOTEL_INDEX_FLUSH_INTERVAL', 5.0)),
+                 batch_size: int = int(os.getenv('HOTEL_INDEX_BATCH_SIZE', 100))):
+        """
+        первичная инициализация класса
+        :param model: модель peewee таблицы HotelLocation
+        :param database: база peewee
+        :param flush_interval: интервал (в секундах) записи новых отелей в базу
+        :param batch_size: максимальное количество отелей в одном insert
+        """
+        self.model = model
+        self.database = database
+        self.flush_interval: float = flush_interval
+        self.batch_size: int = batch_size
+        self._cities: Dict[str, CityHotels] = dict()
+        self._pending: Dict[str, Dict] = dict()
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _city(self, city_id: str) -> CityHotels:
+        """Возвращает отели города, при первом обращении загружая их из базы"""
+        city: Optional[CityHotels] = self._cities.get(city_id)
+        if city is None:
+            city = self._cities[city_id] = CityHotels()
+            with metrics.span('hotel_index_query', operation='load'), self.database:
+                rows = list(self.model.select(self.model.hotel_id, self.model.distance)
+                            .where(self.model.city_id == city_id).tuples())
+            for hotel_id, distance in rows:
+                city.add(hotel_id, distance)
+        return city
+
+    def add(self, city_id: str, hotels: Iterable[HotelSummary]) -> int:
+        """
+        Добавляет в индекс отели страницы результатов поиска (отели без координат, которые хранит
+        таблица HotelLocation, пропускаются)
+        :param city_id: id города (destinationId)
+        :param hotels: записи HotelSummary
+        :return: количество новых или изменившихся отелей
+        """
+        changed: int = 0
+        with self._lock:
+            city: CityHotels = self._city(city_id)
+            for hotel in hotels:
+                if hotel.latitude is None or hotel.longitude is None:
+                    continue
+                if city.add(hotel.hotel_id, hotel.distance_value):
+                    changed += 1
+                    position: int = city.positions[hotel.hotel_id]
+                    distance: float = city.center_distances[position]
+                    self._pending[hotel.hotel_id] = {'hotel_id': hotel.hotel_id, 'city_id': city_id,
+                                                     'name': hotel.name, 'star_rating': hotel.star_rating,
+                                                     'latitude': hotel.latitude, 'longitude': hotel.longitude,
+                                                     'distance': None if math.isnan(distance) else distance}
+        return changed
+
+    def within(self, city_id: str, distance_km: float) -> int:
+        """Возвращает количество известных отелей города не дальше distance_km от центра"""
+        with self._lock:
+            center_distances: array = self._city(city_id).center_distances
+            if numpy is not None:
+                return int(numpy.count_nonzero(numpy.frombuffer(center_distances, dtype=float) <= distance_km))
+            return sum(1 for distance in center_distances if distance <= distance_km)
+
+    def pages_within(self, city_id: str, distance_km: float, page_size: int) -> int:
+        """
+        Оценивает снизу, сколько страниц properties/list, отсортированных по расстоянию, нужно загрузить,
+        чтобы дойти до отелей дальше distance_km. Индекс знает только отели из прошлых поисков, поэтому
+        в API отелей не дальше distance_km не меньше, чем в индексе, но может быть больше
+        :param city_id: id города
+        :param distance_km: максимальное расстояние до центра
+        :param page_size: количество отелей на странице
+        :return: количество страниц (не меньше 1)
+        """
+        return self.within(city_id, distance_km) // page_size + 1
+
+    def flush(self) -> int:
+        """
+        Записывает новые и изменившиеся отели в базу в одной транзакции. Если запись не удалась, отели
+        снова помечаются для записи (кроме изменившихся за это время), а исключение передается вызывающему коду
+        :return: количество записанных отелей
+        """
+        with self._lock:
+            changed, self._pending = self._pending, dict()
+        pending: List[Dict] = list(changed.values())
+        if pending:
+            try:
+                with metrics.span('hotel_index_query', operation='flush'), self.database:
+                    for start in range(0, len(pending), self.batch_size):
+                        self.model.insert_many(pending[start:start + self.batch_size]).on_conflict_replace().execute()
+            except Exception:
+                with self._lock:
+                    for hotel_id, row in changed.items():
+                        self._pending.setdefault(hotel_id, row)
+                raise
+            logger.info(f'Записано в индекс отелей: {len(pending)}')
+        return len(pending)
+
+    def _run(self) -> None:
+        """Фоновая запись индекса в базу"""
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as err:
+                logger.exception(f'Ошибка записи индекса отелей в базу: {err}')
+
+    def start(self) -> None:
+        """Запускает фоновый поток записи индекса в базу"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='hotel-index-flush', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Останавливает фоновый поток и записывает оставшиеся отели в базу"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        """Возвращает количество городов и отелей в памяти и ожидающих записи в базу"""
+        with self._lock:
+            return {'cities': len(self._cities), 'hotels': sum(len(city.positions) for city in self._cities.values()),
+                    'pending': len(self._pending)}
+
@@ -0,0 +1,377 @@
+import bisect
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+from telebot import asyncio_handler_backends, handler_backends
+
+# границы интервалов гистограмм задержек в секундах
+LATENCY_BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOG_FORMAT: str = ('{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {extra[trace_id]} | '
+                   '{name}:{function}:{line} - {message}')
+
+
+class Histogram:
+    """Класс, реализующий гистограмму с фиксированными границами интервалов (как histogram в Prometheus)"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """
+        первичная инициализация класса
+        :param buckets: верхние границы интервалов по возрастанию
+        """
+        self.buckets: Tuple[float, ...] = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.total: float = 0.0
+        self.count: int = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """Учитывает одно значение"""
+        index: int = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """Возвращает количество значений в интервалах, сумму и количество значений"""
+        with self._lock:
+            return list(self.counts), self.total, self.count
+
+    def quantile(self, share: float) -> float:
+        """Возвращает оценку квантиля share (от 0 до 1): верхнюю границу интервала, в который он попадает"""
+        counts, _, count = self.snapshot()
+        rank: float = share * count
+        seen: int = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Trace:
+    """Класс, реализующий трассировку обработки одного обновления telegram: id корреляции и интервалы"""
+    __slots__ = ('trace_id', 'name', 'started', 'spans', 'token')
+
+    def __init__(self, name: str):
+        """
+        первичная инициализация класса
+        :param name: название шага (команда, шаг диалога или тип кнопки)
+        """
+        self.trace_id: str = uuid.uuid4().hex[:12]
+        self.name: str = name
+        self.started: float = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+        self.token = None
+
+    def as_dict(self, duration: float) -> Dict[str, Any]:
+        """Возвращает трассировку в виде словаря для /traces и журнала (время в миллисекундах)"""
+        return {'trace_id': self.trace_id, 'step': self.name, 'ms': round(duration * 1000, 2),
+                'spans': [{'name': name, 'start_ms': round(start * 1000, 2), 'ms': round(spent * 1000, 2)}
+                          for name, start, spent in self.spans]}
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+
+
+def trace_id() -> str:
+    """Возвращает id корреляции обрабатываемого обновления или '-' вне обработки обновления"""
+    trace: Optional[Trace] = current_trace.get()
+    return '-' if trace is None else trace.trace_id
+
+
+class Metrics:
+    """
+    Класс, реализующий метрики бота: счетчики и гистограммы задержек с метками, показатели компонентов
+    (очереди отправки, ограничителя RapidAPI, кэшей) и трассировку обработки обновлений.
+    Часть трассировок (trace_sample_rate) сохраняется и выводится в журнал
+    """
+
+    def __init__(self, trace_sample_rate: float = float(os.getenv('TRACE_SAMPLE_RATE', 0.01)),
+                 traces_kept: int = int(os.getenv('TRACES_KEPT', 100))):
+        """
+        первичная инициализация класса
+        :param trace_sample_rate: доля сохраняемых трассировок (от 0 до 1)
+        :param traces_kept: количество хранимых последних трассировок
+        """
+        self.trace_sample_rate: float = trace_sample_rate
+        self.traces: Deque[Dict] = deque(maxlen=traces_kept)
+        self._counters: Dict[Tuple[str, Tuple], float] = dict()
+        self._histograms: Dict[Tuple[str, Tuple], Histogram] = dict()
+        self._gauges: Dict[str, Callable[[], Dict[str, Any]]] = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Увеличивает счетчик name с метками labels"""
+        key: Tuple[str, Tuple] = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Учитывает значение в гистограмме name с метками labels"""
+        key: Tuple[str, Tuple] = (name, tuple(sorted(labels.items())))
+        histogram: Optional[Histogram] = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        """
+        Измеряет время выполнения блока: учитывает его в гистограмме {name}_seconds
+        и добавляет интервал в трассировку обрабатываемого обновления
+        """
+        started: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            spent: float = time.perf_counter() - started
+            self.observe(f'{name}_seconds', spent, **labels)
+            trace: Optional[Trace] = current_trace.get()
+            if trace is not None:
+                title: str = ' '.join([name] + [str(value) for value in labels.values()])
+                trace.spans.append((title, started - trace.started, spent))
+
+    def register_gauges(self, name: str, func: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Регистрирует показатели компонента, которые считываются при выводе метрик
+        :param name: название компонента
+        :param func: функция, возвращающая словарь числовых показателей (например, SendQueue.stats)
+        """
+        self._gauges[name] = func
+
+    def start_trace(self, name: str) -> Trace:
+        """Начинает трассировку обновления в текущем контексте (потоке или задаче asyncio)"""
+        trace = Trace(name)
+        trace.token = current_trace.set(trace)
+        return trace
+
+    def finish_trace(self, trace: Trace, error: Optional[Exception] = None) -> None:
+        """Завершает трассировку: учитывает время обработки шага и сохраняет часть трассировок"""
+        duration: float = time.perf_counter() - trace.started
+        current_trace.reset(trace.token)
+        self.observe('bot_update_seconds', duration, step=trace.name)
+        if error is not None:
+            self.inc('bot_update_errors_total', step=trace.name)
+        if random.random() < self.trace_sample_rate:
+            result: Dict = trace.as_dict(duration)
+            self.traces.append(result)
+            logger.bind(trace_id=trace.trace_id).info(f'trace {json.dumps(result, ensure_ascii=False)}')
+
+    @staticmethod
+    def rename_trace(name: str) -> None:
+        """Уточняет название шага обрабатываемого обновления (например, шагом диалога)"""
+        trace: Optional[Trace] = current_trace.get()
+        if trace is not None:
+            trace.name = name
+
+    @staticmethod
+    def _labels(labels: Tuple, extra: str = '') -> str:
+        """Форматирует метки в виде {key="value",...}"""
+        items: List[str] = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            items.append(extra)
+        return '{' + ','.join(items) + '}' if items else ''
+
+    def prometheus(self) -> str:
+        """Возвращает метрики в текстовом формате Prometheus"""
+        lines: List[str] = []
+        with self._lock:
+            counters: List = sorted(self._counters.items())
+            histograms: List = sorted(self._histograms.items(), key=lambda item: item[0])
+        for (name, labels), value in counters:
+            lines.append(f'hotelbot_{name}{self._labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            counts, total, count = histogram.snapshot()
+            seen: int = 0
+            for bound, bucket_count in zip(histogram.buckets + (float('inf'),), counts):
+                seen += bucket_count
+                bound_label: str = 'le="{}"'.format('+Inf' if bound == float('inf') else bound)
+                lines.append(f'hotelbot_{name}_bucket{self._labels(labels, bound_label)} {seen}')
+            lines.append(f'hotelbot_{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'hotelbot_{name}_count{self._labels(labels)} {count}')
+        for component, values in self.gauges().items():
+            for key, value in values.items():
+                lines.append(f'hotelbot_{component}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def gauges(self) -> Dict[str, Dict[str, float]]:
+        """Считывает числовые показатели зарегистрированных компонентов"""
+        result: Dict[str, Dict[str, float]] = dict()
+        for component, func in list(self._gauges.items()):
+            try:
+                result[component] = {key: value for key, value in func().items() if isinstance(value, (int, float))}
+            except Exception as err:
+                logger.info(f'Не удалось получить показатели {component}: {err}')
+        return result
+
+    def report(self) -> str:
+        """Возвращает краткий отчет для команды администратора: задержки p50/p95, счетчики и показатели"""
+        lines: List[str] = []
+        with self._lock:
+            histograms: List = sorted(self._histograms.items(), key=lambda item: item[0])
+            counters: List = sorted(self._counters.items())
+        for (name, labels), histogram in histograms:
+            title: str = ' '.join([name.replace('_seconds', '')] + [str(value) for _, value in labels])
+            lines.append(f'{title}: n={histogram.count}, p50≤{histogram.quantile(0.5) * 1000:g} мс, '
+                         f'p95≤{histogram.quantile(0.95) * 1000:g} мс')
+        for (name, labels), value in counters:
+            lines.append(' '.join([name] + [str(value) for _, value in labels]) + f': {value:g}')
+        for component, values in self.gauges().items():
+            lines.append(f'{component}: ' + ', '.join(f'{key}={value:g}' for key, value in values.items()))
+        return '\n'.join(lines) or 'Метрик пока нет'
+
+
+def update_step(update) -> str:
+    """Возвращает начальное название шага для обновления: команду, 'text' или тип нажатой кнопки"""
+    data: Optional[str] = getattr(update, 'data', None)
+    if data is not None:
+        return 'calendar' if data.startswith('cbcal') else 'button ' + data.rsplit('.', 1)[-1]
+    text: str = getattr(update, 'text', None) or ''
+    return text.split()[0].split('@')[0] if text.startswith('/') else 'text'
+
+
+class TraceMiddleware(handler_backends.BaseMiddleware):
+    """Промежуточный обработчик telebot: трассировка и время обработки каждого сообщения и нажатия кнопки"""
+
+    def __init__(self, registry: 'Metrics'):
+        """
+        первичная инициализация класса
+        :param registry: метрики
+        """
+        super().__init__()
+        self.registry: Metrics = registry
+        self.update_types: List[str] = ['message', 'callback_query']
+
+    def pre_process(self, message, data: Dict) -> None:
+        data['trace'] = self.registry.start_trace(update_step(message))
+
+    def post_process(self, message, data: Dict, exception: Optional[Exception]) -> None:
+        self.registry.finish_trace(data['trace'], exception)
+
+
+class AsyncTraceMiddleware(asyncio_handler_backends.BaseMiddleware):
+    """Асинхронный вариант TraceMiddleware для AsyncTeleBot"""
+
+    def __init__(self, registry: 'Metrics'):
+        """
+        первичная инициализация класса
+        :param registry: метрики
+        """
+        super().__init__()
+        self.registry: Metrics = registry
+        self.update_types: List[str] = ['message', 'callback_query']
+
+    async def pre_process(self, message, data: Dict) -> None:
+        data['trace'] = self.registry.start_trace(update_step(message))
+
+    async def post_process(self, message, data: Dict, exception: Optional[Exception]) -> None:
+        self.registry.finish_trace(data['trace'], exception)
+
+
+class MetricsServer:
+    """
+    Класс, реализующий локальный http-сервер метрик: /metrics - метрики в формате Prometheus,
+    /traces - последние сохраненные трассировки в json
+    """
+
+    def __init__(self, registry: 'Metrics', host: str = os.getenv('METRICS_HOST', '127.0.0.1'),
+                 port: int = int(os.getenv('METRICS_PORT', 9108))):
+        """
+        первичная инициализация класса
+        :param registry: метрики
+        :param host: адрес, на котором принимаются запросы
+        :param port: порт (0 - любой свободный)
+        """
+        self.registry: Metrics = registry
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """Возвращает порт, на котором запущен сервер"""
+        return self.server.server_address[1]
+
+    def _handler(self):
+        """Создает класс обработчика http-запросов, связанный с сервером"""
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """Обработчик запросов метрик"""
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = registry.prometheus().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/traces':
+                    body, content_type = json.dumps(list(registry.traces), ensure_ascii=False).encode(), \
+                                         'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return MetricsHandler
+
+    def start(self) -> None:
+        """Запускает сервер в фоновом потоке"""
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info(f'Сервер метрик запущен на порту {self.port}')
+
+    def stop(self) -> None:
+        """Останавливает сервер"""
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def setup_logging(path: str, level: str = os.getenv('LOG_LEVEL', 'INFO'),
+                  sample_rate: float = float(os.getenv('LOG_SAMPLE_RATE', 1.0)),
+                  enqueue: bool = os.getenv('LOG_ENQUEUE', '1') == '1') -> None:
+    """
+    Настраивает журнал: вывод в консоль и файл path с id корреляции обновления в каждой строке.
+    Сообщения уровня ниже WARNING можно прореживать, а запись выполнять в фоновом потоке,
+    чтобы журнал не задерживал обработчики
+    :param path: файл журнала
+    :param level: минимальный уровень сообщений
+    :param sample_rate: доля записываемых сообщений уровня ниже WARNING (от 0 до 1)
+    :param enqueue: записывать журнал через очередь в фоновом потоке
+    """
+
+    def sampled(record: Dict) -> bool:
+        return sample_rate >= 1 or record['level'].no >= 30 or random.random() < sample_rate
+
+    def add_trace_id(record: Dict) -> None:
+        if record['extra'].get('trace_id', '-') == '-':
+            record['extra']['trace_id'] = trace_id()
+
+    logger.remove()
+    logger.configure(extra={'trace_id': '-'}, patcher=add_trace_id)
+    logger.add(sys.stderr, level=level, format=LOG_FORMAT, filter=sampled, enqueue=enqueue)
+    logger.add(path, rotation="50 MB", encoding='utf-8', level=level, format=LOG_FORMAT, filter=sampled,
+               enqueue=enqueue)
+
+
+metrics = Metrics()
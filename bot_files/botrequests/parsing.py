@@ -0,0 +1,107 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Union
+
+from botrequests.records import HotelDetails, HotelSummary
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DISTANCE_PATTERN = re.compile(r'(\d+(?:[.,]\d+)?)')
+MILE_KM: float = 1.609344
+
+
+def loads(raw: Union[bytes, str]) -> Any:
+    """
+    Разбирает json из байтов ответа без предварительного декодирования в строку.
+    Если установлен orjson, используется он
+    :param raw: тело ответа
+    :return: разобранный json
+    """
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def to_float(value: Any) -> Optional[float]:
+    """Возвращает число или None, если значение не является числом"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_km(distance: str) -> Optional[float]:
+    """
+    Переводит расстояние в виде строки API ('0.6 miles', '1,2 км') в километры
+    :param distance: расстояние в виде строки
+    :return: расстояние в километрах или None, если число не найдено
+    """
+    found = DISTANCE_PATTERN.search(distance or '')
+    if found is None:
+        return None
+    value: float = float(found.group(1).replace(',', '.'))
+    return value * MILE_KM if 'mile' in distance else value
+
+
+def parse_hotels(data: Dict) -> List[HotelSummary]:
+    """
+    Выбирает из ответа properties/list только нужные поля отелей за один проход
+    :param data: ответ API
+    :return: список записей HotelSummary
+    """
+    results = data['data']['body']['searchResults']['results']
+    hotels: List[HotelSummary] = []
+    for hotel in results:
+        price: Dict = (hotel.get('ratePlan') or {}).get('price') or {}
+        landmarks: List = hotel.get('landmarks') or [{}]
+        distance: str = landmarks[0].get('distance', '')
+        coordinate: Dict = hotel.get('coordinate') or {}
+        hotels.append(HotelSummary(hotel_id=str(hotel.get('id')),
+                                   name=hotel.get('name'),
+                                   star_rating=int(hotel.get('starRating') or 0),
+                                   address=(hotel.get('address') or {}).get('streetAddress'),
+                                   price=str(price.get('current')),
+                                   price_value=to_float(price.get('exactCurrent')),
+                                   distance=distance,
+                                   distance_value=to_km(distance),
+                                   latitude=to_float(coordinate.get('lat')),
+                                   longitude=to_float(coordinate.get('lon'))))
+    return hotels
+
+
+def parse_hotel_details(data: Dict) -> HotelDetails:
+    """
+    Выбирает из ответа properties/get-details только нужные поля за один проход по разделам описания
+    :param data: ответ API
+    :return: запись HotelDetails
+    """
+    body: Dict = data['data']['body']
+    description: Dict = body['propertyDescription']
+    coordinates: Dict = body['pdpHeader']['hotelLocation']['coordinates']
+    featured_price: Dict = description.get('featuredPrice') or {}
+
+    overview_titles: List[str] = []
+    overview: List[str] = []
+    around_titles: List[str] = []
+    around: List[str] = []
+    for section in body['overview']['overviewSections']:
+        section_type: str = section.get('type')
+        if section_type == 'HOTEL_FEATURE':
+            overview_titles.append(section.get('title'))
+            overview.extend(section.get('content') or [])
+        elif section_type == 'LOCATION_SECTION':
+            around_titles.append(section.get('title'))
+            around.extend(section.get('content') or [])
+
+    return HotelDetails(name=description.get('name'),
+                        address=(description.get('address') or {}).get('fullAddress'),
+                        map_url=(description.get('mapWidget') or {}).get('staticMapUrl', ''),
+                        latitude=coordinates.get('latitude'),
+                        longitude=coordinates.get('longitude'),
+                        overview_titles=overview_titles, overview=overview,
+                        around_titles=around_titles, around=around,
+                        price=str((featured_price.get('currentPrice') or {}).get('formatted')),
+                        price_info=str(featured_price.get('priceInfo', '')))
@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from loguru import logger
+
+from botrequests.bot_classes import API_KEYS, Request, details_cache
+from botrequests.records import HotelSummary
+
+
+class Prefetcher:
+    """
+    Класс, реализующий упреждающую загрузку информации и списков фотографий для первых top_k отелей
+    из результатов поиска. Загруженные данные попадают в кэш details_cache и используются
+    get_hotel_info и get_hotel_pics. Количество запросов к API ограничено бюджетом на период
+    """
+
+    def __init__(self, top_k: int = int(os.getenv('PREFETCH_TOP_K', 3)),
+                 workers: int = int(os.getenv('PREFETCH_WORKERS', 4)),
+                 budget: int = int(os.getenv('PREFETCH_BUDGET', 500)),
+                 period: float = float(os.getenv('PREFETCH_BUDGET_PERIOD', 86400))):
+        """
+        первичная инициализация класса
+        :param top_k: количество отелей, для которых загружаются данные (0 - загрузка отключена)
+        :param workers: количество потоков загрузки
+        :param budget: максимальное количество запросов к API за период
+        :param period: период бюджета в секундах
+        """
+        self.top_k: int = top_k
+        self.budget: int = budget
+        self.period: float = period
+        self.spent: int = 0
+        self._period_start: float = time.time()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+
+    def take(self, requests_number: int) -> bool:
+        """
+        Списывает запросы из бюджета текущего периода
+        :param requests_number: количество запросов
+        :return: True, если бюджета достаточно
+        """
+        with self._lock:
+            if time.time() - self._period_start >= self.period:
+                self._period_start = time.time()
+                self.spent = 0
+            if self.spent + requests_number > self.budget:
+                return False
+            self.spent += requests_number
+            return True
+
+    @staticmethod
+    def fetch(func: Callable[[], Any], hotel_id: str) -> None:
+        """Выполняет загрузку данных одного отеля в кэш"""
+        try:
+            func()
+        except Exception as err:
+            logger.info(f'Ошибка упреждающей загрузки отеля {hotel_id}: {err}')
+
+    def prefetch(self, hotels: List[HotelSummary], info_request: Dict) -> int:
+        """
+        Запускает фоновую загрузку для первых top_k отелей. Данные, которые уже есть в кэше details_cache,
+        не загружаются, и из бюджета списываются только отправляемые запросы
+        :param hotels: список записей HotelSummary
+        :param info_request: запрос информации об отеле без id отеля (как в search_hotel_info)
+        :return: количество отелей, поставленных в загрузку
+        """
+        scheduled: int = 0
+        for hotel in hotels[:self.top_k]:
+            hotel_id: str = hotel.hotel_id
+            info = Request({**info_request, API_KEYS['hotel_id']: hotel_id})
+            pics = Request({API_KEYS['hotel_id']: hotel_id})
+            loads: List[Callable[[], Any]] = [load for load, key in ((info.get_hotel_info, info.hotel_info_key()),
+                                                                     (pics.get_hotel_pics, pics.hotel_pics_key()))
+                                              if key not in details_cache]
+            if not loads:
+                continue
+            if not self.take(len(loads)):
+                logger.info('Бюджет упреждающей загрузки исчерпан')
+                break
+            for load in loads:
+                self._executor.submit(self.fetch, load, hotel_id)
+            scheduled += 1
+        return scheduled
+
+    def stop(self) -> None:
+        """Дожидается завершения загрузок"""
+        self._executor.shutdown(wait=True)
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,236 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+class TokenBucket:
+    """
+    Класс, реализующий ограничитель частоты запросов «ведро с токенами»: токены пополняются со скоростью rate
+    в секунду до capacity. Токены можно занять заранее: reserve списывает их сразу и возвращает время,
+    которое нужно подождать до их появления, поэтому ожидающие обслуживаются в порядке очереди
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        первичная инициализация класса
+        :param rate: скорость пополнения (токенов в секунду), 0 - без ограничения
+        :param capacity: максимальное количество накопленных токенов (допустимый всплеск)
+        """
+        self.rate: float = rate
+        self.capacity: float = max(capacity, 1)
+        self._tokens: float = self.capacity
+        self._updated: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        Списывает tokens токенов
+        :param tokens: количество токенов
+        :return: время в секундах, через которое токены будут доступны (0 - сразу)
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now: float = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def try_reserve(self, tokens: float = 1) -> float:
+        """
+        Списывает tokens токенов, только если они уже есть
+        :param tokens: количество токенов
+        :return: 0, если токены списаны, иначе время в секундах до их появления (токены не списываются)
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now: float = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def share(self, parts: int) -> None:
+        """Уменьшает скорость и всплеск в parts раз, когда ограничение делится между parts процессами"""
+        with self._lock:
+            self.rate /= parts
+            self.capacity = max(self.capacity / parts, 1)
+            self._tokens = min(self._tokens, self.capacity)
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Ожидает появления tokens токенов
+        :return: время ожидания в секундах
+        """
+        delay: float = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class KeyedTokenBuckets:
+    """Класс, реализующий отдельные TokenBucket для каждого ключа (например, чата) с вытеснением давно не используемых"""
+
+    def __init__(self, rate: float, capacity: float, maxsize: int = 10000):
+        """
+        первичная инициализация класса
+        :param rate: скорость пополнения для одного ключа (токенов в секунду), 0 - без ограничения
+        :param capacity: допустимый всплеск для одного ключа
+        :param maxsize: максимальное количество хранимых ограничителей
+        """
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.maxsize: int = maxsize
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: Any) -> TokenBucket:
+        """Возвращает ограничитель ключа key, создавая его при первом обращении"""
+        with self._lock:
+            bucket: Optional[TokenBucket] = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return bucket
+
+    def reserve(self, key: Any, tokens: float = 1) -> float:
+        """Списывает токены ограничителя ключа key и возвращает время ожидания в секундах"""
+        if self.rate <= 0 or key is None:
+            return 0.0
+        return self._bucket(key).reserve(tokens)
+
+    def try_reserve(self, key: Any, tokens: float = 1) -> float:
+        """Списывает токены ограничителя ключа key, если они есть (см. TokenBucket.try_reserve)"""
+        if self.rate <= 0 or key is None:
+            return 0.0
+        return self._bucket(key).try_reserve(tokens)
+
+
+class MonthlyQuota:
+    """
+    Класс, реализующий счетчик запросов с месячной квотой. Счетчик сбрасывается в начале календарного месяца.
+    Если задано хранилище store (с методами get и set, например TTLCache с persistent=True), счетчик
+    восстанавливается из него после перезапуска и сохраняется в него каждые save_every запросов
+    """
+
+    def __init__(self, limit: int, store: Any = None, save_every: int = 10):
+        """
+        первичная инициализация класса
+        :param limit: квота запросов на месяц, 0 - без ограничения
+        :param store: хранилище счетчика
+        :param save_every: через сколько запросов сохранять счетчик в хранилище
+        """
+        self.limit: int = limit
+        self.store = store
+        self.save_every: int = save_every
+        self.used: int = 0
+        self.rejected: int = 0
+        self.part: Optional[int] = None
+        self._month: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _key(self, month: str) -> str:
+        """Возвращает ключ счетчика месяца в хранилище (у каждого процесса свой счетчик своей доли квоты)"""
+        return month if self.part is None else f'{month}:{self.part}'
+
+    def share(self, parts: int, part: int) -> None:
+        """
+        Оставляет процессу его долю квоты, когда квота делится между parts процессами
+        :param parts: количество процессов
+        :param part: номер процесса
+        """
+        with self._lock:
+            self.limit = -(-self.limit // parts)
+            self.part = part
+            self._month = None
+
+    def _switch_month(self, month: str) -> None:
+        """При смене месяца восстанавливает счетчик месяца month из хранилища (вызывается под блокировкой)"""
+        if month != self._month:
+            self._month = month
+            self.used = (self.store.get(self._key(month)) if self.store is not None else None) or 0
+
+    def take(self) -> bool:
+        """
+        Учитывает один запрос
+        :return: True, если квота текущего месяца не исчерпана
+        """
+        if self.limit <= 0:
+            return True
+        month: str = datetime.now().strftime('%Y-%m')
+        with self._lock:
+            self._switch_month(month)
+            if self.used >= self.limit:
+                self.rejected += 1
+                return False
+            self.used += 1
+            if self.store is not None and self.used % self.save_every == 0:
+                self.store.set(self._key(month), self.used)
+            return True
+
+    def remaining(self) -> Optional[int]:
+        """Возвращает остаток квоты текущего месяца, либо None, если квота не ограничена"""
+        if self.limit <= 0:
+            return None
+        month: str = datetime.now().strftime('%Y-%m')
+        with self._lock:
+            self._switch_month(month)
+            return max(self.limit - self.used, 0)
+
+    def save(self) -> None:
+        """Сохраняет счетчик в хранилище"""
+        with self._lock:
+            if self.store is not None and self._month is not None:
+                self.store.set(self._key(self._month), self.used)
+
+
+class ApiLimiter:
+    """
+    Класс, реализующий ограничение запросов к внешнему API: не чаще rate запросов в секунду
+    и не больше месячной квоты. Ведет учет ответов 429
+    """
+
+    def __init__(self, bucket: TokenBucket, quota: MonthlyQuota):
+        """
+        первичная инициализация класса
+        :param bucket: ограничитель частоты запросов
+        :param quota: месячная квота
+        """
+        self.bucket: TokenBucket = bucket
+        self.quota: MonthlyQuota = quota
+        self.throttled: int = 0
+        self.waited: float = 0.0
+
+    def reserve(self) -> Optional[float]:
+        """
+        Занимает место для одного запроса
+        :return: время ожидания в секундах, либо None, если месячная квота исчерпана
+        """
+        if not self.quota.take():
+            return None
+        delay: float = self.bucket.reserve()
+        self.waited += delay
+        return delay
+
+    def share(self, parts: int, part: int) -> None:
+        """Оставляет процессу part его долю частоты запросов и месячной квоты из parts процессов"""
+        self.bucket.share(parts)
+        self.quota.share(parts, part)
+
+    def record_status(self, status: int) -> None:
+        """Учитывает код ответа API"""
+        if status == 429:
+            self.throttled += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает количество ответов 429, израсходованную квоту и суммарное время ожидания"""
+        return {'throttled_429': self.throttled, 'quota_used': self.quota.used, 'quota_limit': self.quota.limit,
+                'quota_rejected': self.quota.rejected, 'waited_s': round(self.waited, 3)}
@@ -0,0 +1,152 @@
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+
+
+class City:
+    """Класс, реализующий компактную запись о городе из ответа locations/v2/search"""
+    __slots__ = ('caption', 'destination_id')
+
+    def __init__(self, caption: str, destination_id: str):
+        """
+        первичная инициализация класса
+        :param caption: название города с географической привязкой
+        :param destination_id: id города в API
+        """
+        self.caption: str = caption
+        self.destination_id: str = destination_id
+
+    def __repr__(self) -> str:
+        return f'City({self.caption!r}, {self.destination_id!r})'
+
+
+class HotelSummary:
+    """Класс, реализующий компактную запись об отеле из результатов поиска (properties/list)"""
+    __slots__ = ('hotel_id', 'name', 'star_rating', 'address', 'price', 'price_value', 'distance',
+                 'distance_value', 'latitude', 'longitude')
+
+    def __init__(self, hotel_id: str, name: str, star_rating: int, address: str, price: str,
+                 price_value: Optional[float], distance: str, distance_value: Optional[float] = None,
+                 latitude: Optional[float] = None, longitude: Optional[float] = None):
+        """
+        первичная инициализация класса
+        :param hotel_id: id отеля
+        :param name: название отеля
+        :param star_rating: количество звезд
+        :param address: адрес (улица)
+        :param price: цена в виде строки, как ее возвращает API
+        :param price_value: цена в виде числа
+        :param distance: расстояние до центра в виде строки, как его возвращает API
+        :param distance_value: расстояние до центра в километрах
+        :param latitude: широта
+        :param longitude: долгота
+        """
+        self.hotel_id: str = hotel_id
+        self.name: str = name
+        self.star_rating: int = star_rating
+        self.address: str = address
+        self.price: str = price
+        self.price_value: Optional[float] = price_value
+        self.distance: str = distance
+        self.distance_value: Optional[float] = distance_value
+        self.latitude: Optional[float] = latitude
+        self.longitude: Optional[float] = longitude
+
+    def __repr__(self) -> str:
+        return f'HotelSummary({self.hotel_id!r}, {self.name!r})'
+
+
+class SearchResults:
+    """Класс, реализующий результаты поиска отелей, которые показываются пользователю постранично"""
+    __slots__ = ('hotels', 'page_size', 'locale', 'dates')
+
+    def __init__(self, hotels: List[HotelSummary], page_size: int, locale: str,
+                 dates: Optional[Dict[str, Tuple[date, date]]] = None):
+        """
+        первичная инициализация класса
+        :param hotels: найденные отели
+        :param page_size: количество отелей на одной странице клавиатуры
+        :param locale: локализация запроса
+        :param dates: даты заезда и выезда по id отеля, если они у отелей разные (гибкий поиск)
+        """
+        self.hotels: List[HotelSummary] = hotels
+        self.page_size: int = page_size
+        self.locale: str = locale
+        self.dates: Optional[Dict[str, Tuple[date, date]]] = dates
+
+    @property
+    def pages(self) -> int:
+        """Количество страниц"""
+        return -(-len(self.hotels) // self.page_size)
+
+    def page(self, number: int) -> List[HotelSummary]:
+        """Возвращает отели страницы number (нумерация с 0)"""
+        return self.hotels[number * self.page_size:(number + 1) * self.page_size]
+
+    def __repr__(self) -> str:
+        return f'SearchResults({len(self.hotels)} hotels, page_size={self.page_size})'
+
+
+class HotelDetails:
+    """Класс, реализующий компактную запись с подробной информацией об отеле (properties/get-details)"""
+    __slots__ = ('name', 'address', 'map_url', 'latitude', 'longitude', 'overview_titles', 'overview',
+                 'around_titles', 'around', 'price', 'price_info')
+
+    def __init__(self, name: str, address: str, map_url: str, latitude: Optional[float], longitude: Optional[float],
+                 overview_titles: List[str], overview: List[str], around_titles: List[str], around: List[str],
+                 price: str, price_info: str):
+        """
+        первичная инициализация класса
+        :param name: название отеля
+        :param address: полный адрес
+        :param map_url: ссылка на карту
+        :param latitude: широта
+        :param longitude: долгота
+        :param overview_titles: заголовки разделов с описанием отеля
+        :param overview: строки описания отеля
+        :param around_titles: заголовки разделов с описанием окрестностей
+        :param around: строки описания окрестностей
+        :param price: цена
+        :param price_info: пояснение к цене
+        """
+        self.name: str = name
+        self.address: str = address
+        self.map_url: str = map_url
+        self.latitude: Optional[float] = latitude
+        self.longitude: Optional[float] = longitude
+        self.overview_titles: List[str] = overview_titles
+        self.overview: List[str] = overview
+        self.around_titles: List[str] = around_titles
+        self.around: List[str] = around
+        self.price: str = price
+        self.price_info: str = price_info
+
+    def __repr__(self) -> str:
+        return f'HotelDetails({self.name!r})'
+
+
+class HistoryEntry:
+    """Класс, реализующий запись журнала поисков (таблица HistoryQuery)"""
+    __slots__ = ('entry_id', 'created_at', 'command', 'city', 'check_in', 'check_out', 'hotels')
+
+    def __init__(self, entry_id: int, created_at: datetime, command: str, city: str, check_in: str, check_out: str,
+                 hotels: List[str]):
+        """
+        первичная инициализация класса
+        :param entry_id: id записи в таблице HistoryQuery
+        :param created_at: время завершения поиска
+        :param command: команда поиска (/lowprice, /highprice, /bestdeal)
+        :param city: город, введенный пользователем
+        :param check_in: дата заезда
+        :param check_out: дата выезда
+        :param hotels: названия показанных отелей
+        """
+        self.entry_id: int = entry_id
+        self.created_at: datetime = created_at
+        self.command: str = command
+        self.city: str = city
+        self.check_in: str = check_in
+        self.check_out: str = check_out
+        self.hotels: List[str] = hotels
+
+    def __repr__(self) -> str:
+        return f'HistoryEntry({self.created_at!r}, {self.command!r}, {self.city!r})'
@@ -0,0 +1,128 @@
+from datetime import date
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from botrequests.history import to_cursor
+from botrequests.records import City, HistoryEntry, HotelDetails, HotelSummary, SearchResults
+
+HOTEL_SITES: Dict[str, str] = {'en_US': '', 'ru_RU': 'ru.'}
+STARS: List[str] = ['⭐️' * num for num in range(6)]
+FLEX_DATES: str = '{} ({:%d.%m}—{:%d.%m})'
+HISTORY_ENTRY: str = '{created_at:%d.%m.%Y %H:%M} {command} {city}\nДаты: {check_in} — {check_out}\n{hotels}'
+
+
+@lru_cache(maxsize=None)
+def templates(locale: str) -> Dict[str, str]:
+    """
+    Возвращает шаблоны сообщений для локализации. Шаблоны собираются один раз для каждой локализации
+    :param locale: локализация запроса ('ru_RU', 'en_US')
+    :return: словарь шаблонов: надпись кнопки отеля (оператор %) и сообщение об отеле (str.format)
+    """
+    return {'hotel_label': '%s %s  %s. %s %s до центра',
+            'hotel_text': '{name}\n\n'
+                          'Адрес отеля: {address}\n'
+                          '{map_url}\n'
+                          'Координаты отеля: {latitude}, {longitude}\n\n'
+                          '{overview_titles}\n\n'
+                          '{overview}\n\n'
+                          '{around_titles}\n\n'
+                          '{around}\n\n'
+                          '{price} {price_info}\n\n'
+                          'Ссылка на страницу отеля на сайте hotels.com: '
+                          'https://www.' + HOTEL_SITES.get(locale, '') + 'hotels.com/ho{hotel_id}\n'}
+
+
+def city_keys(cities: List[City]) -> List[Tuple[str, str]]:
+    """Возвращает кнопки inline клавиатуры для списка городов"""
+    return [(city.caption, city.destination_id + '.city_id') for city in cities]
+
+
+def hotel_label(hotel: HotelSummary, locale: str = 'en_US', template: Optional[str] = None) -> str:
+    """
+    Возвращает надпись кнопки отеля: название, звезды, адрес, цена и расстояние до центра
+    :param hotel: запись HotelSummary
+    :param locale: локализация запроса
+    :param template: шаблон надписи, если он уже получен вызывающей функцией
+    :return: надпись кнопки
+    """
+    stars: str = STARS[hotel.star_rating] if 0 <= hotel.star_rating < len(STARS) else '⭐️' * hotel.star_rating
+    return (template or templates(locale)['hotel_label']) % (hotel.name, stars, hotel.address, hotel.price.lower(),
+                                                             hotel.distance.partition(' ')[0])
+
+
+def hotel_keys(hotels: List[HotelSummary], locale: str = 'en_US',
+               dates: Optional[Dict[str, Tuple[date, date]]] = None) -> List[Tuple[str, str]]:
+    """
+    Возвращает кнопки inline клавиатуры для списка отелей
+    :param hotels: список записей HotelSummary
+    :param locale: локализация запроса
+    :param dates: даты заезда и выезда по id отеля, добавляются к надписи кнопки (гибкий поиск)
+    :return: список кнопок
+    """
+    template: str = templates(locale)['hotel_label']
+    if dates is None:
+        return [(hotel_label(hotel, locale, template), hotel.hotel_id + '.hotel_id') for hotel in hotels]
+    return [(FLEX_DATES.format(hotel_label(hotel, locale, template), *dates[hotel.hotel_id]),
+             hotel.hotel_id + '.hotel_id') for hotel in hotels]
+
+
+def results_keys(results: SearchResults, session_id: int, page: int) -> List[Tuple[str, str]]:
+    """
+    Возвращает кнопки отелей одной страницы результатов поиска и кнопки перелистывания.
+    В callback data кнопок перелистывания передаются id запроса и номер страницы
+    :param results: результаты поиска
+    :param session_id: id текущего запроса пользователя (ключ results_cache)
+    :param page: номер страницы (с 0)
+    :return: список кнопок
+    """
+    keys: List[Tuple[str, str]] = hotel_keys(results.page(page), results.locale, results.dates)
+    if page > 0:
+        keys.append(('« Назад', f'{session_id}_{page - 1}.results'))
+    if page + 1 < results.pages:
+        keys.append(('Еще »', f'{session_id}_{page + 1}.results'))
+    return keys
+
+
+def hotel_text(hotel: HotelDetails, hotel_id: str, locale: str) -> str:
+    """
+    Возвращает сообщение с полной информацией об отеле
+    :param hotel: запись HotelDetails
+    :param hotel_id: id отеля
+    :param locale: локализация запроса
+    :return: текст сообщения
+    """
+    return templates(locale)['hotel_text'].format(name=hotel.name, address=hotel.address, map_url=hotel.map_url,
+                                                  latitude=hotel.latitude, longitude=hotel.longitude,
+                                                  overview_titles='\n'.join(hotel.overview_titles),
+                                                  overview='\n'.join(hotel.overview),
+                                                  around_titles='\n'.join(hotel.around_titles),
+                                                  around='\n'.join(hotel.around),
+                                                  price=hotel.price, price_info=hotel.price_info, hotel_id=hotel_id)
+
+
+def history_text(entries: List[HistoryEntry]) -> str:
+    """Возвращает страницу журнала поисков одним сообщением"""
+    if not entries:
+        return 'История поиска пуста'
+    return '\n\n'.join(HISTORY_ENTRY.format(created_at=entry.created_at, command=entry.command, city=entry.city,
+                                             check_in=entry.check_in, check_out=entry.check_out,
+                                             hotels='\n'.join('• ' + hotel for hotel in entry.hotels)
+                                             if entry.hotels else 'Отелей не найдено')
+                         for entry in entries)
+
+
+def history_keys(entries: List[HistoryEntry], has_newer: bool, has_older: bool) -> List[Tuple[str, str]]:
+    """
+    Возвращает кнопки перелистывания журнала поисков. В callback data передается позиция (время и id)
+    первой или последней записи страницы, от которой читается следующая страница
+    :param entries: записи текущей страницы (от новых к старым)
+    :param has_newer: есть ли записи новее текущей страницы
+    :param has_older: есть ли записи старее текущей страницы
+    :return: список кнопок
+    """
+    keys: List[Tuple[str, str]] = []
+    if entries and has_newer:
+        keys.append(('« Новее', f'newer_{to_cursor(entries[0])}.history'))
+    if entries and has_older:
+        keys.append(('Старее »', f'older_{to_cursor(entries[-1])}.history'))
+    return keys
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from loguru import logger
+from peewee import fn
+
+from botrequests.bot_classes import CachedValue, HistoryQuery, Session, db
+
+
+class SessionRetention:
+    """
+    Класс, реализующий фоновую очистку таблицы Session.
+    Удаляются завершенные запросы (все, кроме последнего запроса каждого чата) старше max_age_days
+    или сверх max_per_chat последних запросов чата, а также устаревшие записи CachedValue и журнала поисков
+    HistoryQuery (старше history_max_age_days или сверх history_max_per_chat последних записей чата).
+    После удаления освобождается место в файле базы
+    """
+
+    def __init__(self, max_age_days: float = float(os.getenv('SESSION_MAX_AGE_DAYS', 30)),
+                 max_per_chat: int = int(os.getenv('SESSION_MAX_PER_CHAT', 20)),
+                 interval: float = float(os.getenv('SESSION_RETENTION_INTERVAL', 3600)),
+                 history_max_age_days: float = float(os.getenv('HISTORY_MAX_AGE_DAYS', 180)),
+                 history_max_per_chat: int = int(os.getenv('HISTORY_MAX_PER_CHAT', 100))):
+        """
+        первичная инициализация класса
+        :param max_age_days: максимальный возраст завершенного запроса в днях
+        :param max_per_chat: максимальное количество хранимых запросов одного чата
+        :param interval: интервал (в секундах) между очистками
+        :param history_max_age_days: максимальный возраст записи журнала поисков в днях
+        :param history_max_per_chat: максимальное количество хранимых записей журнала поисков одного чата
+        """
+        self.max_age_days: float = max_age_days
+        self.max_per_chat: int = max_per_chat
+        self.interval: float = interval
+        self.history_max_age_days: float = history_max_age_days
+        self.history_max_per_chat: int = history_max_per_chat
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> int:
+        """
+        Удаляет устаревшие запросы и освобождает место в базе
+        :return: количество удаленных записей
+        """
+        latest = Session.select(fn.MAX(Session.id)).group_by(Session.chat_id)
+        cutoff: datetime = datetime.now() - timedelta(days=self.max_age_days)
+        ranked = Session.select(Session.id, fn.ROW_NUMBER().over(partition_by=[Session.chat_id],
+                                                                  order_by=[Session.id.desc()]).alias('rn'))
+        surplus = Session.select(ranked.c.id).from_(ranked).where(ranked.c.rn > self.max_per_chat)
+
+        with db:
+            deleted: int = Session.delete().where(Session.id.not_in(latest),
+                                                  Session.created_at < cutoff).execute()
+            deleted += Session.delete().where(Session.id.in_(surplus)).execute()
+            expired: int = CachedValue.delete().where(CachedValue.expires_at < time.time()).execute()
+            history: int = self.prune_history()
+        with db.connection_context():
+            db.execute_sql('PRAGMA incremental_vacuum').fetchall()
+        logger.info(f'Очистка таблицы Session: удалено записей {deleted}, устаревших записей кэша {expired}, '
+                    f'записей журнала поисков {history}')
+        return deleted
+
+    def prune_history(self) -> int:
+        """
+        Удаляет устаревшие записи журнала поисков и записи сверх history_max_per_chat последних записей чата
+        :return: количество удаленных записей
+        """
+        cutoff: datetime = datetime.now() - timedelta(days=self.history_max_age_days)
+        ranked = HistoryQuery.select(HistoryQuery.id, fn.ROW_NUMBER().over(
+            partition_by=[HistoryQuery.chat_id], order_by=[HistoryQuery.created_at.desc()]).alias('rn'))
+        surplus = HistoryQuery.select(ranked.c.id).from_(ranked).where(ranked.c.rn > self.history_max_per_chat)
+        deleted: int = HistoryQuery.delete().where(HistoryQuery.created_at < cutoff).execute()
+        deleted += HistoryQuery.delete().where(HistoryQuery.id.in_(surplus)).execute()
+        return deleted
+
+    def _run(self) -> None:
+        """Периодическая очистка в фоновом потоке"""
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as err:
+                logger.exception(f'Ошибка очистки таблицы Session: {err}')
+
+    def start(self) -> None:
+        """Запускает фоновый поток очистки"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='session-retention', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Останавливает фоновый поток очистки"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+session_retention = SessionRetention()
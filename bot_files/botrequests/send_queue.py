@@ -0,0 +1,362 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+from telebot.apihelper import ApiTelegramException
+
+from botrequests.metrics import metrics
+from botrequests.ratelimit import KeyedTokenBuckets, TokenBucket
+
+# приоритет метода бота (меньше - раньше) и позиция аргумента chat_id
+PRIORITIES: Dict[str, Tuple[int, Optional[int]]] = {'answer_callback_query': (0, None),
+                                                    'edit_message_text': (0, 1),
+                                                    'edit_message_reply_markup': (0, 0),
+                                                    'send_message': (1, 0),
+                                                    'send_photo': (2, 0),
+                                                    'send_media_group': (2, 0)}
+
+
+def retry_after(err: Exception) -> Optional[float]:
+    """Возвращает паузу, запрошенную telegram в ответе 429, или None для остальных ошибок"""
+    if isinstance(err, ApiTelegramException) and err.error_code == 429:
+        return float(((err.result_json or {}).get('parameters') or {}).get('retry_after', 1))
+    return None
+
+
+class SendStats:
+    """Класс, реализующий счетчики очереди отправки: отправлено, ответы 429, время ожидания в очереди"""
+
+    def __init__(self):
+        """первичная инициализация класса"""
+        self.sent: int = 0
+        self.throttled: int = 0
+        self.wait_total: float = 0.0
+        self.wait_max: float = 0.0
+        self._lock = threading.Lock()
+
+    def record_wait(self, wait: float) -> None:
+        """Учитывает время ожидания одного вызова в очереди"""
+        with self._lock:
+            self.sent += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def record_throttled(self) -> None:
+        """Учитывает ответ 429"""
+        with self._lock:
+            self.throttled += 1
+
+    def as_dict(self, depth: int) -> Dict[str, Any]:
+        """Возвращает счетчики и текущую глубину очереди"""
+        with self._lock:
+            return {'depth': depth, 'sent': self.sent, 'throttled_429': self.throttled,
+                    'wait_avg_s': round(self.wait_total / self.sent, 4) if self.sent else 0.0,
+                    'wait_max_s': round(self.wait_max, 4)}
+
+
+class SendQueue:
+    """
+    Класс, реализующий очередь исходящих запросов к telegram с приоритетами. Запросы выполняются
+    пулом потоков в порядке приоритета (правка сообщений и ответы на кнопки раньше отправки фотографий),
+    не чаще глобального ограничения и ограничения на один чат. Поток не ждет освобождения ограничения чата:
+    вызов, для чата которого лимит исчерпан, откладывается до появления токена, а поток берет следующий
+    готовый вызов. Ответ 429 также откладывает вызов на паузу retry_after
+    """
+
+    def __init__(self, workers: int = int(os.getenv('SEND_QUEUE_WORKERS', 4)),
+                 global_rate: float = float(os.getenv('TELEGRAM_RATE_LIMIT', 30)),
+                 chat_rate: float = float(os.getenv('TELEGRAM_CHAT_RATE_LIMIT', 1)),
+                 chat_burst: float = float(os.getenv('TELEGRAM_CHAT_BURST', 3)),
+                 retries: int = int(os.getenv('TELEGRAM_RETRIES', 3))):
+        """
+        первичная инициализация класса
+        :param workers: количество потоков отправки
+        :param global_rate: максимальное количество запросов в секунду для всего бота
+        :param chat_rate: максимальное количество запросов в секунду в один чат
+        :param chat_burst: допустимый всплеск запросов в один чат
+        :param retries: количество повторов после ответа 429
+        """
+        self.workers: int = workers
+        self.retries: int = retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = KeyedTokenBuckets(chat_rate, chat_burst)
+        self.stats_counters = SendStats()
+        self._heap: List[Tuple] = []
+        self._delayed: List[Tuple] = []
+        self._sending: int = 0
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopped: bool = False
+
+    def call(self, priority: int, chat_id: Any, func: Callable, *args, **kwargs) -> Any:
+        """
+        Ставит вызов в очередь и ожидает его результата
+        :param priority: приоритет (меньше - раньше)
+        :param chat_id: id чата для ограничения частоты отправки в один чат
+        :param func: метод бота
+        :return: результат метода бота
+        """
+        self.start()
+        future: Future = Future()
+        with self._condition:
+            heapq.heappush(self._heap, (priority, next(self._counter), time.monotonic(), chat_id, func, args, kwargs,
+                                        future, 0))
+            self._condition.notify()
+        return future.result()
+
+    def _next(self, now: float) -> Tuple[Optional[Tuple], Optional[float]]:
+        """
+        Выбирает готовый к отправке вызов с наивысшим приоритетом и занимает для него токен чата.
+        Вызовы, для чатов которых лимит исчерпан, откладываются до появления токена
+        :param now: текущее время (time.monotonic)
+        :return: вызов (или None) и время до ближайшего отложенного вызова (None, если отложенных нет)
+        """
+        while self._delayed and self._delayed[0][0] <= now:
+            heapq.heappush(self._heap, heapq.heappop(self._delayed)[2])
+        while self._heap:
+            item: Tuple = heapq.heappop(self._heap)
+            wait: float = self.chat_buckets.try_reserve(item[3])
+            if wait <= 0:
+                self._sending += 1
+                return item, None
+            heapq.heappush(self._delayed, (now + wait, item[1], item))
+        return None, (self._delayed[0][0] - now if self._delayed else None)
+
+    def _retry(self, item: Tuple, err: Exception) -> bool:
+        """
+        Откладывает вызов после ответа 429 на паузу retry_after (вызывается под блокировкой)
+        :return: True, если вызов отложен, False - если ошибку нужно передать вызывающему коду
+        """
+        pause: Optional[float] = retry_after(err)
+        attempt: int = item[8]
+        if pause is None or attempt >= self.retries:
+            return False
+        self.stats_counters.record_throttled()
+        logger.info(f'Ответ 429 от telegram для чата {item[3]}, повтор через {pause} с')
+        heapq.heappush(self._delayed, (time.monotonic() + pause, item[1], item[:8] + (attempt + 1,)))
+        return True
+
+    def _idle(self) -> bool:
+        """Проверяет, что в очереди нет ни готовых, ни отложенных, ни отправляемых вызовов"""
+        return not self._heap and not self._delayed and not self._sending
+
+    def send(self, item: Tuple) -> None:
+        """Выполняет вызов, соблюдая глобальное ограничение частоты, и передает результат вызывающему потоку"""
+        priority, _, queued_at, chat_id, func, args, kwargs, future, attempt = item
+        delay: float = self.global_bucket.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        self.stats_counters.record_wait(time.monotonic() - queued_at)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as err:
+            with self._condition:
+                self._sending -= 1
+                retried: bool = isinstance(err, ApiTelegramException) and self._retry(item, err)
+                self._condition.notify_all()
+            if not retried:
+                future.set_exception(err)
+            return
+        with self._condition:
+            self._sending -= 1
+            self._condition.notify_all()
+        future.set_result(result)
+
+    def _run(self) -> None:
+        """Поток отправки: выполняет готовые вызовы из очереди в порядке приоритета"""
+        while True:
+            with self._condition:
+                while True:
+                    item, wait = self._next(time.monotonic())
+                    if item is not None:
+                        break
+                    if self._stopped and self._idle():
+                        return
+                    self._condition.wait(wait)
+            self.send(item)
+
+    def start(self) -> None:
+        """Запускает потоки отправки, если они еще не запущены"""
+        with self._condition:
+            if self._threads:
+                return
+            self._stopped = False
+            self._threads = [threading.Thread(target=self._run, name=f'send-queue-{num}', daemon=True)
+                             for num in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """Дожидается отправки поставленных в очередь вызовов и останавливает потоки"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join()
+        logger.info(f'Очередь отправки остановлена: {self.stats()}')
+
+    def share(self, parts: int) -> None:
+        """
+        Делит глобальное ограничение частоты между parts процессами. Ограничение на чат не делится:
+        обновления одного чата обрабатывает один процесс
+        """
+        self.global_bucket.share(parts)
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает глубину очереди, количество отправленных запросов, ответов 429 и время ожидания в очереди"""
+        with self._condition:
+            depth: int = len(self._heap) + len(self._delayed)
+        return self.stats_counters.as_dict(depth)
+
+
+class AsyncSendQueue(SendQueue):
+    """
+    Асинхронный вариант SendQueue: вызовы асинхронного бота выполняются задачами цикла событий.
+    Очередь используется только из цикла событий, поэтому блокировка не нужна
+    """
+
+    def __init__(self, workers: int = int(os.getenv('SEND_QUEUE_WORKERS', 4)),
+                 global_rate: float = float(os.getenv('TELEGRAM_RATE_LIMIT', 30)),
+                 chat_rate: float = float(os.getenv('TELEGRAM_CHAT_RATE_LIMIT', 1)),
+                 chat_burst: float = float(os.getenv('TELEGRAM_CHAT_BURST', 3)),
+                 retries: int = int(os.getenv('TELEGRAM_RETRIES', 3))):
+        """
+        первичная инициализация класса
+        :param workers: количество задач отправки
+        :param global_rate: максимальное количество запросов в секунду для всего бота
+        :param chat_rate: максимальное количество запросов в секунду в один чат
+        :param chat_burst: допустимый всплеск запросов в один чат
+        :param retries: количество повторов после ответа 429
+        """
+        super().__init__(workers, global_rate, chat_rate, chat_burst, retries)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def call(self, priority: int, chat_id: Any, func: Callable, *args, **kwargs) -> Any:
+        """Асинхронный вариант SendQueue.call: func - корутинный метод асинхронного бота"""
+        self.start()
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._counter), time.monotonic(), chat_id, func, args, kwargs,
+                                    future, 0))
+        self._wakeup.set()
+        return await future
+
+    async def send(self, item: Tuple) -> None:
+        """Асинхронный вариант SendQueue.send"""
+        priority, _, queued_at, chat_id, func, args, kwargs, future, attempt = item
+        delay: float = self.global_bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.stats_counters.record_wait(time.monotonic() - queued_at)
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as err:
+            self._sending -= 1
+            if not (isinstance(err, ApiTelegramException) and self._retry(item, err)) and not future.done():
+                future.set_exception(err)
+        else:
+            self._sending -= 1
+            if not future.done():
+                future.set_result(result)
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        """Задача отправки: выполняет готовые вызовы из очереди в порядке приоритета"""
+        while True:
+            item, wait = self._next(time.monotonic())
+            if item is not None:
+                await self.send(item)
+                continue
+            if self._stopped and self._idle():
+                return
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        """Создает задачи отправки в текущем цикле событий, если они еще не созданы"""
+        if self._tasks:
+            return
+        self._stopped = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._run()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Дожидается отправки поставленных в очередь вызовов и останавливает задачи"""
+        self._stopped = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        tasks, self._tasks = self._tasks, []
+        await asyncio.gather(*tasks)
+        logger.info(f'Очередь отправки остановлена: {self.stats()}')
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает глубину очереди, количество отправленных запросов, ответов 429 и время ожидания в очереди"""
+        return self.stats_counters.as_dict(len(self._heap) + len(self._delayed))
+
+
+def chat_of(position: Optional[int], args: Tuple, kwargs: Dict) -> Any:
+    """Возвращает id чата вызова метода бота по позиции аргумента chat_id или по его имени"""
+    if 'chat_id' in kwargs:
+        return kwargs['chat_id']
+    return args[position] if position is not None and len(args) > position else None
+
+
+class QueuedBot:
+    """
+    Класс-обертка бота telebot: методы отправки и правки сообщений из PRIORITIES выполняются через очередь
+    отправки с приоритетом метода, остальные атрибуты (регистрация обработчиков, polling) берутся у бота
+    """
+
+    def __init__(self, bot, queue: SendQueue):
+        """
+        первичная инициализация класса
+        :param bot: бот telebot
+        :param queue: очередь отправки
+        """
+        self.bot = bot
+        self.queue: SendQueue = queue
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.bot, name)
+        if name not in PRIORITIES:
+            return attribute
+
+        priority, position = PRIORITIES[name]
+
+        def queued(*args, **kwargs):
+            return self.queue.call(priority, chat_of(position, args, kwargs), attribute, *args, **kwargs)
+
+        return queued
+
+
+class AsyncQueuedBot(QueuedBot):
+    """Асинхронный вариант QueuedBot для AsyncTeleBot"""
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.bot, name)
+        if name not in PRIORITIES:
+            return attribute
+
+        priority, position = PRIORITIES[name]
+
+        async def queued(*args, **kwargs):
+            return await self.queue.call(priority, chat_of(position, args, kwargs), attribute, *args, **kwargs)
+
+        return queued
+
+
+send_queue = SendQueue()
+async_send_queue = AsyncSendQueue()
+metrics.register_gauges('send_queue', send_queue.stats)
+metrics.register_gauges('async_send_queue', async_send_queue.stats)
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from typing import Dict, Optional, Set
+
+from loguru import logger
+
+from botrequests.bot_classes import Session, db
+from botrequests.metrics import metrics
+
+
+class SessionStore:
+    """
+    Класс, реализующий хранение текущих запросов пользователей в памяти.
+    Чтение значений производится из памяти, измененные поля записываются в таблицу Session
+    пакетами: в фоновом потоке через заданный интервал и при вызове flush. Запросы, к которым
+    давно не обращались, после записи удаляются из памяти
+    """
+
+    def __init__(self, flush_interval: float = float(os.getenv('SESSION_FLUSH_INTERVAL', 1.0)),
+                 max_idle: float = float(os.getenv('SESSION_MAX_IDLE', 3600))):
+        """
+        первичная инициализация класса
+        :param flush_interval: интервал (в секундах) записи измененных полей в базу
+        :param max_idle: через сколько секунд без обращений записанный запрос удаляется из памяти
+        """
+        self.flush_interval: float = flush_interval
+        self.max_idle: float = max_idle
+        self._rows: Dict[str, Dict] = dict()
+        self._dirty: Dict[str, Set[str]] = dict()
+        self._touched: Dict[str, float] = dict()
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _row_to_dict(row: Session) -> Dict:
+        """Возвращает словарь со значениями колонок строки таблицы Session"""
+        return {field: getattr(row, field) for field in Session._meta.fields}
+
+    def load(self, chat_id) -> Dict:
+        """
+        Возвращает текущий запрос пользователя. Если его нет в памяти, он загружается из базы
+        :param chat_id: id чата
+        :return: словарь со значениями колонок таблицы Session
+        """
+        chat_id = str(chat_id)
+        with self._lock:
+            row = self._rows.get(chat_id)
+            if row is not None:
+                self._touched[chat_id] = time.monotonic()
+                return row
+        with metrics.span('session_query', operation='load'), db:
+            cur_query = Session.select().where(Session.chat_id == chat_id).order_by(Session.id.desc()).first()
+        if cur_query is None:
+            raise KeyError(f'Запрос для чата {chat_id} не найден')
+        with self._lock:
+            self._touched[chat_id] = time.monotonic()
+            return self._rows.setdefault(chat_id, self._row_to_dict(cur_query))
+
+    def get(self, chat_id, column: str):
+        """
+        Возвращает значение колонки текущего запроса пользователя
+        :param chat_id: id чата
+        :param column: название колонки в таблице Session
+        """
+        return self.load(chat_id)[column]
+
+    def set(self, chat_id, column: str, value) -> None:
+        """
+        Изменяет значение колонки текущего запроса пользователя и помечает его для записи в базу
+        :param chat_id: id чата
+        :param column: название колонки в таблице Session
+        :param value: новое значение
+        """
+        if column not in Session._meta.fields or column == 'id':
+            raise KeyError(f'Колонка {column} отсутствует в таблице Session')
+        self._modify(str(chat_id), {column: value})
+
+    def update(self, chat_id, **fields) -> None:
+        """
+        Изменяет значения нескольких колонок текущего запроса пользователя одним изменением
+        :param chat_id: id чата
+        :param fields: новые значения колонок
+        """
+        unknown = set(fields) - set(Session._meta.fields) | set(fields) & {'id'}
+        if unknown:
+            raise KeyError(f'Колонки {unknown} отсутствуют в таблице Session')
+        self._modify(str(chat_id), fields)
+
+    def _modify(self, chat_id: str, fields: Dict) -> None:
+        """Изменяет колонки запроса, находящегося в памяти (если запрос заменен, пока загружался, - повторяет)"""
+        while True:
+            row: Dict = self.load(chat_id)
+            with self._lock:
+                if self._rows.get(chat_id) is row:
+                    row.update(fields)
+                    self._dirty.setdefault(chat_id, set()).update(fields)
+                    return
+
+    def new_session(self, chat_id, **fields) -> Dict:
+        """
+        Создает новую запись текущего запроса пользователя. Несохраненные изменения
+        предыдущего запроса предварительно записываются в базу
+        :param chat_id: id чата
+        :param fields: значения колонок новой записи
+        :return: словарь со значениями колонок новой записи
+        """
+        chat_id = str(chat_id)
+        self.flush(chat_id)
+        with metrics.span('session_query', operation='create'), db:
+            session = Session.create(chat_id=chat_id, **fields)
+        row = self._row_to_dict(session)
+        with self._lock:
+            self._rows[chat_id] = row
+            self._dirty.pop(chat_id, None)
+            self._touched[chat_id] = time.monotonic()
+        return row
+
+    def flush(self, chat_id=None) -> int:
+        """
+        Записывает в базу измененные поля одного (chat_id) или всех текущих запросов в одной транзакции.
+        Изменения копируются под блокировкой, запись в базу выполняется без нее. Если запись не удалась,
+        изменения снова помечаются для записи, а исключение передается вызывающему коду
+        :param chat_id: id чата, если не указан - записываются все чаты
+        :return: количество обновленных записей
+        """
+        with self._write_lock:
+            with self._lock:
+                if chat_id is None:
+                    chats = list(self._dirty)
+                else:
+                    chats = [str(chat_id)] if str(chat_id) in self._dirty else []
+                batch = [(chat, self._rows[chat]['id'],
+                          {column: self._rows[chat][column] for column in self._dirty.pop(chat)})
+                         for chat in chats]
+            if not batch:
+                return 0
+            try:
+                with metrics.span('session_query', operation='flush'), db:
+                    for chat, row_id, fields in batch:
+                        Session.update(**fields).where(Session.id == row_id).execute()
+            except Exception:
+                with self._lock:
+                    for chat, row_id, fields in batch:
+                        if self._rows.get(chat, {}).get('id') == row_id:
+                            self._dirty.setdefault(chat, set()).update(fields)
+                raise
+        logger.info(f'Записано в базу изменений запросов: {len(batch)}')
+        return len(batch)
+
+    def evict(self, max_idle: Optional[float] = None) -> int:
+        """
+        Удаляет из памяти записанные в базу запросы, к которым не обращались дольше max_idle секунд
+        :param max_idle: время без обращений в секундах, по умолчанию - заданное при создании
+        :return: количество удаленных запросов
+        """
+        deadline: float = time.monotonic() - (self.max_idle if max_idle is None else max_idle)
+        with self._lock:
+            idle = [chat for chat, touched in self._touched.items() if touched <= deadline and chat not in self._dirty]
+            for chat in idle:
+                self._rows.pop(chat, None)
+                del self._touched[chat]
+        if idle:
+            logger.info(f'Удалено из памяти неактивных запросов: {len(idle)}')
+        return len(idle)
+
+    def remember(self, row: Session) -> None:
+        """Помещает в память строку таблицы Session, если текущий запрос чата еще не загружен"""
+        with self._lock:
+            self._rows.setdefault(str(row.chat_id), self._row_to_dict(row))
+            self._touched.setdefault(str(row.chat_id), time.monotonic())
+
+    def forget(self, chat_id) -> None:
+        """Записывает изменения и удаляет текущий запрос пользователя из памяти"""
+        self.flush(chat_id)
+        with self._lock:
+            if str(chat_id) not in self._dirty:
+                self._rows.pop(str(chat_id), None)
+                self._touched.pop(str(chat_id), None)
+
+    def _run(self) -> None:
+        """Фоновая запись изменений в базу и удаление неактивных запросов из памяти"""
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+                self.evict()
+            except Exception as err:
+                logger.exception(f'Ошибка записи изменений запросов в базу: {err}')
+
+    def start(self) -> None:
+        """Запускает фоновый поток записи изменений в базу"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='session-store-flush', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Останавливает фоновый поток и записывает оставшиеся изменения в базу"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+session_store = SessionStore()
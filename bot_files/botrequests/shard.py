@@ -0,0 +1,142 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from loguru import logger
+from telebot import apihelper
+from telebot.types import Update
+
+
+def shard_of(chat_id: Any, processes: int) -> int:
+    """
+    Возвращает номер процесса, обрабатывающего чат. Хэш не зависит от запуска интерпретатора,
+    поэтому чат после перезапуска попадает в тот же процесс, и равномерно распределяет идущие подряд id
+    :param chat_id: id чата
+    :param processes: количество процессов
+    """
+    return int.from_bytes(hashlib.blake2b(str(chat_id).encode(), digest_size=8).digest(), 'big') % processes
+
+
+def raw_chat_id(update: Dict) -> Any:
+    """Возвращает id чата необработанного обновления telegram (словаря json), как dispatcher.update_chat_id"""
+    callback_query: Optional[Dict] = update.get('callback_query')
+    if callback_query is not None:
+        if callback_query.get('message') is not None:
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if update.get(kind) is not None:
+            return update[kind]['chat']['id']
+    return 0
+
+
+def serve_shard(bot, updates: multiprocessing.Queue, ready) -> None:
+    """
+    Цикл процесса-обработчика: получает пакеты необработанных обновлений своих чатов и передает их боту,
+    пока не получит None
+    :param bot: бот (process_new_updates)
+    :param updates: очередь пакетов обновлений
+    :param ready: событие, которое устанавливается, когда процесс готов принимать обновления
+    """
+    ready.set()
+    while True:
+        batch: Optional[List[Dict]] = updates.get()
+        if batch is None:
+            break
+        bot.process_new_updates([Update.de_json(item) for item in batch])
+
+
+class ShardRouter:
+    """
+    Класс, распределяющий обновления telegram между несколькими процессами по хэшу chat_id.
+    Главный процесс только получает обновления (long polling или webhook) и передает их в очередь
+    процесса чата без разбора, обработка выполняется в процессах-обработчиках. Обновления одного чата
+    всегда обрабатывает один процесс в порядке поступления
+    """
+
+    def __init__(self, worker: Callable, processes: int = int(os.getenv('BOT_PROCESSES', 1)),
+                 queue_size: int = int(os.getenv('SHARD_QUEUE_SIZE', 1000))):
+        """
+        первичная инициализация класса
+        :param worker: функция процесса-обработчика с аргументами (номер процесса, количество процессов,
+        очередь пакетов обновлений, событие готовности), должна быть доступна для импорта
+        :param processes: количество процессов-обработчиков
+        :param queue_size: максимальное количество пакетов в очереди одного процесса
+        """
+        self.worker: Callable = worker
+        self.processes: int = processes
+        self.queue_size: int = queue_size
+        self.last_update_id: int = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._queues: List[multiprocessing.Queue] = []
+        self._ready: List[Any] = []
+        self._workers: List[Optional[multiprocessing.Process]] = []
+        self._lock = threading.Lock()
+
+    def _spawn(self, shard: int) -> multiprocessing.Process:
+        """Запускает процесс-обработчик shard"""
+        process = self._context.Process(target=self.worker, name=f'bot-shard-{shard}',
+                                        args=(shard, self.processes, self._queues[shard], self._ready[shard]))
+        process.start()
+        return process
+
+    def start(self, timeout: float = 60) -> None:
+        """
+        Запускает процессы-обработчики и дожидается их готовности
+        :param timeout: максимальное время ожидания готовности в секундах
+        """
+        self._queues = [self._context.Queue(self.queue_size) for _ in range(self.processes)]
+        self._ready = [self._context.Event() for _ in range(self.processes)]
+        self._workers = [self._spawn(shard) for shard in range(self.processes)]
+        deadline: float = time.monotonic() + timeout
+        for ready in self._ready:
+            ready.wait(max(deadline - time.monotonic(), 0))
+        logger.info(f'Запущено процессов-обработчиков: {self.processes}')
+
+    def process_raw_updates(self, updates: List[Dict]) -> None:
+        """
+        Передает необработанные обновления процессам их чатов одним пакетом на процесс.
+        Завершившийся с ошибкой процесс перезапускается, его очередь сохраняется
+        :param updates: обновления (словари json)
+        """
+        batches: Dict[int, List[Dict]] = dict()
+        for update in updates:
+            self.last_update_id = max(self.last_update_id, update['update_id'])
+            batches.setdefault(shard_of(raw_chat_id(update), self.processes), []).append(update)
+        for shard, batch in batches.items():
+            with self._lock:
+                process: multiprocessing.Process = self._workers[shard]
+                if not process.is_alive():
+                    logger.error(f'Процесс-обработчик {shard} завершился с кодом {process.exitcode}, перезапуск')
+                    self._workers[shard] = self._spawn(shard)
+            self._queues[shard].put(batch)
+
+    def polling(self, token: str, stop_event: threading.Event, timeout: int = 20) -> None:
+        """
+        Получает обновления long polling и передает их процессам, пока не установлено stop_event
+        :param token: токен бота
+        :param stop_event: событие остановки
+        :param timeout: таймаут long polling в секундах
+        """
+        while not stop_event.is_set():
+            try:
+                updates: List[Dict] = apihelper.get_updates(token, offset=self.last_update_id + 1, timeout=timeout,
+                                                            long_polling_timeout=timeout)
+            except Exception as err:
+                logger.exception(f'Ошибка получения обновлений: {err}')
+                stop_event.wait(3)
+                continue
+            if updates:
+                self.process_raw_updates(updates)
+
+    def stop(self) -> None:
+        """Дожидается обработки переданных обновлений и останавливает процессы-обработчики"""
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._workers:
+            process.join()
+        self._workers = []
+        logger.info('Процессы-обработчики остановлены')
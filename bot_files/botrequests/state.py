@@ -0,0 +1,129 @@
+import json
+import math
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class SqliteCacheBackend:
+    """
+    Класс, реализующий хранилище сохраняемых кэшей (в том числе счетчика квоты) в таблице CachedValue базы sqlite.
+    Используется по умолчанию: база в режиме WAL доступна всем процессам бота на одной машине
+    """
+
+    def __init__(self, model, database):
+        """
+        первичная инициализация класса
+        :param model: модель peewee таблицы CachedValue
+        :param database: база peewee
+        """
+        self.model = model
+        self.database = database
+
+    def get(self, namespace: str, key: str) -> Optional[Tuple[str, float]]:
+        """
+        Возвращает не устаревшую запись
+        :param namespace: название кэша
+        :param key: ключ записи (строка json)
+        :return: значение (строка json) и время устаревания, либо None
+        """
+        with self.database:
+            row = self.model.get_or_none(self.model.cache_name == namespace, self.model.key == key,
+                                         self.model.expires_at > time.time())
+        return None if row is None else (row.value, row.expires_at)
+
+    def set(self, namespace: str, key: str, value: str, expires_at: float) -> None:
+        """
+        Сохраняет запись
+        :param namespace: название кэша
+        :param key: ключ записи (строка json)
+        :param value: значение (строка json)
+        :param expires_at: время устаревания (unix time)
+        """
+        with self.database:
+            self.model.replace(cache_name=namespace, key=key, value=value, expires_at=expires_at).execute()
+
+
+class KeyValueCacheBackend:
+    """
+    Класс, реализующий хранилище сохраняемых кэшей на key-value сервере (клиент с методами get и set(ex=)
+    как у redis.Redis). Время жизни записи передается серверу, поэтому устаревшие записи удаляет он сам
+    """
+
+    def __init__(self, client, prefix: str = 'hotelbot:'):
+        """
+        первичная инициализация класса
+        :param client: клиент key-value сервера
+        :param prefix: префикс ключей бота на сервере
+        """
+        self.client = client
+        self.prefix: str = prefix
+
+    def get(self, namespace: str, key: str) -> Optional[Tuple[str, float]]:
+        """Возвращает не устаревшую запись: значение и время устаревания, либо None"""
+        raw = self.client.get(f'{self.prefix}{namespace}:{key}')
+        if raw is None:
+            return None
+        value, expires_at = json.loads(raw)
+        return None if expires_at <= time.time() else (value, expires_at)
+
+    def set(self, namespace: str, key: str, value: str, expires_at: float) -> None:
+        """Сохраняет запись со временем жизни до expires_at"""
+        self.client.set(f'{self.prefix}{namespace}:{key}', json.dumps([value, expires_at]),
+                        ex=max(1, math.ceil(expires_at - time.time())))
+
+
+class LocalKeyValue:
+    """
+    Класс, заменяющий key-value сервер в памяти процесса (поддерживает get, set и delete клиента redis).
+    Предназначен для проверки KeyValueCacheBackend без сервера: записи не разделяются между процессами
+    """
+
+    def __init__(self):
+        """первичная инициализация класса"""
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[Any]:
+        """Возвращает значение ключа, либо None, если ключа нет или его время жизни истекло"""
+        with self._lock:
+            item = self._data.get(name)
+            if item is not None and item[1] is not None and item[1] <= time.monotonic():
+                del self._data[name]
+                item = None
+        return None if item is None else item[0]
+
+    def set(self, name: str, value: Any, ex: Optional[float] = None) -> bool:
+        """Сохраняет значение ключа со временем жизни ex секунд"""
+        with self._lock:
+            self._data[name] = (value, None if ex is None else time.monotonic() + ex)
+        return True
+
+    def delete(self, *names: str) -> int:
+        """Удаляет ключи и возвращает количество удаленных"""
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+
+def create_backend(url: str, model, database):
+    """
+    Создает хранилище сохраняемых кэшей по адресу из настройки CACHE_BACKEND
+    :param url: 'sqlite' - таблица CachedValue, 'memory' - LocalKeyValue,
+    'redis://host:port/db' - сервер redis (требуется пакет redis)
+    :param model: модель peewee таблицы CachedValue
+    :param database: база peewee
+    """
+    if url == 'sqlite':
+        return SqliteCacheBackend(model, database)
+    if url == 'memory':
+        return KeyValueCacheBackend(LocalKeyValue())
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        if redis is None:
+            raise RuntimeError('Для CACHE_BACKEND=redis необходимо установить пакет redis')
+        return KeyValueCacheBackend(redis.Redis.from_url(url))
+    raise ValueError(f'Неизвестное хранилище кэшей {url}')
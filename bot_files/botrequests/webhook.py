@@ -0,0 +1,116 @@
+import hmac
+import json
+import os
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+
+from loguru import logger
+from telebot.types import Update
+
+
+class WebhookServer:
+    """
+    Класс, реализующий встроенный http-сервер для приема обновлений telegram через webhook.
+    Проверяет секретный токен из заголовка X-Telegram-Bot-Api-Secret-Token и передает обновления
+    в bot.process_new_updates. Тело запроса может содержать одно обновление или список обновлений,
+    которые обрабатываются одним пакетом
+    """
+
+    def __init__(self, bot, host: str = os.getenv('WEBHOOK_HOST', '0.0.0.0'),
+                 port: int = int(os.getenv('WEBHOOK_PORT', 8443)),
+                 path: str = os.getenv('WEBHOOK_PATH', '/telegram'),
+                 secret_token: Optional[str] = os.getenv('WEBHOOK_SECRET')):
+        """
+        первичная инициализация класса
+        :param bot: бот или ShardRouter
+        :param host: адрес, на котором принимаются запросы
+        :param port: порт
+        :param path: путь, на который telegram отправляет обновления
+        :param secret_token: секретный токен, передаваемый при установке webhook. Если он не задан,
+        генерируется случайный: запросы без токена не принимаются
+        """
+        self.bot = bot
+        self.path: str = path
+        if not secret_token:
+            secret_token = secrets.token_urlsafe(32)
+            logger.info('webhook: WEBHOOK_SECRET не задан, используется случайный секретный токен')
+        self.secret_token: str = secret_token
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """Возвращает порт, на котором запущен сервер"""
+        return self.server.server_address[1]
+
+    def authorized(self, token: Optional[str]) -> bool:
+        """Проверяет секретный токен запроса"""
+        return token is not None and hmac.compare_digest(token, self.secret_token)
+
+    def process(self, body: bytes) -> int:
+        """
+        Разбирает тело запроса и передает обновления боту. Если вместо бота задан ShardRouter,
+        обновления передаются процессам-обработчикам без разбора
+        :param body: тело запроса
+        :return: количество обработанных обновлений
+        """
+        data = json.loads(body)
+        items: List = data if isinstance(data, list) else [data]
+        process_raw_updates: Optional[Callable] = getattr(self.bot, 'process_raw_updates', None)
+        if process_raw_updates is not None:
+            if items:
+                process_raw_updates(items)
+            return len(items)
+        updates: List[Update] = [Update.de_json(item) for item in items]
+        if updates:
+            self.bot.process_new_updates(updates)
+        return len(updates)
+
+    def _handler(self):
+        """Создает класс обработчика http-запросов, связанный с сервером"""
+        webhook = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            """Обработчик http-запросов от telegram"""
+
+            def do_POST(self):
+                if self.path != webhook.path:
+                    self.send_error(404)
+                    return
+                if not webhook.authorized(self.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+                    logger.info(f'webhook: запрос с неверным секретным токеном от {self.client_address[0]}')
+                    self.send_error(403)
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    webhook.process(body)
+                except (KeyError, TypeError, ValueError) as err:
+                    logger.info(f'webhook: некорректное тело запроса: {err}')
+                    self.send_error(400)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return WebhookHandler
+
+    def start(self) -> None:
+        """Запускает сервер в фоновом потоке"""
+        self._thread = threading.Thread(target=self.server.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        logger.info(f'webhook: сервер запущен на порту {self.port}, путь {self.path}')
+
+    def stop(self) -> None:
+        """Прекращает прием запросов и дожидается завершения обрабатываемых"""
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        logger.info('webhook: сервер остановлен')
@@ -0,0 +1,414 @@
+"""
+Сквозной бенчмарк бота без RapidAPI и telegram. Запуск из каталога bot_files:
+    python e2e_benchmark.py [--users 1000] [--concurrency 32] [--cities 50] [--api-latency 50]
+                            [--telegram-latency 5] [--recordings dir] [--rate-limits]
+
+Поднимает локальную заглушку RapidAPI, которая отдает записанные ответы (файлы locations.json, list.json,
+details.json и photos.json из --recordings или встроенные образцы) с заданной задержкой, и поддельный
+Bot API telegram, который запоминает отправленные сообщения. Затем прогоняет users пользователей
+по сценарию /lowprice → город → выбор города → количество отелей → гости → даты → отель → фото → количество фото
+через обработчики main.py и выводит задержки p50/p95/p99 по шагам, пропускную способность,
+количество sql-запросов и память процесса.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+ENDPOINTS: Dict[str, str] = {'/locations/v2/search': 'locations', '/properties/list': 'list',
+                             '/properties/get-details': 'details', '/properties/get-hotel-photos': 'photos'}
+BOT_USER: Dict = {'id': 1, 'is_bot': True, 'first_name': 'FindYourHotelBot'}
+
+
+def percentile(values: List[float], share: float) -> float:
+    """Возвращает перцентиль share (от 0 до 1) отсортированного списка значений"""
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))] if values else 0.0
+
+
+def sample_photos_payload(photos: int = 20) -> bytes:
+    """Возвращает ответ properties/get-hotel-photos в формате API"""
+    return json.dumps({'hotelId': 100000, 'hotelImages': [
+        {'baseUrl': f'https://exp.cdn-hotels.com/hotels/{num}_{{size}}.jpg', 'imageId': num,
+         'sizes': [{'suffix': suffix, 'type': num} for num, suffix in enumerate('bdegnstyz')]}
+        for num in range(photos)]}).encode()
+
+
+def city_name(num: int) -> str:
+    """
+    Возвращает название города номер num. Названия разных номеров не похожи друг на друга,
+    поэтому локальный индекс городов не принимает их за опечатки
+    """
+    return ''.join('bdfgklmnprstvz'[int(char, 16) % 14] + 'aeiou'[int(char, 16) % 5]
+                   for char in format(zlib.crc32(str(num).encode()), '08x')[:4]).capitalize()
+
+
+def sample_city_payload(query: str) -> bytes:
+    """Возвращает ответ locations/v2/search с одним городом, destinationId которого зависит от запроса"""
+    return json.dumps({'term': query, 'suggestions': [
+        {'group': 'CITY_GROUP', 'entities': [
+            {'type': 'CITY', 'caption': f'{query}, <span class="highlighted">Russia</span>',
+             'destinationId': str(zlib.crc32(query.encode())), 'name': query}]},
+        {'group': 'HOTEL_GROUP', 'entities': []}]}).encode()
+
+
+class FakeRapidApi:
+    """
+    Класс, реализующий локальную заглушку RapidAPI: отдает записанные ответы четырех методов,
+    используемых Request, с задержкой latency и считает запросы к каждому методу
+    """
+
+    def __init__(self, latency: float, recordings: Optional[str] = None):
+        """
+        первичная инициализация класса
+        :param latency: задержка ответа в секундах
+        :param recordings: каталог с записанными ответами (locations.json, list.json, details.json, photos.json)
+        """
+        import benchmark
+
+        self.latency: float = latency
+        self.requests: Dict[str, int] = {name: 0 for name in ENDPOINTS.values()}
+        self.responses: Dict[str, bytes] = {'list': benchmark.sample_hotels_payload(),
+                                            'details': benchmark.sample_details_payload(),
+                                            'photos': sample_photos_payload()}
+        for name in ENDPOINTS.values():
+            path: str = os.path.join(recordings or '', f'{name}.json')
+            if recordings and os.path.exists(path):
+                self.responses[name] = open(path, 'rb').read()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        """Возвращает адрес заглушки для RAPIDAPI_URL"""
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def respond(self, path: str) -> Tuple[int, bytes]:
+        """Возвращает код и тело ответа на запрос path"""
+        parts = urlsplit(path)
+        name: Optional[str] = ENDPOINTS.get(parts.path)
+        if name is None:
+            return 404, b''
+        with self._lock:
+            self.requests[name] += 1
+        time.sleep(self.latency)
+        if name == 'locations' and name not in self.responses:
+            return 200, sample_city_payload(dict(parse_qsl(parts.query)).get('query', ''))
+        return 200, self.responses[name]
+
+    def _handler(self):
+        """Создает класс обработчика http-запросов, связанный с заглушкой"""
+        stub = self
+
+        class RapidApiHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                status, body = stub.respond(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return RapidApiHandler
+
+    def start(self) -> None:
+        """Запускает заглушку в фоновом потоке"""
+        threading.Thread(target=self.server.serve_forever, name='fake-rapidapi', daemon=True).start()
+
+    def stop(self) -> None:
+        """Останавливает заглушку"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeTelegram:
+    """
+    Класс, реализующий поддельный Bot API telegram: отвечает на методы отправки и правки сообщений
+    как telegram, запоминает последнюю inline клавиатуру каждого чата и считает вызовы методов
+    """
+
+    def __init__(self, latency: float):
+        """
+        первичная инициализация класса
+        :param latency: задержка ответа в секундах
+        """
+        self.latency: float = latency
+        self.calls: Dict[str, int] = dict()
+        self.keyboards: Dict[int, Tuple[int, List[List[Dict]]]] = dict()
+        self._message_id: int = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def api_url(self) -> str:
+        """Возвращает шаблон адреса для telebot.apihelper.API_URL"""
+        return f'http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}'
+
+    def message(self, chat_id: int, message_id: Optional[int] = None, photo: bool = False, **fields) -> Dict:
+        """Возвращает объект Message ответа telegram"""
+        with self._lock:
+            if message_id is None:
+                self._message_id += 1
+                message_id = self._message_id
+        result: Dict = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                        'chat': {'id': chat_id, 'type': 'private'}, **fields}
+        if photo:
+            result['photo'] = [{'file_id': f'photo{message_id}', 'file_unique_id': f'u{message_id}',
+                                'width': 1280, 'height': 960}]
+        return result
+
+    def respond(self, method: str, params: Dict) -> Any:
+        """Выполняет метод Bot API и возвращает поле result ответа"""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        time.sleep(self.latency)
+        chat_id: int = int(params.get('chat_id', 0))
+        if method in ('sendMessage', 'editMessageText', 'editMessageReplyMarkup'):
+            message_id: Optional[int] = int(params['message_id']) if 'message_id' in params else None
+            result: Dict = self.message(chat_id, message_id, text=params.get('text', ''))
+            if 'reply_markup' in params:
+                keyboard: List = json.loads(params['reply_markup']).get('inline_keyboard')
+                if keyboard:
+                    with self._lock:
+                        self.keyboards[chat_id] = (result['message_id'], keyboard)
+            return result
+        if method == 'sendPhoto':
+            return self.message(chat_id, photo=True)
+        if method == 'sendMediaGroup':
+            return [self.message(chat_id, photo=True) for _ in json.loads(params['media'])]
+        return True
+
+    def keyboard(self, chat_id: int) -> Tuple[int, List[Dict]]:
+        """Возвращает id сообщения и кнопки последней inline клавиатуры чата"""
+        with self._lock:
+            message_id, rows = self.keyboards[chat_id]
+        return message_id, [button for row in rows for button in row]
+
+    def _handler(self):
+        """Создает класс обработчика http-запросов, связанный с поддельным telegram"""
+        fake = self
+
+        class TelegramHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def handle_method(self):
+                parts = urlsplit(self.path)
+                params: Dict = dict(parse_qsl(parts.query))
+                length: int = int(self.headers.get('Content-Length', 0))
+                if length:
+                    params.update(parse_qsl(self.rfile.read(length).decode()))
+                body: bytes = json.dumps({'ok': True, 'result': fake.respond(parts.path.rsplit('/', 1)[-1],
+                                                                             params)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = handle_method
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return TelegramHandler
+
+    def start(self) -> None:
+        """Запускает поддельный telegram в фоновом потоке"""
+        threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True).start()
+
+    def stop(self) -> None:
+        """Останавливает поддельный telegram"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SimulatedUser:
+    """
+    Класс, реализующий пользователя, проходящего сценарий поиска: отправляет боту обновления
+    и выбирает кнопки из клавиатур, которые бот отправил в поддельный telegram
+    """
+
+    def __init__(self, chat_id: int, city: str, telegram: FakeTelegram, bot, timings: Dict[str, List[float]]):
+        """
+        первичная инициализация класса
+        :param chat_id: id чата пользователя
+        :param city: название города для поиска
+        :param telegram: поддельный telegram
+        :param bot: бот telebot (threaded=False), обработчики которого вызываются напрямую
+        :param timings: словарь, в который добавляются задержки шагов
+        """
+        self.chat_id: int = chat_id
+        self.city: str = city
+        self.telegram: FakeTelegram = telegram
+        self.bot = bot
+        self.timings: Dict[str, List[float]] = timings
+        self._update_id: int = chat_id * 100
+
+    def user(self) -> Dict:
+        """Возвращает объект User пользователя"""
+        return {'id': self.chat_id, 'is_bot': False, 'first_name': 'User'}
+
+    def send(self, step: str, update: Dict) -> None:
+        """Передает обновление боту и учитывает время его обработки как задержку шага step"""
+        from telebot.types import Update
+
+        self._update_id += 1
+        update['update_id'] = self._update_id
+        started: float = time.perf_counter()
+        self.bot.process_new_updates([Update.de_json(update)])
+        self.timings.setdefault(step, []).append(time.perf_counter() - started)
+
+    def text(self, step: str, text: str) -> None:
+        """Отправляет текстовое сообщение или команду"""
+        message: Dict = {'message_id': 0, 'date': int(time.time()), 'from': self.user(), 'text': text,
+                         'chat': {'id': self.chat_id, 'type': 'private'}}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        self.send(step, {'message': message})
+
+    def press(self, step: str, suffix: str, pick: int = 0) -> str:
+        """
+        Нажимает кнопку последней клавиатуры чата, callback data которой содержит suffix
+        :param pick: номер кнопки среди подходящих (-1 - последняя)
+        :return: callback data нажатой кнопки
+        """
+        message_id, buttons = self.telegram.keyboard(self.chat_id)
+        data: str = [button['callback_data'] for button in buttons if suffix in button['callback_data']][pick]
+        self.send(step, {'callback_query': {
+            'id': str(self._update_id), 'from': self.user(), 'chat_instance': str(self.chat_id), 'data': data,
+            'message': {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER, 'text': '',
+                        'chat': {'id': self.chat_id, 'type': 'private'}}}})
+        return data
+
+    def pick_date(self, step: str, target: date) -> None:
+        """Выбирает в календаре год, месяц и день даты target"""
+        for level, value in (('y', f'_{target.year}_'), ('m', f'_{target.year}_{target.month}_'),
+                             ('d', f'_{target.year}_{target.month}_{target.day}')):
+            self.press('calendar' if level != 'd' else step, f'cbcal_0_s_{level}{value}')
+
+    def run(self) -> None:
+        """Проходит сценарий /lowprice от команды до фотографий отеля"""
+        check_in: date = date.today() + timedelta(days=30)
+        self.text('command', '/lowprice')
+        self.text('city', self.city)
+        self.press('city_choice', '.city_id')
+        self.text('hotels_count', '3')
+        self.text('guests', '2')
+        self.pick_date('check_in', check_in)
+        self.pick_date('check_out_search', check_in + timedelta(days=2))
+        self.press('hotel', '.hotel_id')
+        self.press('photos_answer', 'Yes.photo')
+        self.text('photos_details', '3')
+
+
+def run_load(users: int, concurrency: int, cities: int, telegram: FakeTelegram, bot) -> Dict:
+    """
+    Прогоняет users пользователей через сценарий поиска в concurrency потоках
+    :return: задержки шагов, время прогона и количество пользователей, завершивших сценарий с ошибкой
+    """
+    timings: Dict[str, List[float]] = dict()
+    failed: List[int] = []
+
+    def simulate(num: int) -> None:
+        try:
+            SimulatedUser(1000 + num, city_name(num % cities), telegram, bot, timings).run()
+        except Exception as err:
+            failed.append(num)
+            print(f'пользователь {num}: {err!r}', file=sys.stderr)
+
+    started: float = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(simulate, range(users)))
+    return {'timings': timings, 'seconds': time.perf_counter() - started, 'failed': len(failed)}
+
+
+def report(result: Dict, queries: int, users: int, rapidapi: FakeRapidApi, telegram: FakeTelegram,
+           rss_before: int) -> None:
+    """Выводит задержки по шагам, пропускную способность, sql-запросы и память"""
+    print(f"{'шаг':<18}{'p50, мс':>9}{'p95, мс':>9}{'p99, мс':>9}{'n':>7}")
+    updates: int = 0
+    for step, values in result['timings'].items():
+        values.sort()
+        updates += len(values)
+        print(f'{step:<18}{percentile(values, 0.5) * 1000:>9.1f}{percentile(values, 0.95) * 1000:>9.1f}'
+              f'{percentile(values, 0.99) * 1000:>9.1f}{len(values):>7}')
+    print(f"пользователей {users} (с ошибкой {result['failed']}) за {result['seconds']:.1f} с: "
+          f"{users / result['seconds']:.1f} сценариев/с, {updates / result['seconds']:.0f} обновлений/с")
+    print(f'sql-запросов: {queries} ({queries / users:.1f} на сценарий)')
+    print(f'запросов к RapidAPI: {rapidapi.requests}')
+    print(f'вызовов Bot API: {telegram.calls}')
+    rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'пиковая память процесса: {rss / 1024:.0f} МБ (прирост за прогон {(rss - rss_before) / 1024:.0f} МБ)')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='количество пользователей')
+    parser.add_argument('--concurrency', type=int, default=32, help='количество одновременных пользователей')
+    parser.add_argument('--cities', type=int, default=50, help='количество разных городов (попадания в кэши)')
+    parser.add_argument('--api-latency', type=float, default=50, help='задержка ответа RapidAPI, мс')
+    parser.add_argument('--telegram-latency', type=float, default=5, help='задержка ответа Bot API, мс')
+    parser.add_argument('--recordings', help='каталог с записанными ответами RapidAPI')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='оставить ограничения частоты запросов к RapidAPI и telegram из настроек')
+    args = parser.parse_args()
+
+    # настройки читаются при импорте модулей бота, поэтому задаются до него
+    os.environ.update({'DB_PATH': os.path.join(tempfile.mkdtemp(), 'e2e.db'), 'TOKEN_TELEGRAM': '0:e2e',
+                       'x-rapidapi-key': 'e2e'})
+    if not args.rate_limits:
+        os.environ.update({'RAPIDAPI_RATE_LIMIT': '0', 'RAPIDAPI_MONTHLY_QUOTA': '0', 'TELEGRAM_RATE_LIMIT': '0',
+                           'TELEGRAM_CHAT_RATE_LIMIT': '0'})
+
+    from loguru import logger
+    logger.remove()
+    from telebot import apihelper
+
+    import benchmark
+    import main as bot_main
+    from botrequests import bot_func as bf
+    from botrequests.bot_classes import Request
+    from botrequests.history import history_log
+    from botrequests.send_queue import send_queue
+    from botrequests.session_store import session_store
+
+    rapidapi = FakeRapidApi(args.api_latency / 1000, args.recordings)
+    telegram = FakeTelegram(args.telegram_latency / 1000)
+    Request.base_url = rapidapi.url
+    apihelper.API_URL = telegram.api_url
+    rapidapi.start()
+    telegram.start()
+    bf.create_database()
+    rss_before: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with benchmark.QueryCounter() as counter:
+            result: Dict = run_load(args.users, args.concurrency, args.cities, telegram, bot_main.bot.bot)
+            session_store.flush()
+            history_log.flush()
+    finally:
+        send_queue.stop()
+        rapidapi.stop()
+        telegram.stop()
+    report(result, counter.count, args.users, rapidapi, telegram, rss_before)
+
+
+if __name__ == '__main__':
+    main()
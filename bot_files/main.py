@@ -1,5 +1,7 @@
 import os
-from typing import Dict
+import signal
+import threading
+from typing import Dict, Optional
 
 import telebot
 from dotenv import load_dotenv
@@ -8,14 +10,35 @@ from telebot.types import ReplyKeyboardMarkup, KeyboardButton, Message, Callback
 from telegram_bot_calendar import DetailedTelegramCalendar
 
 import botrequests.bot_func as bf
+from botrequests.bot_classes import hotel_index, rapidapi_limiter
+from botrequests.city_index import CITY_INDEX_PATH, city_index
+from botrequests.conversation import restore, set_step
+from botrequests.date_picker import date_picker
+from botrequests.dispatcher import dispatcher
+from botrequests.history import history_log
+from botrequests.metrics import MetricsServer, TraceMiddleware, metrics, setup_logging
+from botrequests.prefetch import prefetcher
+from botrequests.retention import session_retention
+from botrequests.send_queue import QueuedBot, send_queue
+from botrequests.session_store import session_store
+from botrequests.shard import ShardRouter, serve_shard, shard_of
+from botrequests.webhook import WebhookServer
 
 load_dotenv()
 
-bot = telebot.TeleBot(os.getenv('TOKEN_TELEGRAM'))
+bot = QueuedBot(telebot.TeleBot(os.getenv('TOKEN_TELEGRAM'), threaded=False, use_class_middlewares=True), send_queue)
+bot.setup_middleware(TraceMiddleware(metrics))
 
 service_messages: Dict = {'/lowprice': 'PRICE',
                           '/highprice': 'PRICE_HIGHEST_FIRST',
-                          '/bestdeal': 'DISTANCE_FROM_LANDMARK'}
+                          '/bestdeal': 'DISTANCE_FROM_LANDMARK',
+                          '/flexprice': 'FLEX_PRICE'}
+
+
+@bot.message_handler(func=bf.conversation.expects, content_types=['text'])
+def next_step_handler(message: Message):
+    """ Передает сообщение обработчику текущего шага диалога"""
+    bf.conversation.handle(message, bot)
 
 
 @bot.message_handler(commands=['start'])
@@ -31,34 +54,45 @@ def help_handler(message: Message):
     """ Обработчик команды help"""
     keyboard_menu = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
     keyboard_menu.add(KeyboardButton('/lowprice'), KeyboardButton('/highprice'),
-                      KeyboardButton('/bestdeal'), KeyboardButton('/history'))
+                      KeyboardButton('/bestdeal'), KeyboardButton('/flexprice'), KeyboardButton('/history'))
     bot.send_message(message.chat.id, 'В меню используйте следующие команды:\n'
                                       '/lowprice - Поиск отелей с демократическими ценами\n'
                                       '/highprice - Поиск отелей с максимальными ценами\n'
                                       '/bestdeal - Поиск доступных отелей по удаленности от центра города\n'
-                                      '/history - Просмотр результатов последнего запроса', reply_markup=keyboard_menu)
+                                      '/flexprice - Поиск самых низких цен на даты рядом с выбранными\n'
+                                      '/history - Просмотр истории поиска', reply_markup=keyboard_menu)
 
 
-@bot.message_handler(commands=['lowprice', 'highprice', 'bestdeal'])
+@bot.message_handler(commands=['lowprice', 'highprice', 'bestdeal', 'flexprice'])
 def request_handler(message: Message):
-    """ Обработчик команд lowprice, highprice, bestdeal """
+    """ Обработчик команд lowprice, highprice, bestdeal, flexprice """
     logger.info(f'message {message.from_user.id}{message.text}')
     bf.add_new_save(message, service_messages[message.text])
-    msg = bot.send_message(message.chat.id, 'В каком городе ищем отели? ')
-    bot.register_next_step_handler(msg, bf.search_city, bot)
+    bot.send_message(message.chat.id, 'В каком городе ищем отели? ')
+    set_step(message, 'search_city')
+
+
+@bot.message_handler(commands=['history'])
+def history_handler(message: Message):
+    """ Обработчик команды history"""
+    logger.info(f'message {message.from_user.id}{message.text}')
+    bf.show_history(message, bot)
+
+
+@bot.message_handler(commands=['stats'], func=bf.is_admin)
+def stats_handler(message: Message):
+    """ Обработчик команды администратора stats"""
+    logger.info(f'message {message.from_user.id}{message.text}')
+    bf.show_stats(message, bot)
 
 
 @bot.callback_query_handler(func=DetailedTelegramCalendar.func())
 def calendar(call: CallbackQuery):
     """ Обработчик inline callback запросов для ввода дат"""
     locale: str = bf.get_value_from_save(call.message, 'locale')[:2]
-    result, key, step = DetailedTelegramCalendar(locale=locale).process(call.data)
-    if not result and key:
-        if bf.get_value_from_save(call.message, 'check_in') == '':
-            text_message = 'заезда в отель'
-        else:
-            text_message = 'выезда из отеля'
-        bot.edit_message_text('Введите дату ' + text_message,
+    result, key = date_picker.process(locale, call.data)
+    if key:
+        bot.edit_message_text(bf.dates_text(call.message),
                               call.message.chat.id,
                               call.message.message_id,
                               reply_markup=key)
@@ -67,25 +101,18 @@ def calendar(call: CallbackQuery):
                               call.message.chat.id,
                               call.message.message_id)
         logger.info(f'call chat_id {call.from_user.id}: {call.data}')
-        if bf.get_value_from_save(call.message, 'check_in') == '':
-            bf.update_save(call.message, 'check_in', result)
-        else:
-            bf.update_save(call.message, 'check_out', result)
-
-        if bf.get_value_from_save(call.message, 'check_out') == '':
+        dates = date_picker.choose(call.message.chat.id, result)
+        if dates is None:
             bf.check_dates(call.message, bot)
+        elif bf.validation_dates(call.message, *dates):
+            logger.info(f'message {call.message.from_user.id}: Даты введены корректно')
+            date_picker.save(call.message.chat.id, *dates)
+            bf.search_hotels(call.message, bot)
         else:
-            if bf.validation_dates(call.message, bot):
-                logger.info(f'message {call.message.from_user.id}: Даты введены корректно')
-                bf.search_hotels(call.message, bot)
-
-            else:
-                bot.send_message(call.message.chat.id, 'Возможно Вы ошиблись при вводе данных.'
-                                                       ' Дата выезда не может быть раньше или равна дате въезда.'
-                                                       'Попробуйте ввести их еще раз')
-                bf.update_save(call.message, 'check_in', '')
-                bf.update_save(call.message, 'check_out', '')
-                bf.check_dates(call.message, bot)
+            bot.send_message(call.message.chat.id, 'Возможно Вы ошиблись при вводе данных.'
+                                                   ' Дата выезда не может быть раньше или равна дате въезда.'
+                                                   'Попробуйте ввести их еще раз')
+            bf.check_dates(call.message, bot)
 
 
 @bot.callback_query_handler(func=lambda call: True)
@@ -95,19 +122,23 @@ def callback_inline(call: CallbackQuery):
     data_sep = call.data.split('.')
     if data_sep[1] == 'city_id':
         bf.update_save(call.message, 'city_id', data_sep[0])
-        msg = bot.send_message(call.message.chat.id, 'Сколько вариантов отелей показывать? Прошу ограничится 25')
-        bot.register_next_step_handler(msg, bf.number_hotels, bot)
+        bot.send_message(call.message.chat.id, 'Сколько вариантов отелей показывать? Прошу ограничится 25')
+        set_step(call.message, 'number_hotels')
     elif data_sep[1] == 'hotel_id':
-        bf.update_save(call.message, 'hotel_id', data_sep[0])
+        bf.choose_hotel(call.message, data_sep[0])
         bf.check_photo(call.message, bot)
     elif data_sep[1] == 'photo':
         if data_sep[0] == 'No':
             bf.update_save(call.message, 'hotel_pics', '0')
             bf.search_hotel_info(call.message, bot)
         else:
-            msg = bot.send_message(call.message.chat.id,
-                                   'Сколько фотографий данного отеля показывать? Прошу ограничится 15')
-            bot.register_next_step_handler(msg, bf.number_photos, bot)
+            bot.send_message(call.message.chat.id,
+                             'Сколько фотографий данного отеля показывать? Прошу ограничится 15')
+            set_step(call.message, 'number_photos')
+    elif data_sep[1] == 'results':
+        bf.turn_results_page(call, bot)
+    elif data_sep[1] == 'history':
+        bf.turn_history_page(call, bot)
 
 
 @bot.message_handler(content_types=['text'])
@@ -120,8 +151,126 @@ def text_handler(message):
                                       ' используя команду /start')
 
 
+def run_webhook(target) -> None:
+    """
+    Принимает обновления через webhook до получения SIGINT или SIGTERM
+    :param target: бот или ShardRouter, которому передаются обновления
+    """
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda *args: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+    server = WebhookServer(target)
+    server.start()
+    bot.set_webhook(url=os.getenv('WEBHOOK_URL'), secret_token=server.secret_token)
+    try:
+        stop_event.wait()
+    finally:
+        bot.remove_webhook()
+        server.stop()
+
+
+def start_metrics_server(offset: int = 0) -> Optional[MetricsServer]:
+    """
+    Запускает сервер метрик на порту METRICS_PORT + offset (0 в METRICS_PORT отключает сервер)
+    :param offset: смещение порта (номер процесса-обработчика + 1 при запуске в нескольких процессах)
+    """
+    port: int = int(os.getenv('METRICS_PORT', 9108))
+    if port == 0:
+        return None
+    server = MetricsServer(metrics, port=port + offset)
+    server.start()
+    return server
+
+
+def run_shard(shard: int, processes: int, updates, ready) -> None:
+    """
+    Процесс-обработчик обновлений своей доли чатов при запуске в нескольких процессах (BOT_PROCESSES > 1).
+    Ограничения частоты запросов к telegram и RapidAPI делятся между процессами поровну
+    :param shard: номер процесса
+    :param processes: количество процессов
+    :param updates: очередь пакетов обновлений от главного процесса
+    :param ready: событие готовности процесса
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(f'botrequests/logs_{shard}.log')
+    metrics_server: Optional[MetricsServer] = start_metrics_server(shard + 1)
+    send_queue.share(processes)
+    rapidapi_limiter.share(processes, shard)
+    restore(lambda chat_id: shard_of(chat_id, processes) == shard)
+    city_index.load(CITY_INDEX_PATH)
+    session_store.start()
+    history_log.start()
+    hotel_index.start()
+    dispatcher.start()
+    dispatcher.dispatch(bot.bot)
+    try:
+        serve_shard(bot.bot, updates, ready)
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        dispatcher.stop()
+        send_queue.stop()
+        rapidapi_limiter.quota.save()
+        city_index.save(CITY_INDEX_PATH)
+        prefetcher.stop()
+        hotel_index.stop()
+        history_log.stop()
+        session_store.stop()
+
+
+def run_sharded(processes: int) -> None:
+    """
+    Главный процесс при запуске в нескольких процессах: получает обновления и распределяет их
+    между процессами-обработчиками по chat_id, а также выполняет фоновую очистку базы
+    :param processes: количество процессов-обработчиков
+    """
+    router = ShardRouter(run_shard, processes)
+    router.start()
+    session_retention.start()
+    try:
+        if os.getenv('BOT_MODE', 'polling') == 'webhook':
+            run_webhook(router)
+        else:
+            stop_event = threading.Event()
+            signal.signal(signal.SIGINT, lambda *args: stop_event.set())
+            signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+            bot.remove_webhook()
+            router.polling(bot.token, stop_event)
+    finally:
+        router.stop()
+        session_retention.stop()
+
+
 if __name__ == '__main__':
-    logger.add('botrequests/logs.log', rotation="50 MB", encoding='utf-8')
+    setup_logging('botrequests/logs.log')
     logger.info('Bot is starting')
     bf.create_database()
-    bot.polling(none_stop=True)
+    if int(os.getenv('BOT_PROCESSES', 1)) > 1:
+        run_sharded(int(os.getenv('BOT_PROCESSES', 1)))
+    else:
+        restore()
+        city_index.load(CITY_INDEX_PATH)
+        metrics_server: Optional[MetricsServer] = start_metrics_server()
+        session_store.start()
+        history_log.start()
+        hotel_index.start()
+        session_retention.start()
+        dispatcher.start()
+        dispatcher.dispatch(bot.bot)
+        try:
+            if os.getenv('BOT_MODE', 'polling') == 'webhook':
+                run_webhook(bot.bot)
+            else:
+                bot.polling(none_stop=True)
+        finally:
+            if metrics_server is not None:
+                metrics_server.stop()
+            dispatcher.stop()
+            send_queue.stop()
+            rapidapi_limiter.quota.save()
+            city_index.save(CITY_INDEX_PATH)
+            prefetcher.stop()
+            session_retention.stop()
+            hotel_index.stop()
+            history_log.stop()
+            session_store.stop()
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'test_bot.db')
+os.environ['CACHE_BACKEND'] = 'sqlite'
+os.environ['TOKEN_TELEGRAM'] = '123456:TEST'
+
+
+@pytest.fixture(scope='session')
+def database():
+    """База бота во временном файле с созданными таблицами"""
+    import botrequests.bot_func as bf
+    from botrequests.bot_classes import db
+
+    bf.create_database()
+    return db
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from datetime import date, timedelta
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+import botrequests.async_func as af
+import botrequests.bot_classes as bot_classes
+import botrequests.bot_func as bf
+from benchmark import fake_message
+from botrequests.bot_classes import API_KEYS, AsyncApiClient, Request
+from botrequests.conversation import current_step
+from botrequests.ratelimit import ApiLimiter, MonthlyQuota, TokenBucket
+from botrequests.records import HotelSummary
+
+
+class FakeBot:
+    """Асинхронный бот, который запоминает отправленные сообщения"""
+
+    def __init__(self):
+        self.sent: List = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.append((text, reply_markup))
+        return SimpleNamespace(message_id=len(self.sent))
+
+
+def hotel(number: int) -> HotelSummary:
+    return HotelSummary(str(number), f'Hotel {number}', 3, 'street', '100 RUB', 100.0, '1 km', 1.0, 55.0, 37.0)
+
+
+def new_dialog(chat_id: int) -> None:
+    """Создает текущий запрос пользователя с заполненным городом"""
+    bf.add_new_save(fake_message(chat_id), 'PRICE')
+    for key, value in (('query', 'Москва'), ('locale', 'ru_RU'), ('currency', 'RUB'), ('city_id', '1')):
+        bf.update_save(fake_message(chat_id), key, value)
+
+
+def test_dialog_steps_use_shared_replies(database):
+    chat_id = 201
+    new_dialog(chat_id)
+    bot = FakeBot()
+    asyncio.run(af.number_hotels(fake_message(chat_id, '0'), bot))
+    assert bot.sent[-1][0] == bf.number_hotels_reply(fake_message(chat_id, '0')).text
+    assert current_step(chat_id) == 'number_hotels'
+    asyncio.run(af.number_hotels(fake_message(chat_id, '5'), bot))
+    assert current_step(chat_id) == 'number_guests'
+    asyncio.run(af.number_guests(fake_message(chat_id, '2'), bot))
+    assert bot.sent[-1][0] == 'Введите дату заезда в отель' and bot.sent[-1][1] is not None
+    assert current_step(chat_id) == 'dates'
+
+
+def test_search_hotels_records_history_off_event_loop(database, monkeypatch):
+    chat_id = 202
+    new_dialog(chat_id)
+    for key, value in (('number_hotels', '2'), ('number_persons', '1'),
+                       ('check_in', date.today() + timedelta(days=1)), ('check_out', date.today() + timedelta(days=2))):
+        bf.update_save(fake_message(chat_id), key, value)
+    threads: List[int] = []
+
+    async def object_search(func_name, request_queue, message):
+        return [hotel(number) for number in range(5)]
+
+    monkeypatch.setattr(af, 'object_search', object_search)
+    monkeypatch.setattr(bf, 'prefetch_hotels', lambda message, hotels: None)
+    monkeypatch.setattr(af, 'record_history', lambda message, hotels: threads.append(threading.get_ident()))
+    bot = FakeBot()
+    asyncio.run(af.search_hotels(fake_message(chat_id), bot))
+    assert [text for text, markup in bot.sent] == [bf.SEARCH_PROGRESS, 'Найдено несколько отелей. Выберите подходящий:']
+    assert threads and threads[0] != threading.get_ident()
+
+
+@pytest.mark.parametrize('cached', [True, False])
+def test_city_cache_is_used_off_event_loop(monkeypatch, cached):
+    threads: List[int] = []
+
+    def get(key):
+        threads.append(threading.get_ident())
+        return [('Москва, Россия', '1')] if cached else None
+
+    async def aget_response(self, url, current_request):
+        return {}
+
+    monkeypatch.setattr(bot_classes.city_cache, 'get', get)
+    monkeypatch.setattr(bot_classes.city_cache, 'set', lambda key, value: threads.append(threading.get_ident()))
+    monkeypatch.setattr(Request, 'aget_response', aget_response)
+    monkeypatch.setattr(Request, 'parse_city', lambda self, response: [('Москва, Россия', '1')])
+    monkeypatch.setattr(Request, 'local_city', lambda self: [])
+    monkeypatch.setattr(Request, 'suggest_city', lambda self: [])
+    cities, suggested = asyncio.run(Request({'query': 'Москва', 'locale': 'ru_RU'}).aget_city())
+    assert [city.destination_id for city in cities] == ['1'] and not suggested
+    assert len(threads) == (1 if cached else 2)
+    assert threading.get_ident() not in threads
+
+
+def test_hotel_index_is_filled_off_event_loop(monkeypatch):
+    threads: List[int] = []
+
+    async def aget_response(self, url, current_request):
+        return {}
+
+    monkeypatch.setattr(Request, 'aget_response', aget_response)
+    monkeypatch.setattr(Request, 'parse_hotels', staticmethod(lambda response: [hotel(1)]))
+    monkeypatch.setattr(bot_classes.hotel_index, 'add', lambda city_id, hotels: threads.append(threading.get_ident()))
+    hotels = asyncio.run(Request({API_KEYS['city_id']: '1'}).aload_hotels('hotel-index-test'))
+    assert [item.hotel_id for item in hotels] == ['1']
+    assert threads and threads[0] != threading.get_ident()
+
+
+def test_api_quota_is_persisted_off_event_loop():
+    threads: List[int] = []
+
+    class QuotaStore:
+        def get(self, key):
+            threads.append(threading.get_ident())
+            return 1
+
+        def set(self, key, value):
+            threads.append(threading.get_ident())
+
+    async def request():
+        client = AsyncApiClient(retries=0, limiter=ApiLimiter(TokenBucket(0, 1), MonthlyQuota(1, QuotaStore())))
+        try:
+            return await client.get('http://127.0.0.1:9/locations/v2/search', {}, {})
+        finally:
+            await client.close()
+
+    assert asyncio.run(request()) is None
+    assert threads and threading.get_ident() not in threads
+
+
+def test_concurrent_hotel_details_share_one_request(monkeypatch):
+    urls: List[str] = []
+
+    async def aget_response(self, url, current_request):
+        urls.append(url)
+        await asyncio.sleep(0.01)
+        return {'hotelImages': [{'baseUrl': 'http://photo/{size}.jpg'}]}
+
+    monkeypatch.setattr(Request, 'aget_response', aget_response)
+    monkeypatch.setattr(bot_classes.details_cache, 'get', lambda key: None)
+
+    async def search():
+        return await asyncio.gather(*(Request({'id': '1'}).aget_hotel_pics() for _ in range(3)))
+
+    assert asyncio.run(search()) == [['http://photo/z.jpg']] * 3
+    assert len(urls) == 1
@@ -0,0 +1,91 @@
+import asyncio
+import inspect
+import threading
+import time
+
+import pytest
+from telebot.types import Update
+
+import async_main
+import botrequests.bot_func as bf
+from benchmark import fake_message
+from botrequests.bot_classes import db
+from botrequests.conversation import current_step, set_step
+from botrequests.session_store import session_store
+
+
+def text_update(update_id: int, chat_id: int, text: str) -> Update:
+    """Возвращает обновление telegram с текстовым сообщением"""
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+               'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return Update.de_json({'update_id': update_id, 'message': message})
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Сообщения, отправленные асинхронным ботом"""
+    messages = []
+
+    async def send_message(chat_id, text, *args, **kwargs):
+        messages.append(text)
+
+    monkeypatch.setattr(async_main.bot, 'send_message', send_message, raising=False)
+    return messages
+
+
+def test_handler_filters_are_synchronous():
+    # pyTelegramBotAPI 4.7.0 из requirements.txt вызывает фильтр func без await
+    for handler in async_main.bot.message_handlers + async_main.bot.callback_query_handlers:
+        func = handler['filters'].get('func')
+        assert func is None or not inspect.iscoroutinefunction(func)
+
+
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+def test_commands_are_not_routed_to_dialog(database, sent):
+    chat_id = 101
+    bf.add_new_save(fake_message(chat_id), 'PRICE')
+    set_step(fake_message(chat_id), 'number_hotels')
+    asyncio.run(async_main.bot.process_new_updates([text_update(1, chat_id, '/start')]))
+    assert len(sent) == 1 and sent[0].startswith('Приветствую')
+    assert current_step(chat_id) == 'number_hotels'
+
+
+def test_dialog_input_is_routed_to_step(database, sent):
+    chat_id = 102
+    bf.add_new_save(fake_message(chat_id), 'PRICE')
+    set_step(fake_message(chat_id), 'number_hotels')
+    asyncio.run(async_main.bot.process_new_updates([text_update(2, chat_id, '5')]))
+    assert sent == ['Сколько человек будет проживать в отеле:']
+    assert current_step(chat_id) == 'number_guests'
+
+
+def test_text_without_dialog_is_not_routed_to_dialog(database, sent):
+    asyncio.run(async_main.bot.process_new_updates([text_update(3, 103, 'hello')]))
+    assert len(sent) == 1 and sent[0].startswith('Если в меню определены кнопки')
+
+
+@pytest.mark.parametrize('has_session', [True, False])
+def test_dialog_lookup_does_not_query_on_event_loop(database, sent, monkeypatch, has_session):
+    chat_id = 104 if has_session else 105
+    if has_session:
+        bf.add_new_save(fake_message(chat_id), 'PRICE')
+        set_step(fake_message(chat_id), 'number_hotels')
+        session_store.flush(chat_id)
+        session_store.forget(chat_id)
+    threads = []
+    execute_sql = db.execute_sql
+
+    def counted_execute_sql(*args, **kwargs):
+        threads.append(threading.get_ident())
+        return execute_sql(*args, **kwargs)
+
+    monkeypatch.setattr(db, 'execute_sql', counted_execute_sql)
+    asyncio.run(async_main.bot.process_new_updates([text_update(4, chat_id, '5')]))
+    assert threads and threading.get_ident() not in threads
+    if has_session:
+        assert sent == ['Сколько человек будет проживать в отеле:']
+    else:
+        assert len(sent) == 1 and sent[0].startswith('Если в меню определены кнопки')
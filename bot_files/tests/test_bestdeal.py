@@ -0,0 +1,76 @@
+from typing import List
+
+import pytest
+from peewee import OperationalError
+
+from botrequests.bestdeal import BESTDEAL_SORT_ORDER, BestDeal
+from botrequests.bot_classes import API_KEYS, HotelLocation, Request, hotel_index
+from botrequests.records import HotelSummary
+
+PAGE_SIZE = 25
+
+
+def hotel(number: int, distance: float, price: float = 100.0) -> HotelSummary:
+    """Возвращает отель на расстоянии distance километров к северу от центра"""
+    return HotelSummary(str(number), f'Hotel {number}', 3, 'street', f'{price} RUB', price, f'{distance} km',
+                        distance, 55.0 + distance / 111.2, 37.0)
+
+
+@pytest.fixture
+def listing(monkeypatch):
+    """Выдача API, отсортированная по расстоянию: 60 отелей не дальше 2 км, затем 40 дальних"""
+    hotels: List[HotelSummary] = [hotel(number, 0.03 * number) for number in range(60)] + \
+                                 [hotel(number, 5.0 + number) for number in range(60, 100)]
+    requested: List[int] = []
+
+    def get_hotels(self) -> List[HotelSummary]:
+        page: int = int(self.this_query[API_KEYS['page_number']])
+        requested.append(page)
+        return hotels[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+
+    monkeypatch.setattr(Request, 'get_hotels', get_hotels)
+    return requested
+
+
+def search(city_id: str, number_hotels: int) -> BestDeal:
+    query = {API_KEYS['city_id']: city_id, API_KEYS['sort_order']: BESTDEAL_SORT_ORDER,
+             API_KEYS['page_number']: '1'}
+    return BestDeal(query, number_hotels, 0, 1000, 2.0, max_pages=5, page_size=PAGE_SIZE)
+
+
+def test_sparse_index_does_not_truncate_results(database, listing):
+    # индекс заполнен другим поиском: 5 отелей в пределах 2 км и 20 дальних
+    hotel_index.add('sparse', [hotel(number, 0.1 * number) for number in range(5)] +
+                    [hotel(number, 5.0 + number) for number in range(100, 120)])
+    deal = search('sparse', 50)
+    assert deal.eager_pages == 1
+    assert len(deal.search()) == 50
+    assert deal.pages_loaded == 2
+
+
+def test_stops_at_far_hotels(database, listing):
+    deal = search('unknown', 100)
+    assert len(deal.search()) == 60
+    assert deal.pages_loaded == 3
+
+
+def test_index_prefetches_pages_needed_anyway(database, listing):
+    hotel_index.add('dense', [hotel(number, 0.03 * number) for number in range(60)])
+    deal = search('dense', 60)
+    assert deal.eager_pages == 3
+    assert len(deal.search()) == 60
+    assert {1, 2, 3} <= set(listing)
+
+
+def test_failed_index_flush_keeps_hotels(database, monkeypatch):
+    hotel_index.add('flush', [hotel(number, 1.0) for number in range(200, 203)])
+
+    def locked(*args, **kwargs):
+        raise OperationalError('database is locked')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(HotelLocation, 'insert_many', locked)
+        with pytest.raises(OperationalError):
+            hotel_index.flush()
+    assert hotel_index.flush() >= 3
+    assert HotelLocation.select().where(HotelLocation.city_id == 'flush').count() == 3
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import pytest
+from peewee import OperationalError
+
+import botrequests.bot_func as bf
+import botrequests.renderer as renderer
+from botrequests.bot_classes import HistoryQuery
+from botrequests.history import HistoryLog
+
+
+def test_failed_flush_requeues_entries(database, monkeypatch):
+    log = HistoryLog()
+    log.append('history-1', 'PRICE', 'Москва', '2026-11-01', '2026-11-03', ['Hotel 1'])
+
+    def locked(*args, **kwargs):
+        raise OperationalError('database is locked')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(HistoryQuery, 'insert_many', locked)
+        with pytest.raises(OperationalError):
+            log.flush()
+    log.append('history-1', 'PRICE_HIGHEST_FIRST', 'Казань', '2026-11-05', '2026-11-06', ['Hotel 2'])
+    assert log.flush() == 2
+    entries, has_more = log.page('history-1')
+    assert [entry.command for entry in entries] == ['/highprice', '/lowprice']
+    assert not has_more
+
+
+def test_pages_keep_entries_with_same_time(database, monkeypatch):
+    log = HistoryLog(page_size=2)
+    monkeypatch.setattr(bf, 'history_log', log)
+    moment = datetime(2026, 11, 1, 12, 0, 0, 500)
+    saved_query = '{{"command":"/lowprice","city":"{}","check_in":"","check_out":"","hotels":[]}}'
+    rows = [{'chat_id': 'history-2', 'saved_query': saved_query.format(number),
+             'created_at': moment - timedelta(seconds=number // 3)} for number in range(7)]
+    with database:
+        HistoryQuery.insert_many(rows).execute()
+    entries, has_older = log.page('history-2')
+    pages = [[entry.city for entry in entries]]
+    while has_older:
+        cursor = renderer.history_keys(entries, False, has_older)[-1][1]
+        entries, has_newer, has_older = bf.history_page('history-2', *cursor.split('.')[0].split('_'))
+        pages.append([entry.city for entry in entries])
+    assert pages == [['2', '1'], ['0', '5'], ['4', '3'], ['6']]
+    cursor = renderer.history_keys(entries, True, False)[0][1]
+    entries, has_newer, has_older = bf.history_page('history-2', *cursor.split('.')[0].split('_'))
+    assert [entry.city for entry in entries] == ['4', '3'] and has_newer and has_older
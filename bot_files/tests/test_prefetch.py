@@ -0,0 +1,28 @@
+from typing import List
+
+import botrequests.bot_classes as bot_classes
+from botrequests.bot_classes import API_KEYS, Request, TTLCache
+from botrequests.prefetch import Prefetcher
+from botrequests.records import HotelSummary
+
+
+def hotel(number: int) -> HotelSummary:
+    return HotelSummary(str(number), f'Hotel {number}', 3, 'street', '100 RUB', 100.0, '1 km', 1.0, 55.0, 37.0)
+
+
+def test_budget_is_charged_only_for_uncached_details(monkeypatch):
+    cache = TTLCache('details', 100, 60)
+    monkeypatch.setattr(bot_classes, 'details_cache', cache)
+    monkeypatch.setattr('botrequests.prefetch.details_cache', cache)
+    sent: List[str] = []
+    monkeypatch.setattr(Request, 'get_hotel_info', lambda self: sent.append('info'))
+    monkeypatch.setattr(Request, 'get_hotel_pics', lambda self: sent.append('pics'))
+    info_request = {'locale': 'ru_RU'}
+    cache.set(Request({**info_request, API_KEYS['hotel_id']: '1'}).hotel_info_key(), 'info')
+    cache.set(Request({API_KEYS['hotel_id']: '1'}).hotel_pics_key(), ['url'])
+    cache.set(Request({API_KEYS['hotel_id']: '2'}).hotel_pics_key(), ['url'])
+    prefetcher = Prefetcher(top_k=3, workers=1, budget=3)
+    assert prefetcher.prefetch([hotel(1), hotel(2), hotel(3)], info_request) == 2
+    prefetcher.stop()
+    assert prefetcher.spent == 3 and sorted(sent) == ['info', 'info', 'pics']
+    assert cache.stats() == {'hits': 0, 'misses': 0, 'size': 3}
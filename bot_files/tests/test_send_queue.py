@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import time
+from typing import List
+
+from telebot.apihelper import ApiTelegramException
+
+from botrequests.send_queue import AsyncSendQueue, SendQueue
+
+
+def test_rate_limited_chats_do_not_block_other_chats():
+    queue = SendQueue(workers=4, global_rate=0, chat_rate=1, chat_burst=1, retries=0)
+    sent: List[str] = []
+    try:
+        callers = [threading.Thread(target=queue.call, args=(2, chat, sent.append, f'photo {chat}'))
+                   for chat in range(4) for _ in range(3)]
+        for caller in callers:
+            caller.start()
+        time.sleep(0.1)
+        started = time.monotonic()
+        queue.call(0, 'other', sent.append, 'edit')
+        assert time.monotonic() - started < 0.2
+        for caller in callers:
+            caller.join()
+    finally:
+        queue.stop()
+    assert len(sent) == 13
+
+
+def test_higher_priority_call_is_sent_first_when_chat_token_appears():
+    queue = SendQueue(workers=1, global_rate=0, chat_rate=5, chat_burst=1, retries=0)
+    sent: List[str] = []
+    try:
+        queue.call(2, 'chat', sent.append, 'first')
+        photo = threading.Thread(target=queue.call, args=(2, 'chat', sent.append, 'photo'))
+        photo.start()
+        time.sleep(0.05)
+        queue.call(0, 'chat', sent.append, 'edit')
+        photo.join()
+    finally:
+        queue.stop()
+    assert sent == ['first', 'edit', 'photo']
+
+
+def test_retry_after_429():
+    queue = SendQueue(workers=1, global_rate=0, chat_rate=0, chat_burst=1, retries=1)
+    attempts: List[float] = []
+
+    def flaky() -> str:
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise ApiTelegramException('sendMessage', None, {'error_code': 429, 'description': 'Too Many Requests',
+                                                             'parameters': {'retry_after': 0.1}})
+        return 'ok'
+
+    try:
+        assert queue.call(1, 'chat', flaky) == 'ok'
+    finally:
+        queue.stop()
+    assert attempts[1] - attempts[0] >= 0.1
+    assert queue.stats()['throttled_429'] == 1
+
+
+def test_async_queue_does_not_block_on_chat_limit():
+    async def scenario() -> float:
+        queue = AsyncSendQueue(workers=2, global_rate=0, chat_rate=1, chat_burst=1, retries=0)
+
+        async def send(text: str) -> str:
+            return text
+
+        photos = [asyncio.ensure_future(queue.call(2, chat, send, 'photo')) for chat in range(2) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        started = time.monotonic()
+        assert await queue.call(0, 'other', send, 'edit') == 'edit'
+        elapsed = time.monotonic() - started
+        await asyncio.gather(*photos)
+        await queue.stop()
+        return elapsed
+
+    assert asyncio.run(scenario()) < 0.2
@@ -0,0 +1,87 @@
+import threading
+from datetime import date
+
+import pytest
+from peewee import OperationalError
+
+from botrequests.bot_classes import Session
+from botrequests.date_picker import DatePicker, date_picker
+from botrequests.session_store import SessionStore, session_store
+
+
+@pytest.fixture
+def store(database):
+    return SessionStore(max_idle=60)
+
+
+def saved(chat_id: str) -> Session:
+    return Session.select().where(Session.chat_id == chat_id).order_by(Session.id.desc()).first()
+
+
+def new_row(store: SessionStore, chat_id: str) -> None:
+    store.new_session(chat_id, sort_order='PRICE', query='', city_id='', locale='', currency='', number_hotels='',
+                      number_persons='', check_in='', check_out='', hotel_id='', hotel_pics='', price_start='',
+                      price_stop='', distance='', page_number='1')
+
+
+def test_failed_flush_keeps_changes(store, monkeypatch):
+    new_row(store, 'flush-1')
+    store.set('flush-1', 'city_id', '42')
+
+    def locked(*args, **kwargs):
+        raise OperationalError('database is locked')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(Session, 'update', locked)
+        with pytest.raises(OperationalError):
+            store.flush()
+    assert saved('flush-1').city_id == ''
+    assert store.flush('flush-1') == 1
+    assert saved('flush-1').city_id == '42'
+
+
+def test_flush_does_not_block_readers(store, monkeypatch):
+    new_row(store, 'flush-2')
+    new_row(store, 'flush-3')
+    store.set('flush-2', 'city_id', '1')
+    writing, release = threading.Event(), threading.Event()
+    update = Session.update
+
+    def slow_update(*args, **kwargs):
+        writing.set()
+        release.wait(5)
+        return update(*args, **kwargs)
+
+    monkeypatch.setattr(Session, 'update', slow_update)
+    flusher = threading.Thread(target=store.flush)
+    flusher.start()
+    assert writing.wait(5)
+    reader = threading.Thread(target=lambda: store.set('flush-3', 'city_id', '3'))
+    reader.start()
+    reader.join(1)
+    assert not reader.is_alive()
+    release.set()
+    flusher.join()
+    assert store.get('flush-3', 'city_id') == '3'
+
+
+def test_idle_sessions_are_evicted_after_flush(store):
+    new_row(store, 'idle-1')
+    store.set('idle-1', 'city_id', '7')
+    assert store.evict(max_idle=0) == 0
+    store.flush()
+    assert store.evict(max_idle=0) == 1
+    assert 'idle-1' not in store._rows
+    assert store.get('idle-1', 'city_id') == '7'
+
+
+def test_check_in_survives_restart(database):
+    new_row(session_store, 'dates-1')
+    assert date_picker.choose('dates-1', date(2030, 5, 1)) is None
+    session_store.forget('dates-1')
+    restarted = DatePicker()
+    assert restarted.check_in('dates-1') == date(2030, 5, 1)
+    assert restarted.choose('dates-1', date(2030, 5, 3)) == (date(2030, 5, 1), date(2030, 5, 3))
+    assert restarted.check_in('dates-1') is None
+    restarted.save('dates-1', date(2030, 5, 1), date(2030, 5, 3))
+    assert restarted.check_in('dates-1') is None
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+import botrequests.bot_classes as bot_classes
+import botrequests.state as state
+from botrequests.bot_classes import CachedValue, TTLCache
+from botrequests.state import KeyValueCacheBackend, LocalKeyValue, SqliteCacheBackend, create_backend
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def backend(request, database, monkeypatch):
+    """Хранилище сохраняемых кэшей, подставленное в TTLCache"""
+    created = create_backend(request.param, CachedValue, database)
+    monkeypatch.setattr(bot_classes, 'cache_backend', created)
+    return created
+
+
+def test_create_backend_memory_round_trip():
+    created = create_backend('memory', CachedValue, None)
+    assert isinstance(created, KeyValueCacheBackend) and isinstance(created.client, LocalKeyValue)
+    expires_at = time.time() + 60
+    created.set('cities', '["moscow", "ru_RU"]', '[["Москва", "1"]]', expires_at)
+    assert created.get('cities', '["moscow", "ru_RU"]') == ('[["Москва", "1"]]', expires_at)
+    assert created.get('hotels', '["moscow", "ru_RU"]') is None
+    assert created.client.get('hotelbot:cities:["moscow", "ru_RU"]') is not None
+
+
+def test_create_backend_urls(monkeypatch):
+    assert isinstance(create_backend('sqlite', CachedValue, None), SqliteCacheBackend)
+    with pytest.raises(ValueError):
+        create_backend('memcached://localhost', CachedValue, None)
+    monkeypatch.setattr(state, 'redis', None)
+    with pytest.raises(RuntimeError):
+        create_backend('redis://localhost:6379/0', CachedValue, None)
+
+
+def test_local_key_value_expires():
+    client = LocalKeyValue()
+    client.set('short', 'value', ex=0.05)
+    client.set('forever', 'value')
+    assert client.get('short') == 'value'
+    time.sleep(0.1)
+    assert client.get('short') is None
+    assert client.get('forever') == 'value'
+    assert client.delete('short', 'forever') == 1
+
+
+def test_key_value_state_expires():
+    created = KeyValueCacheBackend(LocalKeyValue())
+    created.set('photo', '"url"', '"file_id"', time.time() + 0.05)
+    assert created.get('photo', '"url"')[0] == '"file_id"'
+    time.sleep(0.1)
+    # ключ еще хранится на сервере (время жизни округляется до секунды), но запись уже устарела
+    assert created.client.get('hotelbot:photo:"url"') is not None
+    assert created.get('photo', '"url"') is None
+
+
+def test_ttl_cache_shares_records_through_backend(backend):
+    TTLCache('shared', 10, 60, persistent=True).set(('moscow', 'ru_RU'), [['Москва', '1']])
+    other_process = TTLCache('shared', 10, 60, persistent=True)
+    assert other_process.get(('moscow', 'ru_RU')) == [['Москва', '1']]
+    assert other_process.stats() == {'hits': 1, 'misses': 0, 'size': 1}
+    assert TTLCache('other', 10, 60, persistent=True).get(('moscow', 'ru_RU')) is None
+
+
+def test_ttl_cache_expires_in_memory_and_backend(backend):
+    cache = TTLCache('expiring', 10, 0.05, persistent=True)
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    time.sleep(0.1)
+    assert cache.get('key') is None
+    assert TTLCache('expiring', 10, 0.05, persistent=True).get('key') is None
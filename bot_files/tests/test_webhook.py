@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import List
+
+import pytest
+
+from botrequests.webhook import WebhookServer
+
+SECRET = 'test-secret'
+
+with open(os.path.join(os.path.dirname(__file__), 'data', 'updates.json'), encoding='utf-8') as file:
+    RECORDED_UPDATES: List = json.load(file)
+
+
+class RecordingBot:
+    """Бот, запоминающий полученные пакеты обновлений"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay: float = delay
+        self.batches: List[List] = []
+
+    def process_new_updates(self, updates: List) -> None:
+        time.sleep(self.delay)
+        self.batches.append(updates)
+
+
+def post(server: WebhookServer, payload, secret=SECRET) -> int:
+    """Отправляет обновления серверу и возвращает код ответа"""
+    headers = {'Content-Type': 'application/json'}
+    if secret is not None:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    request = urllib.request.Request(f'http://127.0.0.1:{server.port}{server.path}',
+                                     data=json.dumps(payload).encode(), headers=headers, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as err:
+        return err.code
+
+
+@pytest.fixture
+def bot():
+    return RecordingBot()
+
+
+@pytest.fixture
+def server(bot):
+    server = WebhookServer(bot, host='127.0.0.1', port=0, path='/telegram', secret_token=SECRET)
+    server.start()
+    yield server
+    if server._thread is not None:
+        server.stop()
+
+
+def test_single_update(server, bot):
+    assert post(server, RECORDED_UPDATES[0]) == 200
+    assert len(bot.batches) == 1
+    assert bot.batches[0][0].update_id == 700000001
+    assert bot.batches[0][0].message.text == '/start'
+
+
+def test_batch_of_updates(server, bot):
+    assert post(server, RECORDED_UPDATES) == 200
+    assert [update.update_id for update in bot.batches[0]] == [700000001, 700000002, 700000003]
+    assert bot.batches[0][2].callback_query.data == '1153093.city_id'
+
+
+def test_wrong_secret_is_rejected(server, bot):
+    assert post(server, RECORDED_UPDATES[0], secret='wrong') == 403
+    assert post(server, RECORDED_UPDATES[0], secret=None) == 403
+    assert bot.batches == []
+
+
+def test_missing_secret_is_generated(bot):
+    server = WebhookServer(bot, host='127.0.0.1', port=0, secret_token='')
+    try:
+        assert server.secret_token
+        assert not server.authorized(None)
+        assert not server.authorized('')
+    finally:
+        server.server.server_close()
+
+
+def test_stop_drains_requests_in_progress():
+    bot = RecordingBot(delay=0.5)
+    server = WebhookServer(bot, host='127.0.0.1', port=0, secret_token=SECRET)
+    server.start()
+    statuses: List[int] = []
+    client = threading.Thread(target=lambda: statuses.append(post(server, RECORDED_UPDATES[1])))
+    client.start()
+    time.sleep(0.2)
+    server.stop()
+    assert len(bot.batches) == 1
+    client.join()
+    assert statuses == [200]